@@ -0,0 +1,101 @@
+# Bounded table of the 16-bit network addresses of the radios we hear
+# from, by 64-bit address, so a unicast to one of them can name its
+# 16-bit address and spare the radio a route discovery.
+#
+# Learned from RX Indicators (the sender's) and successful Transmit
+# Statuses (the destination's); forgotten when a transmit to the address
+# fails, in case the node has rejoined with a new one. When full, the
+# least recently used entry makes way.
+
+UNKNOWN16 = 0xfffe      # "unknown": the radio works it out
+BROADCAST64 = b'\x00\x00\x00\x00\x00\x00\xff\xff'
+
+def address_key(address):
+    # Addresses come as bytes, bytearrays, memoryviews or str (as tx()
+    # takes them); keys must be hashable, and the same for all of them
+    if isinstance(address, bytes):
+        return address
+    if isinstance(address, str):
+        return bytes(address, 'ASCII')
+    return bytes(address)
+
+class AddressCache(object):
+    def __init__(self, capacity=32):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.table = {}         # 64-bit address -> [16-bit address, last use]
+        self.clock = 0          # counts uses, for LRU
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0        # new or changed entries
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        return { 'entries': len(self.table),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'learned': self.learned,
+                 'evictions': self.evictions,
+                 'invalidations': self.invalidations }
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, address):
+        return address_key(address) in self.table
+
+    def learn(self, address, address16):
+        if address16 == UNKNOWN16 or address16 is None:
+            return
+        address = address_key(address)
+        if address == BROADCAST64:
+            return
+        self.clock += 1
+        e = self.table.get(address)
+        if e is not None:
+            if e[0] != address16:
+                e[0] = address16
+                self.learned += 1
+            e[1] = self.clock
+            return
+        if len(self.table) >= self.capacity:
+            self.evict()
+        self.table[address] = [address16, self.clock]
+        self.learned += 1
+
+    def evict(self):
+        # Forget the least recently used entry
+        oldest = None
+        t = None
+        for address, e in self.table.items():
+            if t is None or e[1] < t:
+                oldest = address
+                t = e[1]
+        del self.table[oldest]
+        self.evictions += 1
+
+    def lookup(self, address):
+        # The 16-bit address to send to address with, UNKNOWN16 if none
+        address = address_key(address)
+        if address == BROADCAST64:
+            return UNKNOWN16
+        e = self.table.get(address)
+        if e is None:
+            self.misses += 1
+            return UNKNOWN16
+        self.hits += 1
+        self.clock += 1
+        e[1] = self.clock
+        return e[0]
+
+    def invalidate(self, address):
+        if self.table.pop(address_key(address), None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.table.clear()
@@ -0,0 +1,109 @@
+# asyncio front end for XBRadio: uasyncio on the board, asyncio on CPython
+#
+#   aradio = AsyncXBRadio(XBRadio(...))
+#   aradio.start()                      # the one background reader task
+#   address, data = await aradio.recv()
+#   result = await aradio.send(b'hello', address)   # a TxResult
+#   temperature = await aradio.at('TP')
+#
+# The reader task is the only thing that reads the radio; it processes
+# frames as they arrive and wakes whoever is waiting on them.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from pyb import millis, elapsed_millis
+from xbradio import PacketWaitTimeout, RadioException, PacketException
+
+def sleep_ms(ms):
+    if hasattr(asyncio, 'sleep_ms'):
+        return asyncio.sleep_ms(ms)
+    return asyncio.sleep(ms / 1000)
+
+def wait_for_ms(aw, ms):
+    if hasattr(asyncio, 'wait_for_ms'):
+        return asyncio.wait_for_ms(aw, ms)
+    return asyncio.wait_for(aw, ms / 1000)
+
+
+class AsyncXBRadio:
+    def __init__(self, radio, poll_ms=1):
+        self.radio = radio
+        self.poll_ms = poll_ms  # how often the reader looks at the radio
+        self.task = None
+        self.changed = asyncio.Event() # pulsed whenever frames are processed
+        self.errors = 0
+        self.last_error = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.reader())
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def reader(self):
+        radio = self.radio
+        seen = radio.frames_processed
+        while True:
+            try:
+                radio.service()
+            except (RadioException, PacketException) as e:
+                self.errors += 1
+                self.last_error = e
+            if radio.frames_processed != seen:
+                seen = radio.frames_processed
+                self.changed.set()
+                self.changed.clear()
+            await sleep_ms(self.poll_ms)
+
+    async def wait_until(self, cond, timeout=None):
+        # Wait until cond() is true, rechecking as frames come in, or
+        # raise PacketWaitTimeout after timeout ms
+        t0 = millis()
+        while not cond():
+            if timeout is None:
+                await self.changed.wait()
+                continue
+            left = timeout - elapsed_millis(t0)
+            if left <= 0:
+                raise PacketWaitTimeout("%dms" % timeout)
+            try:
+                await wait_for_ms(self.changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+
+    async def recv(self, timeout=None):
+        # Next (address, data) received
+        q = self.radio.received_data_packets
+        await self.wait_until(lambda: len(q), timeout)
+        return q.get()
+
+    async def send(self, data, dest_address=None, ack=True, timeout=5000):
+        # Transmit, and return the TxResult once Transmit Status is in
+        radio = self.radio
+        tracker = radio.tx_tracker
+        await self.wait_until(lambda: not tracker.window_full(), timeout)
+        frame_id = radio.tx(data, dest_address, ack)
+        result = []
+        def done():
+            tracker.expire(millis())
+            r = tracker.poll(frame_id)
+            if r is not None:
+                result.append(r)
+            return result
+        await self.wait_until(done, timeout)
+        return result[0]
+
+    async def at(self, cmd, param=None, timeout=1000):
+        # As XBRadio.at(), on the local radio
+        radio = self.radio
+        frame_id = radio.send_AT_cmd(cmd, param)
+        radio.AT_replies.pop(frame_id, None)
+        await self.wait_until(lambda: frame_id in radio.AT_replies, timeout)
+        return radio.complete_AT(radio.AT_replies.pop(frame_id), param)
@@ -0,0 +1,114 @@
+# Finds the fastest SPI clock a radio stays reliable at on this board
+# and wiring, and saves it for XBRadio(..., prescaler='saved') to use
+# from then on.
+#
+#   xb = XBRadio(...)
+#   report = calibrate(xb)          # a minute or so; saves to xbspi.cfg
+#   print(report['prescaler'])
+#
+# It steps from the slowest prescaler to the fastest, running stress()
+# (loopback frames to the radio's own address, with AT commands mixed
+# in) at each, and stops at the first that isn't clean. Errors at a
+# clock rate get rarer as it gets close to what the hardware can do, so
+# a short run can pass where a long one wouldn't: the prescaler chosen
+# is margin steps slower than the fastest that ran clean.
+
+from pyb import millis, elapsed_millis
+from xbradio import PacketWaitTimeout, ATCommandError, TxWindowFull, \
+    save_prescaler, PRESCALER_FILE
+
+PRESCALERS = (256, 128, 64, 32, 16, 8)
+
+def stress(xb, frames=500, size=64, AT_every=16, timeout=500):
+    # Send frames to ourselves as fast as the transmit window allows,
+    # with ATTP every AT_every of them; returns a dict of what came back
+    # and what went wrong. 'clean' is True if nothing did.
+    hal = xb.xcvr
+    xb.get_and_process_available_packets(timeout=1)
+    xb.received_data_packets.clear()
+    xb.reset_stats()
+    received = 0
+    bad_data = 0
+    AT_failures = 0
+    sent = 0
+    t0 = millis()
+    for i in range(frames):
+        data = bytes([(i + j) & 0xff for j in range(size)])
+        try:
+            xb.tx(data, xb.address)
+        except TxWindowFull:
+            break               # statuses are going missing; no use going on
+        sent += 1
+        if i % AT_every == 0:
+            try:
+                xb.at('TP')
+            except (PacketWaitTimeout, ATCommandError):
+                AT_failures += 1
+        xb.service()
+        while len(xb.received_data_packets):
+            a, d = xb.received_data_packets.get()
+            received += 1
+            if len(d) != size or (d[-1] - d[0]) & 0xff != (size - 1) & 0xff:
+                bad_data += 1
+    # Wait for the stragglers
+    t1 = millis()
+    while received < sent and elapsed_millis(t1) < timeout:
+        xb.get_and_process_available_packets(timeout=1)
+        while len(xb.received_data_packets):
+            xb.received_data_packets.get()
+            received += 1
+    ms = elapsed_millis(t0)
+    st = xb.stats()
+    rx = st['hal']['rx']
+    r = { 'frames': frames,
+          'received': received,
+          'bad_data': bad_data,
+          'checksum_errors': rx['checksum_errors'],
+          'overruns': st['hal']['overruns'],
+          'rx_errors': st['rx_errors'],
+          'AT_failures': AT_failures,
+          'tx_failed': st['tx_failed'],
+          'ms': ms,
+          'frames_per_s': received * 1000 // max(ms, 1),
+          'spi_bytes_per_s': (st['hal']['spi_bytes_read']
+                              + st['hal']['spi_bytes_written']) * 1000 // max(ms, 1) }
+    r['clean'] = received == frames and not (bad_data or r['checksum_errors']
+        or r['overruns'] or r['rx_errors'] or AT_failures or r['tx_failed'])
+    return r
+
+def calibrate(xb, prescalers=PRESCALERS, frames=500, margin=1, path=PRESCALER_FILE,
+              verbose=False):
+    # Returns a dict with the chosen 'prescaler' (None if even the
+    # slowest wasn't clean), the 'fastest' clean one, and the stress()
+    # 'results' at each prescaler tried. The choice is saved to path,
+    # unless that is None, and left set on xb.
+    hal = xb.xcvr
+    was = hal.prescaler
+    results = []
+    fastest = None
+    for p in sorted(prescalers, reverse=True):
+        hal.set_prescaler(p)
+        r = stress(xb, frames)
+        r['prescaler'] = p
+        results.append(r)
+        if verbose:
+            print("prescaler %3d: %s, %d/%d frames, %d frames/s" %
+                  (p, 'clean' if r['clean'] else 'errors', r['received'],
+                   r['frames'], r['frames_per_s']))
+        if not r['clean']:
+            break
+        fastest = p
+    if fastest is None:
+        chosen = None
+        hal.set_prescaler(was)
+    else:
+        chosen = min(fastest << margin, results[0]['prescaler'])
+        hal.set_prescaler(chosen)
+    # Start again clean from whatever the last run left behind
+    xb.reset()
+    xb.get_and_process_available_packets(timeout=1)
+    xb.received_data_packets.clear()
+    xb.reset_stats()
+    if chosen is not None and path is not None:
+        save_prescaler(chosen, path)
+    return { 'prescaler': chosen, 'fastest': fastest, 'results': results }
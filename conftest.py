@@ -0,0 +1,25 @@
+# Run the tests on a host: put the pyb stand-in and the virtual XBee on
+# the path, and give each test a fresh pair of virtual radios wired up
+# as the 'gse' and 'flight' boards, sharing one Air.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+
+import pytest
+
+import pyb
+import xbee_sim
+
+# A script to run by hand on the pyboard, not a test module
+collect_ignore = ['xbradio_test.py']
+
+@pytest.fixture(autouse=True)
+def virtual_radios():
+    pyb.reset()
+    air = xbee_sim.Air(seed=0)
+    radios = { 'gse': xbee_sim.board('gse', air),
+               'flight': xbee_sim.board('flight', air) }
+    yield radios
+    pyb.reset()
@@ -0,0 +1,72 @@
+# Fixed-capacity FIFO queue with O(1) put and get, for parsed frames and
+# received data, so a slow consumer can't grow a list until MemoryError.
+
+# What put() does when the queue is full
+DROP_OLDEST = 0     # make room by discarding the oldest item
+DROP_NEWEST = 1     # discard the item being put
+BACKPRESSURE = 2    # the producer should stop when full() (e.g. stop
+                    # reading the radio, so the XBee's own buffer fills);
+                    # anything put regardless is discarded like DROP_NEWEST
+
+class BoundedFIFO(object):
+    def __init__(self, capacity, policy=DROP_OLDEST):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.policy = policy
+        self.items = [None] * capacity
+        self.head = 0           # next slot to get from
+        self.count = 0
+        self.high_water = 0     # most items ever held at once
+        self.dropped = 0        # items lost to overflow
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # Oldest first
+        for i in range(self.count):
+            yield self.items[(self.head + i) % self.capacity]
+
+    def full(self):
+        return self.count == self.capacity
+
+    def put(self, item):
+        # Returns False if an item (this one or the oldest) was dropped
+        if self.count == self.capacity:
+            self.dropped += 1
+            if self.policy != DROP_OLDEST:
+                return False
+            self.items[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            ok = False
+        else:
+            ok = True
+        self.items[(self.head + self.count) % self.capacity] = item
+        self.count += 1
+        if self.count > self.high_water:
+            self.high_water = self.count
+        return ok
+
+    def get(self):
+        if not self.count:
+            raise IndexError("get from empty BoundedFIFO")
+        item = self.items[self.head]
+        self.items[self.head] = None
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        return item
+
+    def peek(self):
+        if not self.count:
+            raise IndexError("peek at empty BoundedFIFO")
+        return self.items[self.head]
+
+    def clear(self):
+        while self.count:
+            self.get()
+
+    def reset_counters(self):
+        self.high_water = self.count
+        self.dropped = 0
@@ -0,0 +1,334 @@
+# Fragmentation and reassembly over XBRadio, for messages bigger than
+# the radio's RF payload limit (ATNP).
+#
+# A message is split into numbered fragments, each sent as one RF packet:
+#   0xF0 session msg_id index(2) count(2) total_length(3) data...
+# The receiver answers with an acknowledgement carrying a bitmap of the
+# fragments it has:
+#   0xF1 session msg_id count(2) bitmap...
+# session is picked at random by each FragTransport, so that a sender
+# that restarts (and numbers its messages from 1 again) isn't taken for
+# one repeating messages already received.
+# The sender keeps up to `window` fragments unacknowledged in flight,
+# resends just the ones the bitmap shows missing, and on silence for
+# `rto` ms resends what is outstanding. The receiver caps the memory
+# held by partly reassembled messages at max_reassembly bytes, evicting
+# the least recently active.
+#
+#   ft = FragTransport(radio)
+#   ft.send(address, big_bytes)     # blocks until all acknowledged
+#   ft.service()                    # keep calling, on the receiving end
+#   address, data = ft.recv()       # IndexError if nothing complete
+
+try:
+    from os import urandom
+except ImportError:
+    from uos import urandom
+from pyb import millis, elapsed_millis, wfi
+from fifo import BoundedFIFO
+from xbradio import PacketWaitTimeout, big_endian_int
+
+FRAGMENT = 0xF0
+FRAGMENT_ACK = 0xF1
+HEADER_LEN = 10
+ACK_HEADER_LEN = 5
+
+def _bit(bitmap, i):
+    return bitmap[i >> 3] & (1 << (i & 7))
+
+def _set_bit(bitmap, i):
+    bitmap[i >> 3] |= 1 << (i & 7)
+
+
+class FragmentSender(object):
+    def __init__(self, dest, session, msg_id, data, max_chunk, now):
+        if isinstance(data, str):
+            data = bytes(data, 'ASCII')
+        self.dest = dest
+        self.session = session
+        self.msg_id = msg_id
+        self.data = memoryview(data)
+        self.total = len(data)
+        self.count = max(1, (self.total + max_chunk - 1) // max_chunk)
+        self.chunk = (self.total + self.count - 1) // self.count
+        self.acked = bytearray((self.count + 7) // 8)
+        self.n_acked = 0
+        self.sent_at = [None] * self.count
+        self.base = 0           # lowest fragment not yet acknowledged
+        self.next_new = 0       # lowest fragment never sent
+        self.resend = []        # fragments to send again, soonest first
+        self.last_progress = now
+        self.retransmits = 0
+        self.done = False
+
+    def fragment(self, i):
+        s = i * self.chunk
+        return self.data[s:min(s + self.chunk, self.total)]
+
+    def header(self, i):
+        t = self.total
+        return bytes([FRAGMENT, self.session, self.msg_id, i >> 8, i & 0xff,
+                      self.count >> 8, self.count & 0xff,
+                      (t >> 16) & 0xff, (t >> 8) & 0xff, t & 0xff])
+
+    def in_flight(self):
+        n = 0
+        for i in range(self.base, self.next_new):
+            if not _bit(self.acked, i):
+                n += 1
+        return n
+
+    def ack(self, bitmap, now, min_gap):
+        # Take in a receiver's bitmap; queue up the holes it shows
+        progress = False
+        highest = -1
+        for i in range(self.count):
+            if _bit(bitmap, i):
+                highest = i
+                if not _bit(self.acked, i):
+                    _set_bit(self.acked, i)
+                    self.n_acked += 1
+                    progress = True
+        while self.base < self.count and _bit(self.acked, self.base):
+            self.base += 1
+        if progress:
+            self.last_progress = now
+        if self.n_acked == self.count:
+            self.done = True
+            return
+        for i in range(self.base, highest):
+            if not _bit(self.acked, i) and i not in self.resend \
+               and self.sent_at[i] is not None and now - self.sent_at[i] >= min_gap:
+                self.resend.append(i)
+
+    def timed_out(self, now, rto):
+        # Nothing heard for rto ms: send everything outstanding again
+        if now - self.last_progress < rto:
+            return False
+        for i in range(self.base, self.next_new):
+            if not _bit(self.acked, i) and i not in self.resend:
+                self.resend.append(i)
+        self.last_progress = now
+        return True
+
+
+class Partial(object):
+    # A message being reassembled
+    def __init__(self, count, total, now):
+        self.count = count
+        self.total = total
+        self.chunk = (total + count - 1) // count
+        self.buf = bytearray(total)
+        self.have = bytearray((count + 7) // 8)
+        self.got = 0
+        self.since_ack = 0
+        self.hole_acked = False
+        self.t_last = now
+
+
+class FragTransport(object):
+    def __init__(self, radio, mtu=None, window=8, max_reassembly=8192, rto=200,
+                 reassembly_timeout=10000):
+        self.radio = radio
+        if mtu is None:
+            mtu = radio.get_value('NP')
+        self.mtu = mtu
+        self.max_chunk = mtu - HEADER_LEN
+        self.window = window
+        self.ack_every = max(1, window // 2)
+        self.rto = rto
+        self.max_reassembly = max_reassembly
+        self.reassembly_timeout = reassembly_timeout
+        self.session = urandom(1)[0]
+        self.msg_id = 0
+        self.senders = []
+        self.partials = {}      # (source, session, msg_id) -> Partial
+        self.reassembly_bytes = 0
+        # (source, session, msg_id) -> count, to re-ack late duplicates
+        self.completed = {}
+        self.completed_order = BoundedFIFO(16)
+        self.messages = BoundedFIFO(8)  # complete (source, data)
+        # Counters
+        self.fragments_sent = 0
+        self.retransmits = 0
+        self.acks_sent = 0
+        self.evicted = 0
+        self.rejected = 0
+        self.malformed = 0      # fragments that don't fit their message
+        # Our packets come straight to us; the radio queues the rest for rx()
+        radio.subscribe(self.handle_packet, FRAGMENT)
+        radio.subscribe(self.handle_packet, FRAGMENT_ACK)
+
+    def close(self):
+        self.radio.unsubscribe(FRAGMENT)
+        self.radio.unsubscribe(FRAGMENT_ACK)
+
+    ################################################################
+    # Sending
+
+    def start_send(self, dest, data):
+        # Begin sending; service() does the rest. Returns the sender,
+        # whose .done says when every fragment has been acknowledged.
+        max_chunk = self.max_chunk
+        if (len(data) + max_chunk - 1) // max_chunk > (self.mtu - ACK_HEADER_LEN) * 8:
+            raise ValueError("message too big for one ack bitmap")
+        self.msg_id = (self.msg_id + 1) & 0xff
+        s = FragmentSender(dest, self.session, self.msg_id, data, max_chunk,
+                           millis())
+        self.senders.append(s)
+        self.pump(s, millis())
+        self.radio.flush_tx()
+        return s
+
+    def send(self, dest, data, timeout=10000):
+        s = self.start_send(dest, data)
+        t0 = millis()
+        while not s.done:
+            if elapsed_millis(t0) > timeout:
+                self.senders.remove(s)
+                raise PacketWaitTimeout("%d of %d fragments acknowledged after %dms"
+                                        % (s.n_acked, s.count, timeout))
+            self.service()
+            wfi()
+        return s
+
+    def send_fragment(self, s, i, now):
+        self.radio.tx(s.header(i) + bytes(s.fragment(i)), s.dest, flush=False)
+        s.sent_at[i] = now
+        self.fragments_sent += 1
+
+    def pump(self, s, now):
+        while s.resend:
+            i = s.resend.pop(0)
+            if not _bit(s.acked, i):
+                self.send_fragment(s, i, now)
+                s.retransmits += 1
+                self.retransmits += 1
+        n = s.in_flight()
+        while n < self.window and s.next_new < s.count:
+            self.send_fragment(s, s.next_new, now)
+            s.next_new += 1
+            n += 1
+
+    ################################################################
+    # Receiving
+
+    def recv(self):
+        # Next complete (source, data); IndexError if none
+        return self.messages.get()
+
+    def service(self):
+        # Handle what has come in, and keep sends moving
+        radio = self.radio
+        radio.service()
+        now = millis()
+        for s in self.senders:
+            s.timed_out(now, self.rto)
+            self.pump(s, now)
+        self.senders = [s for s in self.senders if not s.done]
+        self.expire(now)
+        radio.flush_tx()
+
+    def handle_packet(self, source, data):
+        # From the radio, for each packet tagged FRAGMENT or FRAGMENT_ACK
+        if data[0] == FRAGMENT:
+            if len(data) >= HEADER_LEN:
+                self.handle_fragment(source, data)
+        elif len(data) >= ACK_HEADER_LEN:
+            self.handle_ack(source, data)
+
+    def handle_ack(self, source, data):
+        if data[1] != self.session:
+            return              # for a FragTransport before us
+        msg_id = data[2]
+        for s in self.senders:
+            if s.msg_id == msg_id and s.dest == source:
+                s.ack(data[ACK_HEADER_LEN:], millis(), self.rto // 4)
+                return
+
+    def handle_fragment(self, source, data):
+        session = data[1]
+        msg_id = data[2]
+        i = (data[3] << 8) | data[4]
+        count = (data[5] << 8) | data[6]
+        total = big_endian_int(data[7:10])
+        key = (source, session, msg_id)
+        now = millis()
+        if key in self.completed:
+            self.send_ack(source, session, msg_id, count, None)  # our ack got lost
+            return
+        chunk = data[HEADER_LEN:]
+        p = self.partials.get(key)
+        if p is None:
+            if total > self.max_reassembly:
+                self.rejected += 1
+                return
+            if i >= count or \
+               i * ((total + count - 1) // count) + len(chunk) > total:
+                self.malformed += 1
+                return
+            self.make_room(total)
+            p = Partial(count, total, now)
+            self.partials[key] = p
+            self.reassembly_bytes += total
+        elif i >= count or count != p.count or total != p.total or \
+             i * p.chunk + len(chunk) > total:
+            # Corrupt, or left over from an earlier message with this ID
+            self.malformed += 1
+            return
+        p.t_last = now
+        if _bit(p.have, i):
+            self.send_ack(source, session, msg_id, count, p.have)
+            return
+        s = i * p.chunk
+        p.buf[s:s + len(chunk)] = chunk
+        _set_bit(p.have, i)
+        p.got += 1
+        p.since_ack += 1
+        if p.got == count:
+            del self.partials[key]
+            self.reassembly_bytes -= total
+            self.remember_completed(key, count)
+            self.messages.put((source, bytes(p.buf)))
+            self.send_ack(source, session, msg_id, count, None)
+            return
+        hole = False
+        for j in range(i):
+            if not _bit(p.have, j):
+                hole = True
+                break
+        if (hole and not p.hole_acked) or p.since_ack >= self.ack_every \
+           or i == count - 1:
+            p.hole_acked = hole
+            p.since_ack = 0
+            self.send_ack(source, session, msg_id, count, p.have)
+
+    def send_ack(self, dest, session, msg_id, count, bitmap):
+        # bitmap None means we have them all
+        if bitmap is None:
+            bitmap = bytearray(b'\xff' * ((count + 7) // 8))
+        self.radio.tx(bytes([FRAGMENT_ACK, session, msg_id, count >> 8, count & 0xff])
+                      + bytes(bitmap), dest, flush=False)
+        self.acks_sent += 1
+
+    def remember_completed(self, key, count):
+        if self.completed_order.full():
+            self.completed.pop(self.completed_order.get(), None)
+        self.completed_order.put(key)
+        self.completed[key] = count
+
+    def make_room(self, total):
+        # Evict the least recently active partial messages until total fits
+        while self.partials and self.reassembly_bytes + total > self.max_reassembly:
+            oldest = None
+            for key, p in self.partials.items():
+                if oldest is None or p.t_last < self.partials[oldest].t_last:
+                    oldest = key
+            self.reassembly_bytes -= self.partials.pop(oldest).total
+            self.evicted += 1
+
+    def expire(self, now):
+        for key in [k for k, p in self.partials.items()
+                    if now - p.t_last > self.reassembly_timeout]:
+            self.reassembly_bytes -= self.partials.pop(key).total
+            self.evicted += 1
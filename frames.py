@@ -0,0 +1,345 @@
+# Typed views of received API frames.
+#
+# Each wraps a memoryview of the frame payload (frame type first, as
+# PacketBuffer hands it out) and decodes a field only when it is asked
+# for, so taking a frame apart copies nothing that isn't used. Byte
+# fields (addresses, data) come back as memoryviews into the frame:
+# copy them with bytes() to keep them past the life of the buffer.
+#
+#   f = decode(b)
+#   if f.frame_type == 0x90:
+#       handle(bytes(f.source64), bytes(f.data))
+#   print(f.name, f.describe())
+
+def _hex(v):
+    return ' '.join("%x" % c for c in v)
+
+def _u16(mv, i):
+    return (mv[i] << 8) | mv[i + 1]
+
+
+class Frame(object):
+    # Any frame; also what decode() gives for types it doesn't know
+    __slots__ = ('mv',)
+    name = "Unk frame"
+
+    def __init__(self, b):
+        self.mv = b if isinstance(b, memoryview) else memoryview(b)
+
+    @property
+    def frame_type(self):
+        return self.mv[0]
+
+    def __len__(self):
+        return len(self.mv)
+
+    def describe(self):
+        return _hex(self.mv)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.name, self.describe())
+
+
+class ATResponse(Frame):
+    # 0x88: frame_id(1) command(2) status(1) data...
+    __slots__ = ('_command',)
+    name = "AT Command Response"
+    status_names = ["OK", "ERR", "Invalid Cmd", "Invalid Param", "Tx Failure"]
+
+    def __init__(self, b):
+        Frame.__init__(self, b)
+        self._command = None
+
+    @property
+    def frame_id(self):
+        return self.mv[1]
+
+    @property
+    def command(self):
+        if self._command is None:
+            self._command = str(bytes(self.mv[2:4]), 'ASCII')
+        return self._command
+
+    @property
+    def status(self):
+        return self.mv[4]
+
+    @property
+    def data(self):
+        return self.mv[5:]
+
+    def status_name(self):
+        s = self.status
+        return self.status_names[s] if s < len(self.status_names) else "0x%x" % s
+
+    def describe(self):
+        s = "id 0x%x %s %s" % (self.frame_id, self.command, self.status_name())
+        if len(self.mv) > 5:
+            s += " %s" % _hex(self.data)
+        return s
+
+
+class ModemStatus(Frame):
+    # 0x8A: status(1)
+    __slots__ = ()
+    name = "Modem Status"
+    HW_RESET = 0x00
+    WATCHDOG_RESET = 0x01
+    WOKE_UP = 0x0b
+    WENT_TO_SLEEP = 0x0c
+    status_names = { 0x00: "HW reset",
+                     0x01: "Watchdog reset",
+                     0x0b: "Network Woke Up",
+                     0x0c: "Network Went To Sleep" }
+
+    @property
+    def status(self):
+        return self.mv[1]
+
+    def describe(self):
+        return self.status_names.get(self.status, "0x%x" % self.status)
+
+
+class TransmitStatus(Frame):
+    # 0x8B: frame_id(1) dest16(2) retries(1) delivery_status(1) discovery_status(1)
+    __slots__ = ()
+    name = "Transmit Status"
+    delivery_names = { 0x00: "Success",
+                       0x01: "MAC ACK Failure",
+                       0x21: "Network ACK Failure",
+                       0x25: "Route Not Found",
+                       0x74: "Payload too large",
+                       0x75: "Indirect message unrequested" }
+    discovery_names = { 0x00: "No Discovery Overhead",
+                        0x02: "Route Discovery" }
+
+    @property
+    def frame_id(self):
+        return self.mv[1]
+
+    @property
+    def dest16(self):
+        return _u16(self.mv, 2)
+
+    @property
+    def retries(self):
+        return self.mv[4]
+
+    @property
+    def delivery_status(self):
+        return self.mv[5]
+
+    @property
+    def discovery_status(self):
+        return self.mv[6]
+
+    def describe(self):
+        d = self.delivery_status
+        ds = self.discovery_status
+        return "id 0x%x, %d retries, %s, %s" % \
+            (self.frame_id, self.retries,
+             self.delivery_names.get(d, "status 0x%x" % d),
+             self.discovery_names.get(ds, "discovery 0x%x" % ds))
+
+
+class RxIndicator(Frame):
+    # 0x90: source64(8) source16(2) options(1) data...
+    __slots__ = ()
+    name = "RX Indicator (AO=0)"
+
+    @property
+    def source64(self):
+        return self.mv[1:9]
+
+    @property
+    def source16(self):
+        return _u16(self.mv, 9)
+
+    @property
+    def options(self):
+        return self.mv[11]
+
+    @property
+    def data(self):
+        return self.mv[12:]
+
+    def describe(self):
+        return "from %s, options 0x%x data %s" % \
+            (':'.join("%x" % v for v in self.source64), self.options, _hex(self.data))
+
+
+class ExplicitRxIndicator(Frame):
+    # 0x91: source64(8) source16(2) source_endpoint(1) dest_endpoint(1)
+    #       cluster_id(2) profile_id(2) options(1) data...
+    __slots__ = ()
+    name = "Explicit Rx Indicator (AO=1)"
+
+    @property
+    def source64(self):
+        return self.mv[1:9]
+
+    @property
+    def source16(self):
+        return _u16(self.mv, 9)
+
+    @property
+    def source_endpoint(self):
+        return self.mv[11]
+
+    @property
+    def dest_endpoint(self):
+        return self.mv[12]
+
+    @property
+    def cluster_id(self):
+        return _u16(self.mv, 13)
+
+    @property
+    def profile_id(self):
+        return _u16(self.mv, 15)
+
+    @property
+    def options(self):
+        return self.mv[17]
+
+    @property
+    def data(self):
+        return self.mv[18:]
+
+    def describe(self):
+        return "from %s, endpoints 0x%x->0x%x cluster 0x%x profile 0x%x options 0x%x data %s" % \
+            (':'.join("%x" % v for v in self.source64), self.source_endpoint,
+             self.dest_endpoint, self.cluster_id, self.profile_id, self.options,
+             _hex(self.data))
+
+
+class NodeIdentification(Frame):
+    # 0x95: source64(8) source16(2) options(1) remote16(2) remote64(8)
+    #       NI... 0 parent16(2) device_type(1) source_event(1)
+    #       profile_id(2) manufacturer_id(2) ...
+    __slots__ = ('_ni_end',)
+    name = "Node Identification Indicator (AO=0)"
+
+    def __init__(self, b):
+        Frame.__init__(self, b)
+        self._ni_end = -1
+
+    @property
+    def source64(self):
+        return self.mv[1:9]
+
+    @property
+    def source16(self):
+        return _u16(self.mv, 9)
+
+    @property
+    def options(self):
+        return self.mv[11]
+
+    @property
+    def remote16(self):
+        return _u16(self.mv, 12)
+
+    @property
+    def remote64(self):
+        return self.mv[14:22]
+
+    def ni_end(self):
+        # Index of the NI string's terminating 0
+        if self._ni_end < 0:
+            mv = self.mv
+            i = 22
+            while i < len(mv) and mv[i]:
+                i += 1
+            self._ni_end = i
+        return self._ni_end
+
+    @property
+    def ni(self):
+        return str(bytes(self.mv[22:self.ni_end()]), 'ASCII')
+
+    @property
+    def parent16(self):
+        return _u16(self.mv, self.ni_end() + 1)
+
+    @property
+    def device_type(self):
+        return self.mv[self.ni_end() + 3]
+
+    @property
+    def source_event(self):
+        return self.mv[self.ni_end() + 4]
+
+    @property
+    def profile_id(self):
+        return _u16(self.mv, self.ni_end() + 5)
+
+    @property
+    def manufacturer_id(self):
+        return _u16(self.mv, self.ni_end() + 7)
+
+    def describe(self):
+        return "%r at %s, event %d" % \
+            (self.ni, ':'.join("%x" % v for v in self.remote64), self.source_event)
+
+
+class RemoteATResponse(Frame):
+    # 0x97: frame_id(1) source64(8) source16(2) command(2) status(1) data...
+    __slots__ = ('_command',)
+    name = "Remote Command Response"
+    status_names = ATResponse.status_names
+
+    def __init__(self, b):
+        Frame.__init__(self, b)
+        self._command = None
+
+    @property
+    def frame_id(self):
+        return self.mv[1]
+
+    @property
+    def source64(self):
+        return self.mv[2:10]
+
+    @property
+    def source16(self):
+        return _u16(self.mv, 10)
+
+    @property
+    def command(self):
+        if self._command is None:
+            self._command = str(bytes(self.mv[12:14]), 'ASCII')
+        return self._command
+
+    @property
+    def status(self):
+        return self.mv[14]
+
+    @property
+    def data(self):
+        return self.mv[15:]
+
+    def status_name(self):
+        s = self.status
+        return self.status_names[s] if s < len(self.status_names) else "0x%x" % s
+
+    def describe(self):
+        s = "id 0x%x from %s %s %s" % (self.frame_id,
+                                       ':'.join("%x" % v for v in self.source64),
+                                       self.command, self.status_name())
+        if len(self.mv) > 15:
+            s += " %s" % _hex(self.data)
+        return s
+
+
+FRAME_TYPES = { 0x88: ATResponse,
+                0x8a: ModemStatus,
+                0x8b: TransmitStatus,
+                0x90: RxIndicator,
+                0x91: ExplicitRxIndicator,
+                0x95: NodeIdentification,
+                0x97: RemoteATResponse }
+
+def decode(b):
+    # The typed frame for b, or a plain Frame if its type isn't known
+    return FRAME_TYPES.get(b[0], Frame)(b)
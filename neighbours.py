@@ -0,0 +1,161 @@
+# The radios we know of on the network, by NI name and by 64-bit
+# address, from node discovery (ATND replies) and Node Identification
+# Indicators (0x95), so they can be reached by name:
+#
+#   xb.discover()                   # runs ATND, waits NT for the replies
+#   xb.tx(b'on', xb.resolve('pump-7'))
+#
+# An entry not heard from (by discovery, 0x95, or a packet from it) in
+# max_age ms is forgotten. Names are looked up case sensitively, as NI
+# is set.
+
+from pyb import millis
+
+class Neighbour(object):
+    __slots__ = ('address', 'address16', 'ni', 'parent16', 'device_type',
+                 'status', 'profile_id', 'manufacturer_id', 'rssi', 'last_seen')
+
+    def __init__(self, address, address16, ni, parent16=0xfffe, device_type=None,
+                 status=None, profile_id=None, manufacturer_id=None, rssi=None,
+                 last_seen=0):
+        self.address = address
+        self.address16 = address16
+        self.ni = ni
+        self.parent16 = parent16
+        self.device_type = device_type
+        self.status = status
+        self.profile_id = profile_id
+        self.manufacturer_id = manufacturer_id
+        self.rssi = rssi        # -dBm of the last hop, if the radio said
+        self.last_seen = last_seen
+
+    def __repr__(self):
+        return "<Neighbour %r %s rssi %r>" % \
+            (self.ni, ':'.join("%02x" % v for v in self.address), self.rssi)
+
+
+def parse_ND(data, now=0):
+    # A Neighbour from the data of one ATND reply:
+    #   MY(2) SH(4) SL(4) NI... 0 parent16(2) device_type(1) status(1)
+    #   profile_id(2) manufacturer_id(2) [DD(4)] [RSSI(1)]
+    # (DD and RSSI are there if NO asks for them). None if data is too
+    # short for that, or NI isn't terminated or isn't ASCII.
+    end = 10
+    while end < len(data) and data[end]:
+        end += 1
+    i = end + 1
+    if i + 8 > len(data):
+        return None
+    try:
+        ni = str(bytes(data[10:end]), 'ASCII')
+    except (UnicodeError, ValueError):
+        return None
+    n = Neighbour(bytes(data[2:10]),
+                  (data[0] << 8) | data[1],
+                  ni,
+                  (data[i] << 8) | data[i + 1],
+                  data[i + 2],
+                  data[i + 3],
+                  (data[i + 4] << 8) | data[i + 5],
+                  (data[i + 6] << 8) | data[i + 7],
+                  None, now)
+    extra = len(data) - (i + 8)
+    if extra in (1, 5):
+        n.rssi = data[-1]
+    return n
+
+
+class NeighbourTable(object):
+    def __init__(self, max_age=600000, capacity=64):
+        self.max_age = max_age
+        self.capacity = capacity
+        self.by_address = {}    # 64-bit address -> Neighbour
+        self.by_name = {}       # NI -> Neighbour
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.updates = 0
+        self.aged_out = 0
+        self.evictions = 0
+
+    def stats(self):
+        return { 'entries': len(self.by_address),
+                 'updates': self.updates,
+                 'aged_out': self.aged_out,
+                 'evictions': self.evictions }
+
+    def __len__(self):
+        return len(self.by_address)
+
+    def __iter__(self):
+        return iter(list(self.by_address.values()))
+
+    def update(self, n):
+        # Add or refresh an entry; a node that has changed its NI is
+        # found under the new one only, and a name taken over by another
+        # node (one swapped in for it) now finds that node
+        old = self.by_address.get(n.address)
+        if old is not None:
+            if self.by_name.get(old.ni) is old:
+                del self.by_name[old.ni]
+            if n.rssi is None:
+                n.rssi = old.rssi
+        elif len(self.by_address) >= self.capacity:
+            self.evict()
+        self.by_address[n.address] = n
+        if n.ni:
+            self.by_name[n.ni] = n
+        self.updates += 1
+        return n
+
+    def evict(self):
+        # Make room by forgetting whoever was heard from longest ago
+        oldest = None
+        for n in self.by_address.values():
+            if oldest is None or n.last_seen < oldest.last_seen:
+                oldest = n
+        self.remove(oldest)
+        self.evictions += 1
+
+    def remove(self, n):
+        self.by_address.pop(n.address, None)
+        if self.by_name.get(n.ni) is n:
+            del self.by_name[n.ni]
+
+    def seen(self, address, now):
+        # A packet came from address
+        n = self.by_address.get(address)
+        if n is not None:
+            n.last_seen = now
+
+    def fresh(self, n, now):
+        if n is not None and now - n.last_seen > self.max_age:
+            self.remove(n)
+            self.aged_out += 1
+            return None
+        return n
+
+    def get(self, name, now=None):
+        # The Neighbour named name, or None
+        if now is None:
+            now = millis()
+        return self.fresh(self.by_name.get(name), now)
+
+    def get_by_address(self, address, now=None):
+        if now is None:
+            now = millis()
+        return self.fresh(self.by_address.get(bytes(address)), now)
+
+    def resolve(self, name, now=None):
+        # The 64-bit address of the node named name; KeyError if unknown
+        n = self.get(name, now)
+        if n is None:
+            raise KeyError(name)
+        return n.address
+
+    def expire(self, now=None):
+        # Forget every entry older than max_age
+        if now is None:
+            now = millis()
+        for n in list(self.by_address.values()):
+            self.fresh(n, now)
@@ -1,19 +1,56 @@
+from fifo import BoundedFIFO, DROP_OLDEST
+from parse_kernel import ring_find_sync, ring_sum, buf_sum
+
 class PacketException(Exception):
     pass
 
 class ChecksumError(PacketException):
     pass
 
+class FrameTooLongError(PacketException):
+    pass
+
+class RingFullError(PacketException):
+    pass
+
 class PacketBuffer(object):
-    def __init__(self):
-        self.packets = []
+    # Frames are handed out as bytearrays, one allocated per frame once
+    # its length is known; readinto() reads into a reusable buffer.
+    # RingPacketBuffer doesn't allocate even that.
+
+    def __init__(self, capacity=32, policy=DROP_OLDEST, max_length=1024):
+        self.packets = BoundedFIFO(capacity, policy)
+        self.max_length = max_length    # longest payload believed
+        self.rbuf = bytearray(16)       # readinto() reads here; grows to fit
+        self.rmv = memoryview(self.rbuf)
         self.reset_parse()
-        self.total_marking_bytes_count = 0
+        self.unparsed = b''     # what followed a bad frame, parsed next time
         self.marking_bytes_count = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.total_marking_bytes_count = 0
         self.packet_count = 0
+        self.byte_count = 0
+        self.checksum_errors = 0
+        self.too_long = 0
+        self.packets.reset_counters()
+
+    def stats(self):
+        return { 'bytes': self.byte_count,
+                 'frames': self.packet_count,
+                 'marking_bytes': self.total_marking_bytes_count,
+                 'checksum_errors': self.checksum_errors,
+                 'too_long': self.too_long,
+                 'queued': len(self.packets),
+                 'high_water': self.packets.high_water,
+                 'dropped': self.packets.dropped }
 
     def reset_parse(self):
-        self.packet_buf = b''
+        self.packet_buf = None
+        self.payload_length = 0
+        self.have = 0           # payload bytes gathered so far
+        self.csum = 0
         # 0: looking for new packet
         # 1: found sync ('~')
         # 2: have first byte of payload length
@@ -21,6 +58,26 @@ class PacketBuffer(object):
         # 4: have full payload, need check byte
         self.state = 0
 
+    def resync(self, discard=False):
+        # Abandon any partly parsed frame, keeping the complete ones; the
+        # parse starts again at the next '~'. With discard, what was left
+        # unparsed after a bad frame goes too (e.g. after a radio reset).
+        self.reset_parse()
+        self.marking_bytes_count = 0
+        if discard:
+            self.unparsed = b''
+
+    def parse_rest(self):
+        # Parse what was left after a bad frame, skipping any further bad
+        # ones in it (they count in checksum_errors). Returns how many.
+        errors = 0
+        while self.unparsed:
+            try:
+                self.include_bytes(b'')
+            except (ChecksumError, FrameTooLongError):
+                errors += 1
+        return errors
+
     def __len__(self):
         return len(self.packets)
 
@@ -28,53 +85,361 @@ class PacketBuffer(object):
         return iter(self.packets)
 
     def dequeue_one(self):
-        return self.packets.pop(0)
+        return self.packets.get()
+
+    def readinto(self, recv, n):
+        # Read n bytes with recv (which fills a buffer, the way pyb's
+        # SPI.recv(buf) does) and parse them
+        if n > len(self.rbuf):
+            self.rbuf = bytearray(n)
+            self.rmv = memoryview(self.rbuf)
+        recv(self.rmv[:n])
+        self._include(self.rbuf, n)
+        return n
 
     def include_bytes(self, b):
-        while len(b):
-            if self.state is 0:
-                marking, sync, b = b.partition(b'~')
-                self.total_marking_bytes_count += len(marking)
-                if sync:
-                    self.marking_bytes_count = 0
-                    self.state = 1
-                else:
-                    self.marking_bytes_count += len(marking)
-            if self.state is 1:
-                if len(b):
-                    self.payload_length = b[0]
-                    b = b[1:]
-                    self.state = 2
-            if self.state is 2:
-                if len(b):
-                    self.payload_length <<= 8
-                    self.payload_length += b[0]
-                    b = b[1:]
-                    self.state = 3
-            if self.state is 3:
-                # Try to get the bytes we need to make the length
-                want = self.payload_length - len(self.packet_buf)
-                self.packet_buf += b[:want]
-                b = b[want:]
-                if len(self.packet_buf) == self.payload_length:
+        # Like RingPacketBuffer, after a ChecksumError the parse picks up
+        # where it left off at the next call, or at parse_rest()
+        if not isinstance(b, (bytes, bytearray)):
+            b = bytes(b)
+        self._include(b, len(b))
+
+    def _include(self, buf, n):
+        self.byte_count += n
+        if self.unparsed:
+            rest = self.unparsed
+            self.unparsed = b''
+            try:
+                self._parse(rest, len(rest))
+            except PacketException:
+                self.unparsed += bytes(buf[:n])
+                raise
+        self._parse(buf, n)
+
+    def _parse(self, buf, end):
+        # Parse buf[:end] (bytes or a bytearray) where it lies
+        mv = memoryview(buf)
+        i = 0
+        while i < end:
+            state = self.state
+            if state == 0:
+                j = buf.find(b'~', i, end)
+                if j < 0:
+                    self.marking_bytes_count += end - i
+                    self.total_marking_bytes_count += end - i
+                    return
+                self.total_marking_bytes_count += j - i
+                self.marking_bytes_count = 0
+                i = j + 1
+                self.state = 1
+            elif state == 1:
+                self.payload_length = buf[i]
+                i += 1
+                self.state = 2
+            elif state == 2:
+                n = (self.payload_length << 8) + buf[i]
+                i += 1
+                if n > self.max_length:
+                    self.too_long += 1
+                    self.reset_parse()
+                    self.unparsed = bytes(buf[i:end])
+                    raise FrameTooLongError("payload length %d is over %d" \
+                                            % (n, self.max_length))
+                self.payload_length = n
+                self.packet_buf = bytearray(n)
+                self.state = 3 if n else 4
+            elif state == 3:
+                # Copy in as much of the payload as has arrived
+                k = min(self.payload_length - self.have, end - i)
+                chunk = mv[i:i + k]
+                self.packet_buf[self.have:self.have + k] = chunk
+                self.csum += buf_sum(buf, i, k)     # keep a running checksum
+                i += k
+                self.have += k
+                if self.have == self.payload_length:
                     self.state = 4
-            if self.state is 4:
-                if len(b):
-                    check_byte = b[0]
-                    b = b[1:]
-                    if (sum(self.packet_buf) & 0xff) + check_byte != 0xff:
-                        self.bad = (self.packet_buf, check_byte)
-                        self.reset_parse()
-                        raise ChecksumError("sum(packet) = 0x%x, check_byte = 0x%x" \
-                                          % (sum(self.bad[0]), self.bad[1]))
-                    self.packets.append(self.packet_buf)
-                    self.packet_count += 1
-                    self.packet_buf = b''
-                    self.state = 0
+            else:
+                check_byte = buf[i]
+                i += 1
+                if (self.csum & 0xff) + check_byte != 0xff:
+                    self.bad = (self.packet_buf, check_byte)
+                    self.checksum_errors += 1
+                    self.reset_parse()
+                    self.unparsed = bytes(buf[i:end])
+                    raise ChecksumError("sum(packet) = 0x%x, check_byte = 0x%x" \
+                                        % (sum(self.bad[0]), self.bad[1]))
+                self.packets.put(self.packet_buf)
+                self.packet_count += 1
+                self.reset_parse()
+
+    def in_a_packet(self):
+        return bool(self.state)
+
+    def bytes_needed_to_finish_next_packet(self):
+        # The fewest bytes that could finish a packet. Reading exactly
+        # this many never runs past the end of the frame.
+        if self.state == 3:
+            return self.payload_length - self.have + 1
+        return (3, 2, 1, 0, 1)[self.state]
+
+
+class RingPacketBuffer(object):
+    # A PacketBuffer that parses in place, in a preallocated ring, and
+    # hands out frames as memoryviews into the ring rather than copies.
+    #
+    # Feed it with readinto(recv, n), where recv(buf) fills buf the way
+    # pyb's SPI.recv(buf) does, or with include_bytes(b), which copies b in.
+    # The view returned by dequeue_one() is valid until the next call of
+    # dequeue_one() (or release()). A frame that wraps around the end of
+    # the ring is linearised into a scratch buffer; that is the only copy.
+
+    def __init__(self, size=1024):
+        if size < 8 or size & (size - 1):
+            raise ValueError("size must be a power of two")
+        self.size = size
+        self.mask = size - 1
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.scratch = memoryview(bytearray(size))
+        # Index of complete frames, itself a ring. Every frame takes at
+        # least 4 bytes of the ring, so this can't fill up first.
+        self.nframes = size // 4 + 1
+        self.frame_start = [0] * self.nframes
+        self.frame_len = [0] * self.nframes
+        self.frame_head = 0     # next slot to fill
+        self.frame_tail = 0     # oldest queued frame
+        self.frame_count = 0
+        self.head = 0           # next ring index to write
+        self.tail = 0           # oldest ring index still needed
+        self.scan = 0           # next ring index to parse
+        self.held = -1          # start of the frame last dequeued, if any
+        self.pending = b''      # bytes include_bytes() had yet to copy in at an error
+        self.marking_bytes_count = 0
+        self.reset_stats()
+        self.reset_parse()
+
+    def reset_stats(self):
+        self.total_marking_bytes_count = 0
+        self.packet_count = 0
+        self.byte_count = 0
+        self.checksum_errors = 0
+        self.too_long = 0
+        self.ring_full = 0
+        self.high_water = self.frame_count
+
+    def stats(self):
+        return { 'bytes': self.byte_count,
+                 'frames': self.packet_count,
+                 'marking_bytes': self.total_marking_bytes_count,
+                 'checksum_errors': self.checksum_errors,
+                 'too_long': self.too_long,
+                 'ring_full': self.ring_full,
+                 'queued': self.frame_count,
+                 'high_water': self.high_water,
+                 'dropped': 0 }
+
+    def reset_parse(self):
+        # Same states as PacketBuffer
+        self.state = 0
+        self.payload_length = 0
+        self.start = 0          # ring index just after the '~'
+        self.have = 0           # payload bytes gathered so far
+        self.csum = 0
+
+    def resync(self, discard=False):
+        # As for PacketBuffer
+        self.reset_parse()
+        self.marking_bytes_count = 0
+        if discard:
+            self.pending = b''
+            self.scan = self.head
+        self._update_tail()
+
+    def parse_rest(self):
+        # As for PacketBuffer; a bad length counts too
+        errors = 0
+        while self.pending or self.scan != self.head:
+            try:
+                self.include_bytes(b'')
+            except (ChecksumError, FrameTooLongError):
+                errors += 1
+            except RingFullError:
+                break
+        return errors
+
+    def __len__(self):
+        return self.frame_count
+
+    def __iter__(self):
+        # Copies, for inspection; dequeue_one() is the zero-copy path
+        j = self.frame_tail
+        for _ in range(self.frame_count):
+            yield bytes(self._frame_view(self.frame_start[j], self.frame_len[j]))
+            j = (j + 1) % self.nframes
 
     def in_a_packet(self):
         return bool(self.state)
 
-# Don't optimize prematurely:
-#    def bytes_needed_to_finish_next_packet(self):
-#        return 0                # FIXME
+    def bytes_needed_to_finish_next_packet(self):
+        # As for PacketBuffer
+        if self.state == 3:
+            return self.payload_length - self.have + 1
+        return (3, 2, 1, 0, 1)[self.state]
+
+    def free(self):
+        # One slot is kept empty so head == tail means empty
+        return self.mask - ((self.head - self.tail) & self.mask)
+
+    def write_view(self, n):
+        # Contiguous writable space at the head, at most n bytes
+        n = min(n, self.free(), self.size - self.head)
+        return self.mv[self.head:self.head + n]
+
+    def commit(self, n):
+        # n bytes have been written into the view from write_view(); parse them
+        self.head = (self.head + n) & self.mask
+        self.byte_count += n
+        self._parse()
+
+    def readinto(self, recv, n):
+        # Read up to n bytes with recv straight into the ring and parse
+        # them. Returns the number read, short if the ring is full.
+        got = 0
+        while got < n:
+            v = self.write_view(n - got)
+            k = len(v)
+            if not k:
+                break
+            recv(v)
+            got += k
+            self.commit(k)
+        return got
+
+    def include_bytes(self, b):
+        # After a ChecksumError, what was left of b is kept and goes in
+        # first next time, or at parse_rest()
+        if self.pending:
+            b = self.pending + bytes(b)
+            self.pending = b''
+        b = memoryview(b)
+        if not len(b):
+            self._parse()
+            return
+        i = 0
+        while i < len(b):
+            v = self.write_view(len(b) - i)
+            k = len(v)
+            if not k:
+                self.ring_full += 1
+                raise RingFullError("ring full with %d bytes unread" % (len(b) - i))
+            v[:] = b[i:i + k]
+            i += k
+            try:
+                self.commit(k)
+            except PacketException:
+                self.pending = bytes(b[i:])
+                raise
+
+    def dequeue_one(self):
+        if not self.frame_count:
+            raise IndexError("dequeue from empty RingPacketBuffer")
+        j = self.frame_tail
+        s = self.frame_start[j]
+        n = self.frame_len[j]
+        self.frame_tail = (j + 1) % self.nframes
+        self.frame_count -= 1
+        self.held = s
+        self._update_tail()
+        return self._frame_view(s, n)
+
+    def release(self):
+        # Done with the last dequeued frame; its space may be reused
+        self.held = -1
+        self._update_tail()
+
+    def _frame_view(self, s, n):
+        if s + n <= self.size:
+            return self.mv[s:s + n]
+        k = self.size - s
+        self.scratch[:k] = self.mv[s:]
+        self.scratch[k:n] = self.mv[:n - k]
+        return self.scratch[:n]
+
+    def _update_tail(self):
+        if self.held >= 0:
+            self.tail = self.held
+        elif self.frame_count:
+            self.tail = self.frame_start[self.frame_tail]
+        elif self.state:
+            self.tail = self.start
+        else:
+            self.tail = self.scan
+
+    def _parse(self):
+        buf = self.buf
+        mask = self.mask
+        i = self.scan
+        head = self.head
+        while i != head:
+            state = self.state
+            if state == 0:
+                j = ring_find_sync(buf, i, head, mask)
+                k = (j - i) & mask
+                self.marking_bytes_count += k
+                self.total_marking_bytes_count += k
+                i = j
+                if i != head:
+                    i = (i + 1) & mask
+                    self.marking_bytes_count = 0
+                    self.start = i
+                    self.state = 1
+            elif state == 1:
+                self.payload_length = buf[i]
+                i = (i + 1) & mask
+                self.state = 2
+            elif state == 2:
+                self.payload_length = (self.payload_length << 8) + buf[i]
+                i = (i + 1) & mask
+                if self.payload_length > self.size - 4:
+                    n = self.payload_length
+                    self.too_long += 1
+                    self.reset_parse()
+                    self.scan = i
+                    self._update_tail()
+                    raise FrameTooLongError("payload length %d won't fit a %d byte ring" \
+                                            % (n, self.size))
+                self.have = 0
+                self.csum = 0
+                self.state = 3 if self.payload_length else 4
+            elif state == 3:
+                # Sum as much of the payload as has arrived
+                k = min(self.payload_length - self.have, (head - i) & mask)
+                self.csum += ring_sum(buf, i, k, mask)
+                i = (i + k) & mask
+                self.have += k
+                if self.have == self.payload_length:
+                    self.state = 4
+            else:
+                check_byte = buf[i]
+                i = (i + 1) & mask
+                n = self.payload_length
+                s = (self.start + 2) & mask
+                if (self.csum & 0xff) + check_byte != 0xff:
+                    self.bad = (bytes(self._frame_view(s, n)), check_byte)
+                    self.checksum_errors += 1
+                    self.reset_parse()
+                    self.scan = i
+                    self._update_tail()
+                    raise ChecksumError("sum(packet) = 0x%x, check_byte = 0x%x" \
+                                        % (sum(self.bad[0]), self.bad[1]))
+                j = self.frame_head
+                self.frame_start[j] = s
+                self.frame_len[j] = n
+                self.frame_head = (j + 1) % self.nframes
+                self.frame_count += 1
+                self.packet_count += 1
+                if self.frame_count > self.high_water:
+                    self.high_water = self.frame_count
+                self.state = 0
+        self.scan = i
+        self._update_tail()
@@ -0,0 +1,135 @@
+# The inner loops of the frame parsers, compiled to machine code with
+# @micropython.viper where the port has it (else @native), and plain
+# Python elsewhere (e.g. CPython, for the host tests).
+#
+#   ring_find_sync(buf, i, head, mask)
+#       ring index of the first '~' from i up to head, or head if none
+#   ring_sum(buf, i, k, mask)
+#       sum of the k bytes of the ring starting at i
+#   buf_sum(buf, i, k)
+#       sum of the k bytes of a flat buffer starting at i
+#
+# For the ring ones buf is RingPacketBuffer's bytearray and mask is its
+# size - 1; PacketBuffer uses buf_sum for the running checksum of each
+# payload (it finds the sync byte with bytearray.find(), already C).
+# KERNEL says which implementation was picked. The Python versions are
+# always available as py_ring_find_sync, py_ring_sum and py_buf_sum, to
+# check the others against.
+#
+# The compiled versions are kept as source and compiled with exec() when
+# the module loads: a port built without the native emitter rejects the
+# decorators when it compiles the code, which would make this whole
+# module fail to import if they were written inline.
+
+import sys
+
+def py_ring_find_sync(buf, i, head, mask):
+    while i != head:
+        if buf[i] == 0x7e:
+            return i
+        i = (i + 1) & mask
+    return head
+
+def py_ring_sum(buf, i, k, mask):
+    s = 0
+    while k:
+        s += buf[i]
+        i = (i + 1) & mask
+        k -= 1
+    return s
+
+def py_buf_sum(buf, i, k):
+    s = 0
+    for j in range(i, i + k):
+        s += buf[j]
+    return s
+
+VIPER_SOURCE = """
+@micropython.viper
+def ring_find_sync(buf, i: int, head: int, mask: int) -> int:
+    p = ptr8(buf)
+    while i != head:
+        if p[i] == 0x7e:
+            return i
+        i = (i + 1) & mask
+    return head
+
+@micropython.viper
+def ring_sum(buf, i: int, k: int, mask: int) -> int:
+    p = ptr8(buf)
+    s = 0
+    while k:
+        s += p[i]
+        i = (i + 1) & mask
+        k -= 1
+    return s
+
+@micropython.viper
+def buf_sum(buf, i: int, k: int) -> int:
+    p = ptr8(buf)
+    s = 0
+    end = i + k
+    while i < end:
+        s += p[i]
+        i += 1
+    return s
+"""
+
+NATIVE_SOURCE = """
+@micropython.native
+def ring_find_sync(buf, i, head, mask):
+    while i != head:
+        if buf[i] == 0x7e:
+            return i
+        i = (i + 1) & mask
+    return head
+
+@micropython.native
+def ring_sum(buf, i, k, mask):
+    s = 0
+    while k:
+        s += buf[i]
+        i = (i + 1) & mask
+        k -= 1
+    return s
+
+@micropython.native
+def buf_sum(buf, i, k):
+    s = 0
+    for j in range(i, i + k):
+        s += buf[j]
+    return s
+"""
+
+def compile_kernel(source, env=None):
+    # (ring_find_sync, ring_sum, buf_sum) compiled from source, or None
+    # if this port can't compile it or what it compiles gets a sum wrong.
+    # env, if given, is the globals to run it in instead of the real
+    # micropython module (the tests run the source as plain Python).
+    try:
+        if env is None:
+            import micropython
+            env = { 'micropython': micropython }
+        g = dict(env)
+        exec(source, g)
+        find, total, flat = g['ring_find_sync'], g['ring_sum'], g['buf_sum']
+        buf = bytearray(b'\x01\x7e\x02\xfe')
+        if find(buf, 3, 2, 3) != 1 or total(buf, 2, 3, 3) != 0x101 \
+           or flat(buf, 1, 3) != 0x17e:
+            return None
+        return find, total, flat
+    except Exception:       # SyntaxError, ValueError, ... as the port has it
+        return None
+
+KERNEL = 'python'
+ring_find_sync = py_ring_find_sync
+ring_sum = py_ring_sum
+buf_sum = py_buf_sum
+
+if sys.implementation.name == 'micropython':
+    for _name, _source in (('viper', VIPER_SOURCE), ('native', NATIVE_SOURCE)):
+        _kernel = compile_kernel(_source)
+        if _kernel is not None:
+            ring_find_sync, ring_sum, buf_sum = _kernel
+            KERNEL = _name
+            break
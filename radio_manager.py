@@ -0,0 +1,175 @@
+# Runs several XBRadios from one loop, e.g. the GSE and flight radios of
+# a ground station, so that waiting on one doesn't starve the others.
+#
+#   rm = RadioManager({'gse': gse_radio, 'flight': flight_radio})
+#   name, address, data = rm.rx(timeout=100)   # from whichever radio
+#   rm.tx(b'ack', address)                     # via the radio that heard it
+#   rm.tx(b'hello', address, radio='flight')   # or a chosen one
+#   value = rm.at('flight', 'TP')              # the others keep being serviced
+#
+# service() goes round the radios in turn, starting after the one that
+# went first last time, and lets each with frames ready (nATTN asserted,
+# or frames already buffered) process up to its budget of them. budget
+# is one number for all the radios, or a dict of them by name. Budgets
+# apply to radios that are polled; one with enable_irq_rx() processes
+# its frames as they arrive, whatever its budget. What they receive goes
+# into one queue of (radio name, address, data).
+#
+# The radio each address was last heard on is remembered for tx(), for
+# up to max_routes addresses; past that the one heard from longest ago
+# is forgotten.
+
+from pyb import millis, elapsed_millis, wfi
+from fifo import BoundedFIFO, DROP_OLDEST, BACKPRESSURE
+from xbradio import PacketWaitTimeout
+from address_cache import address_key
+
+DEFAULT_BUDGET = 4
+
+class RadioManager(object):
+    def __init__(self, radios, budget=DEFAULT_BUDGET, queue_len=64,
+                 policy=DROP_OLDEST, max_routes=64):
+        if not isinstance(radios, dict):
+            radios = dict(('radio%d' % i, r) for i, r in enumerate(radios))
+        if max_routes < 1:
+            raise ValueError("max_routes must be at least 1")
+        self.radios = radios
+        self.names = sorted(radios)
+        # Frames each radio may process per turn, by name
+        if isinstance(budget, dict):
+            self.budgets = dict((name, budget.get(name, DEFAULT_BUDGET))
+                                for name in self.names)
+        else:
+            self.budgets = dict((name, budget) for name in self.names)
+        self.received = BoundedFIFO(queue_len, policy)
+        # address -> [name of the radio last heard it on, when]
+        self.routes = {}
+        self.max_routes = max_routes
+        self.route_clock = 0    # counts addresses heard, for eviction
+        self.route_evictions = 0
+        self.default = self.names[0]
+        self.turn = 0           # index of the radio to go first next time
+        self.serviced = dict((name, 0) for name in self.names)
+        self.passes = 0
+
+    def __getitem__(self, name):
+        return self.radios[name]
+
+    ################################################################
+    # Receiving
+
+    def service(self):
+        # One round of all the radios; returns the frames processed
+        n = 0
+        names = self.names
+        k = len(names)
+        for i in range(k):
+            name = names[(self.turn + i) % k]
+            radio = self.radios[name]
+            if radio.irq_rx or radio.xcvr.packet_ready():
+                m = radio.service(self.budgets[name])
+                self.serviced[name] += m
+                n += m
+            self.collect(name, radio)
+        self.turn = (self.turn + 1) % k
+        self.passes += 1
+        return n
+
+    def collect(self, name, radio):
+        # Move what radio has received into the shared queue (leaving it
+        # there while the shared queue is full, under BACKPRESSURE)
+        q = radio.received_data_packets
+        hold = self.received.policy == BACKPRESSURE
+        while len(q) and not (hold and self.received.full()):
+            address, data = q.get()
+            self.learn_route(address_key(address), name)
+            self.received.put((name, address, data))
+
+    def learn_route(self, address, name):
+        self.route_clock += 1
+        routes = self.routes
+        r = routes.get(address)
+        if r is not None:
+            r[0] = name
+            r[1] = self.route_clock
+            return
+        if len(routes) >= self.max_routes:
+            # Forget the address heard from longest ago
+            oldest = None
+            t = None
+            for a, r in routes.items():
+                if t is None or r[1] < t:
+                    oldest = a
+                    t = r[1]
+            del routes[oldest]
+            self.route_evictions += 1
+        routes[address] = [name, self.route_clock]
+
+    def poll(self, timeout=100):
+        # Service the radios until something is received, or timeout ms
+        t0 = millis()
+        while not len(self.received):
+            if not self.service():
+                if elapsed_millis(t0) >= timeout:
+                    return
+                wfi()
+
+    def wait(self, cond, timeout):
+        # Service the radios until cond() is true, or raise PacketWaitTimeout
+        t0 = millis()
+        while not cond():
+            if elapsed_millis(t0) > timeout:
+                raise PacketWaitTimeout("%dms" % timeout)
+            if not self.service():
+                wfi()
+
+    def rx(self, timeout=1):
+        # Next (radio name, address, data); IndexError if none in timeout ms
+        if not len(self.received):
+            self.poll(timeout)
+        return self.received.get()
+
+    def rx_available(self):
+        self.service()
+        return len(self.received)
+
+    ################################################################
+    # Sending
+
+    def radio_for(self, dest_address, radio=None):
+        # The name of the radio to reach dest_address by
+        if radio is not None:
+            return radio
+        r = self.routes.get(address_key(dest_address))
+        return self.default if r is None else r[0]
+
+    def tx(self, data, dest_address, radio=None, ack=True, flush=True):
+        # Transmit via the named radio, else the one dest_address was last
+        # heard on, else the default. Returns (radio name, frame ID).
+        name = self.radio_for(dest_address, radio)
+        return name, self.radios[name].tx(data, dest_address, ack, flush)
+
+    def wait_tx(self, name, frame_id, timeout=1000):
+        # The TxResult of a frame sent with tx(), servicing every radio
+        # while waiting
+        radio = self.radios[name]
+        tracker = radio.tx_tracker
+        radio.flush_tx()
+        result = []
+        def done():
+            tracker.expire(millis())
+            r = tracker.poll(frame_id)
+            if r is not None:
+                result.append(r)
+            return result
+        self.wait(done, timeout)
+        return result[0]
+
+    def at(self, name, cmd, param=None, timeout=100):
+        # As XBRadio.at() on the named radio, servicing every radio while
+        # waiting for the reply
+        radio = self.radios[name]
+        frame_id = radio.send_AT_cmd(cmd, param)
+        radio.AT_replies.pop(frame_id, None)
+        self.wait(lambda: frame_id in radio.AT_replies, timeout)
+        return radio.complete_AT(radio.AT_replies.pop(frame_id), param)
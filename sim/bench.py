@@ -0,0 +1,55 @@
+# Host-side benchmarks of the driver against the virtual XBee.
+#
+#   python sim/bench.py [frames]
+
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(1, os.path.dirname(here))
+
+import pyb
+from pyb import SPI, Pin
+import xbee_sim
+from xbradio import XBRadio
+
+def new_radio(**kw):
+    pyb.reset()
+    vx = xbee_sim.board('gse')
+    xb = XBRadio(spi=SPI(1), nRESET=Pin('Y11'), DOUT=Pin('Y12'),
+                 nSSEL=Pin('X5'), nATTN=Pin('Y10'), **kw)
+    return xb, vx
+
+def loopback(n=1000, size=64, irq=False, **kw):
+    # Send n frames to ourselves and read them all back
+    xb, vx = new_radio(**kw)
+    if irq:
+        xb.enable_irq_rx()
+    data = bytes(range(size))
+    spi0 = xb.xcvr.spi.bytes_exchanged
+    t0 = time.perf_counter()
+    for i in range(n):
+        xb.tx(data, xb.address)
+        pyb.delay(vx.latency_ms)
+        if irq:
+            while len(xb.received_data_packets):
+                xb.received_data_packets.get()
+        else:
+            while xb.rx_available():
+                xb.rx()
+    dt = time.perf_counter() - t0
+    return n / dt, xb.xcvr.spi.bytes_exchanged - spi0
+
+def report(name, n, **kw):
+    rate, spi_bytes = loopback(n, **kw)
+    print("%-24s %8.0f frames/s %8d SPI bytes" % (name, rate, spi_bytes))
+
+def main(n=1000):
+    report("PacketBuffer", n)
+    report("RingPacketBuffer", n, rx_ring_size=1024)
+    report("nATTN interrupts", n, irq=True)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,12 @@
+# CPython stand-in for the parts of MicroPython's micropython module that
+# the driver uses. Scheduled callbacks are run by the pyb stand-in.
+
+import pyb
+
+def const(x):
+    return x
+
+def schedule(fn, arg):
+    if len(pyb._scheduled) >= pyb._scheduled_depth:
+        raise RuntimeError("schedule queue full")
+    pyb._scheduled.append((fn, arg))
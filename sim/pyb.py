@@ -0,0 +1,276 @@
+# CPython stand-in for the parts of MicroPython's pyb module that the
+# XBee driver uses, so it can run on a host against a simulated radio
+# (see xbee_sim.py).
+#
+# Time is real time, except that delay() doesn't sleep: it moves the
+# clock forward instead, so tests that delay(3000) take no time at all,
+# while busy-wait loops on millis() still see time pass.
+
+import time
+
+_t0 = time.monotonic()
+_skipped_ms = 0
+
+# Things to run whenever the driver looks at the clock or a pin: devices
+# use this to fire timed events.
+_poll_hooks = []
+
+# Callbacks from micropython.schedule(). The board runs them between
+# bytecodes; here they run when the driver looks at the clock or sleeps.
+_scheduled = []
+_scheduled_depth = 8
+_running_scheduled = False
+
+def _poll():
+    for hook in list(_poll_hooks):
+        hook()
+
+def _run_scheduled():
+    global _running_scheduled
+    if _running_scheduled:
+        return
+    _running_scheduled = True
+    try:
+        while _scheduled:
+            fn, arg = _scheduled.pop(0)
+            fn(arg)
+    finally:
+        _running_scheduled = False
+
+def _tick():
+    _poll()
+    _run_scheduled()
+
+def reset():
+    # Forget all pins, buses, hooks and interrupts; for test setUp
+    global _skipped_ms
+    _skipped_ms = 0
+    Pin._pins.clear()
+    SPI._devices.clear()
+    ExtInt._lines.clear()
+    del _poll_hooks[:]
+    del _scheduled[:]
+
+def _now_ms():
+    return int((time.monotonic() - _t0) * 1000) + _skipped_ms
+
+def millis():
+    _tick()
+    return _now_ms()
+
+def micros():
+    _tick()
+    return int((time.monotonic() - _t0) * 1000000) + _skipped_ms * 1000
+
+def elapsed_millis(start):
+    return millis() - start
+
+def elapsed_micros(start):
+    return micros() - start
+
+def delay(ms):
+    global _skipped_ms
+    _skipped_ms += ms
+    _tick()
+
+def udelay(us):
+    delay(us // 1000)
+
+def wfi():
+    _tick()
+
+
+class _PinState:
+    def __init__(self, name):
+        self.name = name
+        self.mode = None
+        self.pull = None
+        self.out = 1            # value last written by the pyboard
+        self.driven = None      # value forced by a device, or None
+        self.listeners = []     # called with (name, old, new) on change
+
+    def level(self):
+        if self.mode == Pin.OUT_PP:
+            return self.out
+        if self.driven is not None:
+            v = self.driven
+        elif self.pull == Pin.PULL_DOWN:
+            v = 0
+        else:
+            v = 1
+        if self.mode == Pin.OUT_OD:
+            # Open drain: either end can pull it low
+            v &= self.out
+        return v
+
+
+class Pin:
+    IN = 0
+    OUT_PP = 1
+    OUT_OD = 0x11
+    AF_PP = 2
+    AF_OD = 0x12
+    ANALOG = 3
+    PULL_NONE = 0
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    _pins = {}
+
+    def __init__(self, name, mode=None, pull=None):
+        if name not in Pin._pins:
+            Pin._pins[name] = _PinState(name)
+        self._s = Pin._pins[name]
+        if mode is not None:
+            self.init(mode, pull)
+
+    def init(self, mode, pull=None):
+        self._change(lambda s: (setattr(s, 'mode', mode), setattr(s, 'pull', pull)))
+
+    def name(self):
+        return self._s.name
+
+    def value(self, v=None):
+        if v is None:
+            _poll()
+            return self._s.level()
+        self._change(lambda s: setattr(s, 'out', 1 if v else 0))
+
+    def high(self):
+        self.value(1)
+
+    def low(self):
+        self.value(0)
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def _change(self, f):
+        s = self._s
+        old = s.level()
+        f(s)
+        new = s.level()
+        if new != old:
+            for listener in list(s.listeners):
+                listener(s.name, old, new)
+
+    # Simulator side
+    @staticmethod
+    def drive(name, v):
+        # A device drives the pin (None to let go of it)
+        Pin(name)._change(lambda s: setattr(s, 'driven', v))
+
+    @staticmethod
+    def listen(name, listener):
+        Pin(name)._s.listeners.append(listener)
+
+
+class SPI:
+    MASTER = 0x104
+    SLAVE = 0
+    LSB = 0x80
+    MSB = 0
+
+    # bus number -> device; a device has exchange(mosi_bytes) -> miso_bytes
+    _devices = {}
+
+    def __init__(self, bus, *args, **kw):
+        self.bus = bus
+        self.prescaler = None
+        self.baudrate = None
+        self.bytes_exchanged = 0
+        self.transactions = 0
+        if args or kw:
+            self.init(*args, **kw)
+
+    def init(self, mode=MASTER, baudrate=328125, *, prescaler=None, polarity=1,
+             phase=0, bits=8, firstbit=MSB, ti=False, crc=None):
+        self.mode = mode
+        self.prescaler = prescaler
+        self.baudrate = baudrate if prescaler is None else None
+        self.polarity = polarity
+        self.phase = phase
+
+    def deinit(self):
+        pass
+
+    @staticmethod
+    def attach(bus, device):
+        SPI._devices[bus] = device
+
+    def _exchange(self, mosi):
+        self.bytes_exchanged += len(mosi)
+        self.transactions += 1
+        device = SPI._devices.get(self.bus)
+        if device is None:
+            return b'\xff' * len(mosi)
+        return device.exchange(self, bytes(mosi))
+
+    @staticmethod
+    def _as_bytes(send):
+        if isinstance(send, int):
+            return bytes([send & 0xff])
+        return bytes(send)
+
+    def send(self, send, *, timeout=5000):
+        self._exchange(self._as_bytes(send))
+
+    def recv(self, recv, *, timeout=5000):
+        if isinstance(recv, int):
+            return self._exchange(b'\x00' * recv)
+        recv[:] = self._exchange(b'\x00' * len(recv))
+        return recv
+
+    def send_recv(self, send, recv=None, *, timeout=5000):
+        miso = self._exchange(self._as_bytes(send))
+        if recv is None:
+            return miso
+        recv[:] = miso
+        return recv
+
+
+class ExtInt:
+    IRQ_RISING = 0x10110000
+    IRQ_FALLING = 0x10210000
+    IRQ_RISING_FALLING = 0x10310000
+    EVT_RISING = 0x10120000
+    EVT_FALLING = 0x10220000
+    EVT_RISING_FALLING = 0x10320000
+
+    _lines = {}                 # pin name -> ExtInt
+
+    def __init__(self, pin, mode, pull, callback):
+        if not isinstance(pin, Pin):
+            pin = Pin(pin)
+        name = pin.name()
+        if name in ExtInt._lines and ExtInt._lines[name].callback is not None \
+           and callback is not None:
+            raise ValueError("ExtInt vector %s is already in use" % name)
+        self.pin = pin
+        self.mode = mode
+        self.callback = callback
+        self.enabled = True
+        self._line = len(ExtInt._lines)
+        ExtInt._lines[name] = self
+        Pin.listen(name, self._changed)
+
+    def line(self):
+        return self._line
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def swint(self):
+        self.callback(self._line)
+
+    def _changed(self, name, old, new):
+        if not self.enabled or self.callback is None or ExtInt._lines.get(name) is not self:
+            return
+        if (new == 0 and self.mode in (ExtInt.IRQ_FALLING, ExtInt.IRQ_RISING_FALLING)) \
+           or (new == 1 and self.mode in (ExtInt.IRQ_RISING, ExtInt.IRQ_RISING_FALLING)):
+            # Hard interrupt: runs right away, in the middle of whatever
+            # caused the edge
+            self.callback(self._line)
@@ -0,0 +1,72 @@
+# A virtual radio that plays back an SPI capture (see spi_capture.py),
+# so that a session recorded on the pyboard can be run through XBRadio
+# again on a host.
+#
+#   pyb.reset()
+#   rp = ReplayXBee(1, 'Y10', open('spi.cap', 'rb'))
+#   xb = XBRadio(spi=SPI(1), nRESET=Pin('Y11'), DOUT=Pin('Y12'),
+#                nSSEL=Pin('X5'), nATTN=Pin('Y10'))
+#
+# Each SPI transaction the driver makes gets the bytes the radio sent in
+# the next captured transaction, and nATTN is held at the level it was
+# captured at before that transaction. With timing, nATTN is not asserted
+# for a transaction until as long after the start as it was captured.
+# Where the driver's transactions don't line up with the capture's (a
+# different length, or different bytes sent), mismatches is counted.
+
+import pyb
+from pyb import Pin, SPI
+from spi_capture import read_capture, miso_of, ATTN, XFER, SEND
+
+
+class ReplayXBee:
+
+    def __init__(self, bus, nATTN, f, timing=False):
+        self.nATTN = nATTN
+        self.timing = timing
+        # (ms, nATTN level before, bytes sent or None, bytes read)
+        self.transactions = []
+        attn = 0
+        for kind, t, payload in read_capture(f):
+            if kind == ATTN:
+                attn = payload[0]
+                continue
+            mosi = None
+            if kind == XFER:
+                mosi = payload[:len(payload) // 2]
+            elif kind == SEND:
+                mosi = payload
+            miso = miso_of(kind, payload)
+            if miso is None:
+                miso = b'\xff' * len(payload)
+            self.transactions.append((t, attn, mosi, miso))
+        self.next = 0
+        self.mismatches = 0
+        self.t0 = pyb._now_ms()
+        SPI.attach(bus, self)
+        pyb._poll_hooks.append(self.poll)
+        self.poll()
+
+    def done(self):
+        return self.next >= len(self.transactions)
+
+    def poll(self):
+        if self.done():
+            Pin.drive(self.nATTN, 1)
+            return
+        t, attn = self.transactions[self.next][:2]
+        if self.timing and pyb._now_ms() - self.t0 < t:
+            attn = 1
+        Pin.drive(self.nATTN, attn)
+
+    def exchange(self, spi, mosi):
+        n = len(mosi)
+        if self.done():
+            return b'\xff' * n
+        t, attn, sent, miso = self.transactions[self.next]
+        self.next += 1
+        if len(miso) != n or (sent is not None and sent != mosi):
+            self.mismatches += 1
+            miso = (miso + b'\xff' * n)[:n]
+        self.poll()
+        return miso
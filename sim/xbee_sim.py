@@ -0,0 +1,468 @@
+# A scripted virtual XBee, talking the API frame protocol over the fake
+# SPI bus in pyb.py, for running and benchmarking the driver on a host.
+#
+# It does what the driver relies on from the real radio:
+#   reset with DOUT held low puts it into SPI mode, and it says so with
+#     a Modem Status (0x8A) frame
+#   nATTN is asserted (low) while it has bytes waiting to be clocked out
+#   0x08 AT commands get 0x88 AT Command Responses
+#   0x10 Transmit Requests are delivered over a shared Air to other
+#     virtual radios (or looped back to itself), arriving there as 0x90
+#     RX Indicators, and get a 0x8B Transmit Status back
+#   0x17 Remote AT Command Requests run on the addressed radio and get a
+#     0x97 Remote Command Response back (status 4 if it can't be reached)
+#   cyclic sleep (see sleep_cycle()), announced with Modem Status 0x0B
+#     and 0x0C; unicasts sent while the network sleeps fail
+#   ATND gets a reply from each other radio on the Air within NT, then
+#     an empty one; identify() is the commissioning button, sending a
+#     0x95 Node Identification Indicator to the others
+# and can misbehave the way the real one does when the SPI clock is too
+# fast: on its own, with bit errors both ways below stable_prescaler, or
+# on demand (see wedge()).
+# Anything it doesn't understand is counted and ignored.
+
+import random
+
+import pyb
+from pyb import Pin, SPI
+
+BROADCAST = b'\x00\x00\x00\x00\x00\x00\xff\xff'
+
+def frame(payload):
+    # Wrap payload in an API frame
+    n = len(payload)
+    return bytes([0x7e, n >> 8, n & 0xff]) + bytes(payload) \
+        + bytes([0xff - (sum(payload) & 0xff)])
+
+
+class Air:
+    # The RF medium shared by a set of virtual radios
+
+    def __init__(self, loss=0.0, seed=None):
+        self.radios = {}        # 64-bit address -> VirtualXBee
+        self.loss = loss        # chance any one RF attempt is lost
+        self.random = random.Random(seed)
+
+    def join(self, xb):
+        self.radios[xb.address] = xb
+
+    def lost(self):
+        return self.loss and self.random.random() < self.loss
+
+
+class VirtualXBee:
+    boot_ms = 90                # reset to Modem Status
+    latency_ms = 2              # airtime for one RF attempt
+    ack_timeout_ms = 50         # give up on an unreachable address
+    max_retries = 3             # MAC retries
+    remote_timeout_ms = 150     # give up on a remote AT command
+    response_ms = 0             # time this node takes to answer a remote AT command
+    stable_prescaler = 64       # SPI prescalers below this one garble bytes...
+    clock_error_rate = 0.002    # ...with this chance each at half it, and more faster
+
+    def __init__(self, bus, nRESET, DOUT, nSSEL, nATTN, address, air=None,
+                 ni='', my16=None):
+        self.bus = bus
+        self.nRESET = nRESET
+        self.DOUT = DOUT
+        self.nSSEL = nSSEL
+        self.nATTN = nATTN
+        self.address = bytes(address)
+        self.air = air if air is not None else Air()
+        self.air.join(self)
+        if my16 is None:
+            my16 = bytes([self.address[6] & 0x7f, self.address[7]])
+        self.my16 = bytes(my16)
+
+        # AT parameters, as the bytes the radio would answer with
+        self.params = { 'SH': self.address[:4],
+                        'SL': self.address[4:],
+                        'MY': self.my16,
+                        'NI': bytes(ni, 'ASCII'),
+                        'VL': b'Virtual XBee',
+                        'TP': b'\x00\x19',
+                        '%V': b'\x0c\xe4',
+                        'DB': b'\x28',
+                        'PL': b'\x04',
+                        'ER': b'\x00\x00',
+                        'NP': b'\x01\x00',
+                        'NT': b'\x00\x0a',
+                        'NO': b'\x00',
+                        'ID': b'\x7f\xff',
+                        'AO': b'\x00' }
+        self.max_payload = 256
+        self.executes = { 'AC': self.at_apply,
+                          'WR': self.at_write,
+                          'FR': self.at_reset,
+                          'RE': self.at_restore }
+        self.frame_dispatch = { 0x08: self.handle_AT,
+                                0x09: self.handle_AT,
+                                0x10: self.handle_tx,
+                                0x17: self.handle_remote_AT }
+
+        # Counters, for tests and benchmarks
+        self.frames_in = {}
+        self.bad_frames = 0
+        self.clock_errors = 0   # bytes garbled by too fast an SPI clock
+        self.at_sets = {}       # param -> number of times written
+        self.flash_writes = 0
+        self.tx_count = 0
+        self.rx_count = 0
+
+        self.events = []        # [due_ms, seq, fn, args], sorted
+        self.seq = 0
+        self.spi_mode = False
+        self.in_reset = False
+        self.wedged = None      # see wedge()
+        self.cycle = None       # (wake ms, sleep ms); see sleep_cycle()
+        self.network_asleep = False
+        self.garble = 0
+        self.out = bytearray()
+        self._reset_parse()
+        self._polling = False
+
+        if bus is None:
+            return              # a node out in the field, with no host here
+        SPI.attach(bus, self)
+        Pin.listen(nRESET, self._nRESET_changed)
+        Pin.listen(nSSEL, self._nSSEL_changed)
+        pyb._poll_hooks.append(self.poll)
+        Pin.drive(nATTN, 1)
+
+    # Time
+
+    def after(self, ms, fn, *args):
+        self.seq += 1
+        self.events.append([pyb._now_ms() + ms, self.seq, fn, args])
+        self.events.sort()
+
+    def poll(self):
+        if self._polling:
+            return
+        self._polling = True
+        try:
+            now = pyb._now_ms()
+            while self.events and self.events[0][0] <= now:
+                due, seq, fn, args = self.events.pop(0)
+                fn(*args)
+        finally:
+            self._polling = False
+
+    # Pins
+
+    def _nRESET_changed(self, name, old, new):
+        if new == 0:
+            self.in_reset = True
+            self.spi_mode = False
+            self.wedged = None
+            self.garble = 0
+            self.cycle = None
+            self.network_asleep = False
+            self.events = []
+            del self.out[:]
+            self._update_nATTN()
+        else:
+            self.in_reset = False
+            # DOUT low coming out of reset forces SPI mode
+            self.spi_mode = not Pin(self.DOUT).value()
+            self._reset_parse()
+            self.after(self.boot_ms, self.send_frame, b'\x8a\x00')
+
+    def _nSSEL_changed(self, name, old, new):
+        if new == 1 and self.wedged == 'stuck':
+            self.wedged = None
+            self._update_nATTN()
+
+    def _update_nATTN(self):
+        if self.wedged:
+            Pin.drive(self.nATTN, 0)
+            return
+        Pin.drive(self.nATTN, 0 if (self.spi_mode and self.out) else 1)
+
+    # Misbehaving
+
+    def wedge(self, mode, n=1):
+        # Make the radio misbehave:
+        #   'garble'  the next n frames it sends lose a byte, so the host
+        #             loses sync with them
+        #   'stuck'   it holds nATTN asserted but sends only marking
+        #             bytes, until nSSEL is deasserted (or a reset)
+        #   'dead'    as 'stuck', but only a reset brings it back
+        if mode == 'garble':
+            self.garble += n
+            return
+        self.wedged = mode
+        self._update_nATTN()
+
+    # SPI
+
+    def exchange(self, spi, mosi):
+        self.poll()
+        n = len(mosi)
+        if not self.spi_mode or Pin(self.nSSEL).value():
+            return b'\xff' * n
+        if self.wedged:
+            # Still listening, but saying nothing
+            for c in mosi:
+                self._include_byte(c)
+            return b'\xff' * n
+        k = min(n, len(self.out))
+        miso = bytes(self.out[:k]) + b'\xff' * (n - k)
+        del self.out[:k]
+        if spi.prescaler and spi.prescaler < self.stable_prescaler:
+            rate = self.clock_error_rate * self.stable_prescaler / 2 / spi.prescaler
+            mosi = self.bit_errors(mosi, rate)
+            miso = self.bit_errors(miso, rate)
+        for c in mosi:
+            self._include_byte(c)
+        self._update_nATTN()
+        return miso
+
+    def bit_errors(self, b, rate):
+        # b with each byte, by chance rate, having a bit flipped
+        r = self.air.random
+        b = bytearray(b)
+        for i in range(len(b)):
+            if r.random() < rate:
+                b[i] ^= 1 << r.randrange(8)
+                self.clock_errors += 1
+        return bytes(b)
+
+    def send_frame(self, payload):
+        # Queue an API frame for the host to clock out
+        if self.in_reset:
+            return
+        f = frame(payload)
+        if self.garble:
+            self.garble -= 1
+            f = f[:3] + f[4:]   # drop the frame type
+        self.out += f
+        self._update_nATTN()
+
+    def _reset_parse(self):
+        self.state = 0
+        self.inbuf = bytearray()
+        self.want = 0
+
+    def _include_byte(self, c):
+        if self.state == 0:
+            if c == 0x7e:
+                self.state = 1
+        elif self.state == 1:
+            self.want = c << 8
+            self.state = 2
+        elif self.state == 2:
+            self.want += c
+            self.inbuf = bytearray()
+            self.state = 3 if self.want else 4
+        elif self.state == 3:
+            self.inbuf.append(c)
+            if len(self.inbuf) == self.want:
+                self.state = 4
+        else:
+            payload = bytes(self.inbuf)
+            self._reset_parse()
+            if (sum(payload) + c) & 0xff != 0xff:
+                self.bad_frames += 1
+            else:
+                self.handle_frame(payload)
+
+    def handle_frame(self, payload):
+        t = payload[0]
+        self.frames_in[t] = self.frames_in.get(t, 0) + 1
+        if t in self.frame_dispatch:
+            self.frame_dispatch[t](payload)
+
+    # AT commands
+
+    def handle_AT(self, p):
+        fid = p[1]
+        cmd = str(p[2:4], 'ASCII')
+        param = p[4:]
+        if cmd == 'ND':
+            self.node_discovery(fid)
+            return
+        status, data = self.do_AT(cmd, param)
+        if fid:
+            self.send_frame(bytes([0x88, fid]) + p[2:4] + bytes([status]) + data)
+
+    def do_AT(self, cmd, param):
+        # Returns (status, data) for an AT command
+        if cmd in self.executes:
+            return self.executes[cmd](param)
+        if cmd not in self.params:
+            return 2, b''       # Invalid Command
+        if param:
+            if cmd in ('SH', 'SL'):
+                return 3, b''   # Invalid Parameter: read-only
+            self.params[cmd] = bytes(param)
+            self.at_sets[cmd] = self.at_sets.get(cmd, 0) + 1
+            return 0, b''
+        return 0, self.params[cmd]
+
+    def handle_remote_AT(self, p):
+        fid = p[1]
+        dest = bytes(p[2:10])
+        cmd = bytes(p[13:15])
+        param = bytes(p[15:])
+        target = self.air.radios.get(dest)
+        if target is None or not self.delivered() or not self.delivered():
+            self.after(self.remote_timeout_ms, self.remote_AT_reply, fid, dest,
+                       b'\xff\xfe', cmd, 4, b'')  # Tx Failure
+            return
+        self.after(2 * self.latency_ms + target.response_ms, self.remote_AT_done,
+                   fid, target, cmd, param)
+
+    def remote_AT_done(self, fid, target, cmd, param):
+        status, data = target.do_AT(str(cmd, 'ASCII'), param)
+        self.remote_AT_reply(fid, target.address, target.my16, cmd, status, data)
+
+    def remote_AT_reply(self, fid, address, my16, cmd, status, data):
+        if fid:
+            self.send_frame(bytes([0x97, fid]) + address + my16 + cmd
+                            + bytes([status]) + data)
+
+    def node_discovery(self, fid):
+        nt = 0
+        for c in self.params['NT']:
+            nt = (nt << 8) | c
+        nt *= 100
+        rssi = self.params['NO'][0] & 0x04
+        for xb in list(self.air.radios.values()):
+            if xb is self or not self.delivered():
+                continue
+            ms = self.latency_ms + self.air.random.randrange(nt // 2)
+            self.after(ms, self.send_frame, bytes([0x88, fid]) + b'ND\x00'
+                       + xb.ND_data(rssi))
+        self.after(nt, self.send_frame, bytes([0x88, fid]) + b'ND\x00')
+
+    def ND_data(self, rssi=False):
+        # What this radio says about itself to node discovery
+        d = self.my16 + self.address + self.params['NI'] + b'\x00' \
+            + b'\xff\xfe' + b'\x01\x00' + b'\xc1\x05' + b'\x10\x1e'
+        if rssi:
+            d += self.params['DB']
+        return d
+
+    def identify(self):
+        # The commissioning button: tell the other radios who we are
+        payload = self.address + self.my16 + b'\x02' + self.my16 + self.address \
+            + self.params['NI'] + b'\x00' + b'\xff\xfe' + b'\x01\x01' \
+            + b'\xc1\x05' + b'\x10\x1e'
+        for xb in list(self.air.radios.values()):
+            if xb is not self:
+                xb.after(self.latency_ms, xb.send_frame, b'\x95' + payload)
+
+    def at_apply(self, param):
+        return 0, b''
+
+    def at_write(self, param):
+        self.flash_writes += 1
+        return 0, b''
+
+    def at_reset(self, param):
+        self.after(1, self._soft_reset)
+        return 0, b''
+
+    def at_restore(self, param):
+        return 0, b''
+
+    def _soft_reset(self):
+        del self.out[:]
+        self.send_frame(b'\x8a\x01')
+
+    # Sleep
+
+    def sleep_cycle(self, wake_ms, sleep_ms):
+        # Join a cyclic sleep network that stays awake for wake_ms and
+        # then sleeps for sleep_ms, from now on (until reset)
+        self.cycle = (wake_ms, sleep_ms)
+        self.after(wake_ms, self._go_to_sleep, self.cycle)
+
+    def _go_to_sleep(self, cycle):
+        if cycle is not self.cycle:
+            return              # an old cycle
+        self.network_asleep = True
+        self.send_frame(b'\x8a\x0c')
+        self.after(cycle[1], self._wake_up, cycle)
+
+    def _wake_up(self, cycle):
+        if cycle is not self.cycle:
+            return
+        self.network_asleep = False
+        self.send_frame(b'\x8a\x0b')
+        self.after(cycle[0], self._go_to_sleep, cycle)
+
+    # RF
+
+    def handle_tx(self, p):
+        fid = p[1]
+        dest = bytes(p[2:10])
+        dest16 = bytes(p[10:12])
+        options = p[13]
+        data = bytes(p[14:])
+        self.tx_count += 1
+        if len(data) > self.max_payload:
+            self.tx_status(fid, b'\xff\xfe', 0, 0x74, 0)
+            return
+        if dest == BROADCAST:
+            for xb in list(self.air.radios.values()):
+                if xb is not self:
+                    self.after(self.latency_ms, xb.receive, self.address, self.my16,
+                               data, 0x02)
+            self.after(self.latency_ms, self.tx_status, fid, b'\xff\xfe', 0, 0x00, 0)
+            return
+        target = self.air.radios.get(dest)
+        if target is None or self.network_asleep:
+            self.after(self.ack_timeout_ms, self.tx_status, fid, b'\xff\xfe',
+                       self.max_retries, 0x21, 0)
+            return
+        if dest16 != b'\xff\xfe' and dest16 != target.my16:
+            self.after(self.ack_timeout_ms, self.tx_status, fid, b'\xff\xfe',
+                       self.max_retries, 0x21, 0)
+            return
+        discovery = 0x02 if dest16 == b'\xff\xfe' else 0x00
+        retries = 0
+        while self.air.lost():
+            if retries == self.max_retries or options & 0x01:
+                self.after(self.latency_ms * (retries + 1), self.tx_status, fid,
+                           target.my16, retries, 0x01, discovery)
+                return
+            retries += 1
+        ms = self.latency_ms * (retries + 1)
+        self.after(ms, target.receive, self.address, self.my16, data, 0x01)
+        self.after(ms, self.tx_status, fid, target.my16, retries, 0x00, discovery)
+
+    def delivered(self):
+        # One RF packet, with MAC retries; False if every attempt is lost
+        for i in range(self.max_retries + 1):
+            if not self.air.lost():
+                return True
+        return False
+
+    def tx_status(self, fid, dest16, retries, status, discovery):
+        if fid:
+            self.send_frame(bytes([0x8b, fid]) + dest16
+                            + bytes([retries, status, discovery]))
+
+    def receive(self, src, src16, data, options):
+        # An RF packet arrives from the Air
+        self.rx_count += 1
+        self.send_frame(b'\x90' + src + src16 + bytes([options]) + data)
+
+
+# The two pyboards in test_XBRadio.create_test_radio
+BOARDS = { 'gse': (1, 'Y11', 'Y12', 'X5', 'Y10',
+                   b'\x00\x13\xa2\x00\x40\xa1\xb2\xc3'),
+           'flight': (2, 'X11', 'X12', 'Y5', 'Y4',
+                      b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6') }
+
+def node(air, address, ni='', **kw):
+    # A virtual XBee out in the field: on the Air, but with no host
+    return VirtualXBee(None, None, None, None, None, address, air=air, ni=ni, **kw)
+
+def board(name, air=None, **kw):
+    # A virtual XBee wired up the way the named test board is
+    bus, nRESET, DOUT, nSSEL, nATTN, address = BOARDS[name]
+    return VirtualXBee(bus, nRESET, DOUT, nSSEL, nATTN, address, air=air,
+                       ni=name, **kw)
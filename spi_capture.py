@@ -0,0 +1,150 @@
+# Capture of the raw SPI traffic between XBRHAL and the radio, and
+# replay of a capture into a PacketBuffer, so that incidents seen in the
+# field (marking-byte storms, checksum bursts, overruns) can be brought
+# home and run again.
+#
+#   hal.start_capture(open('spi.cap', 'wb'))    # or wrap the SPI yourself:
+#   spi = CaptureSPI(SPI(1), open('spi.cap', 'wb'), Pin('Y10'))
+#   ...
+#   hal.stop_capture()
+#
+#   report = replay_into(PacketBuffer(), open('spi.cap', 'rb'))
+#
+# sim/replay.py plays a capture back as a virtual radio, for replaying
+# into a whole XBRadio on a host.
+#
+# The log is HEADER, then records of
+#   kind(1) ms since capture start(4) length(2) payload
+# kinds:
+#   RECV    payload is the bytes read
+#   XFER    payload is the bytes sent, then the bytes read (as many again)
+#   SEND    payload is the bytes sent
+#   ATTN    payload is the nATTN level, recorded before a transaction
+#           whenever it differs from the last one recorded
+
+from pyb import millis, elapsed_millis, delay
+from packet_buffer import ChecksumError, FrameTooLongError, RingFullError
+
+HEADER = b'XBSPI1\n'
+RECV = 0x52
+XFER = 0x58
+SEND = 0x53
+ATTN = 0x41
+
+class CaptureSPI(object):
+    # Stands in for a pyb SPI, passing everything through to it and
+    # logging what goes by
+    def __init__(self, spi, log, nATTN=None):
+        self.spi = spi
+        self.log = log
+        self.nATTN = nATTN
+        self.t0 = millis()
+        self.attn = None
+        self.records = 0
+        self.bytes_logged = 0
+        log.write(HEADER)
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+    def record(self, kind, payload):
+        n = len(payload)
+        t = elapsed_millis(self.t0)
+        self.log.write(bytes([kind, (t >> 24) & 0xff, (t >> 16) & 0xff,
+                              (t >> 8) & 0xff, t & 0xff, n >> 8, n & 0xff]))
+        self.log.write(payload)
+        self.records += 1
+        self.bytes_logged += 7 + n
+
+    def note_attn(self):
+        if self.nATTN is not None:
+            v = self.nATTN.value()
+            if v != self.attn:
+                self.attn = v
+                self.record(ATTN, bytes([v]))
+
+    def recv(self, recv, timeout=5000):
+        self.note_attn()
+        r = self.spi.recv(recv, timeout=timeout)
+        self.record(RECV, bytes(r))
+        return r
+
+    def send_recv(self, send, recv=None, timeout=5000):
+        self.note_attn()
+        mosi = bytes(send)      # send may be a view of a buffer about to change
+        r = self.spi.send_recv(send, recv, timeout=timeout)
+        self.record(XFER, mosi + bytes(r))
+        return r
+
+    def send(self, send, timeout=5000):
+        self.note_attn()
+        if isinstance(send, int):
+            send = bytes([send & 0xff])
+        self.spi.send(send, timeout=timeout)
+        self.record(SEND, bytes(send))
+
+
+def read_capture(f):
+    # Yield (kind, ms, payload) for each record of a capture
+    if f.read(len(HEADER)) != HEADER:
+        raise ValueError("not an SPI capture")
+    while True:
+        h = f.read(7)
+        if len(h) < 7:
+            return
+        t = (h[1] << 24) | (h[2] << 16) | (h[3] << 8) | h[4]
+        n = (h[5] << 8) | h[6]
+        payload = f.read(n)
+        if len(payload) < n:
+            return              # cut short, e.g. by a reset mid-write
+        yield h[0], t, payload
+
+def miso_of(kind, payload):
+    # The bytes the radio sent in a record, or None
+    if kind == RECV:
+        return payload
+    if kind == XFER:
+        return payload[len(payload) // 2:]
+    return None
+
+def replay_into(pb, f, timing=False):
+    # Feed every byte the radio sent in a capture into pb, as fast as
+    # possible or (if timing) at the pace it was captured. Returns a
+    # report dict with the frames parsed (as bytes) and the errors.
+    frames = []
+    errors = { 'checksum_errors': 0, 'too_long': 0, 'ring_full': 0 }
+    n = 0
+    t0 = millis()
+    for kind, t, payload in read_capture(f):
+        miso = miso_of(kind, payload)
+        if miso is None:
+            continue
+        if timing:
+            ahead = t - elapsed_millis(t0)
+            if ahead > 0:
+                delay(ahead)
+        n += len(miso)
+        while True:
+            try:
+                pb.include_bytes(miso)
+                error = None
+            except ChecksumError:
+                error = 'checksum_errors'
+            except FrameTooLongError:
+                error = 'too_long'
+            except RingFullError:
+                error = 'ring_full'
+            while len(pb):
+                frames.append(bytes(pb.dequeue_one()))
+            if hasattr(pb, 'release'):
+                pb.release()
+            if error is None:
+                break
+            errors[error] += 1
+            miso = b''          # go on with what followed the bad frame
+    report = { 'frames': frames,
+               'bytes': n,
+               'marking_bytes': pb.total_marking_bytes_count,
+               'ms': elapsed_millis(t0) }
+    report.update(errors)
+    return report
@@ -0,0 +1,479 @@
+# Reliable, ordered byte streams between two radios, over XBRadio.tx.
+#
+#   st = StreamTransport(radio)
+#   s = st.connect(address)         # or, on the other end, s = st.accept()
+#   s.write(data)                   # blocks while the send buffer is full
+#   data = s.read(100)              # b'' at end of stream
+#   s.close()
+#
+# Streams are file-like (write, read, readinto, flush, close), so a file
+# can be copied through one a block at a time.
+#
+# RF packets used, each starting with a tag byte:
+#   0xF2 conn seq(2) data...        a segment of the stream
+#   0xF3 conn next_seq(2) window    cumulative ack, and room for more segments
+#   0xF4 conn kind                  connection control: SYN, SYN_ACK, FIN, FIN_ACK
+# `conn` is the initiator's connection number, with the top bit set in
+# packets from the accepting end. Sequence numbers count segments, mod 2**16.
+#
+# The sender keeps at most min(cwnd, peer's window) segments in flight.
+# cwnd grows by one segment per window acknowledged and halves (at most
+# once per round trip) on loss: an rto timeout, two duplicate acks, a
+# failed Transmit Status, or a Transmit Status that needed retry_threshold
+# or more MAC retries. rto follows the smoothed round trip time.
+
+from pyb import millis, elapsed_millis, wfi
+from fifo import BoundedFIFO
+from xbradio import PacketWaitTimeout, RadioException
+
+STREAM_DATA = 0xF2
+STREAM_ACK = 0xF3
+STREAM_CTL = 0xF4
+DATA_HEADER_LEN = 4
+
+SYN = 1
+SYN_ACK = 2
+FIN = 3
+FIN_ACK = 4
+
+# Stream states
+CONNECTING = 0
+OPEN = 1
+CLOSING = 2         # our FIN sent, waiting for its FIN_ACK
+CLOSED = 3
+
+class StreamClosed(RadioException):
+    pass
+
+def seq_lt(a, b):
+    return a != b and ((b - a) & 0xffff) < 0x8000
+
+
+class Segment(object):
+    __slots__ = ('seq', 'data', 't_sent', 'retransmitted', 'frame_id')
+
+    def __init__(self, data):
+        self.seq = None
+        self.data = data
+        self.t_sent = None
+        self.retransmitted = False
+        self.frame_id = None
+
+
+class Stream(object):
+    def __init__(self, transport, peer, conn_id, initiator, state):
+        self.transport = transport
+        self.peer = peer
+        self.conn_id = conn_id
+        self.initiator = initiator
+        self.state = state
+        self.timeout = transport.timeout
+        self.t_ctl = None           # when our last SYN or FIN went out
+        # Sending
+        self.queue = []             # Segments written but not yet sent
+        self.unacked = []           # Segments in flight, oldest first
+        self.buffered = 0           # bytes in queue and unacked
+        self.snd_una = 0            # oldest unacknowledged sequence number
+        self.snd_next = 0
+        self.cwnd = 2
+        self.cwnd_acc = 0
+        self.peer_window = 2
+        self.dup_acks = 0
+        self.recover = None         # snd_next at the last cut, while recovering
+        self.last_cut = 0
+        self.srtt = None
+        self.rttvar = 0
+        self.rto = transport.initial_rto
+        # Receiving
+        self.rcv_next = 0
+        self.ooo = {}               # out of order: seq -> data
+        self.chunks = BoundedFIFO(transport.rx_segments)
+        self.chunk_off = 0
+        self.available = 0          # bytes ready to read
+        self.ack_due = False
+        self.adv_window = 0
+        self.peer_fin = False
+        # Counters
+        self.segments_sent = 0
+        self.retransmits = 0
+        self.cuts = 0
+
+    def __repr__(self):
+        return "<Stream %d state %d cwnd %d rto %d>" % (self.conn_id, self.state,
+                                                        self.cwnd, self.rto)
+
+    def wire_conn(self):
+        return self.conn_id if self.initiator else self.conn_id | 0x80
+
+    ################################################################
+    # File-like interface
+
+    def write(self, data):
+        # Queue data for sending; blocks while the send buffer is full.
+        # Returns the number of bytes written.
+        if self.state != OPEN:
+            raise StreamClosed("stream not open")
+        if isinstance(data, str):
+            data = bytes(data, 'ASCII')
+        t = self.transport
+        mv = memoryview(data)
+        n = 0
+        while n < len(mv):
+            room = t.send_buffer - self.buffered
+            if room <= 0:
+                t.wait(lambda: self.buffered < t.send_buffer, self.timeout)
+                continue
+            k = min(room, len(mv) - n)
+            self.enqueue(mv[n:n + k])
+            n += k
+        t.pump(self, millis())
+        t.radio.flush_tx()
+        return n
+
+    def enqueue(self, mv):
+        # Fill up the last unsent segment first, so small writes coalesce
+        mss = self.transport.mss
+        q = self.queue
+        i = 0
+        if q and len(q[-1].data) < mss:
+            k = min(mss - len(q[-1].data), len(mv))
+            q[-1].data += bytes(mv[:k])
+            i = k
+        while i < len(mv):
+            q.append(Segment(bytes(mv[i:i + mss])))
+            i += mss
+        self.buffered += len(mv)
+
+    def flush(self):
+        # Wait until everything written has been acknowledged
+        self.transport.wait(lambda: not self.buffered or self.state == CLOSED,
+                            self.timeout)
+
+    def readinto(self, buf):
+        # Wait for data, then copy in as much as fits. 0 at end of stream.
+        t = self.transport
+        t.wait(lambda: self.available or self.peer_fin or self.state == CLOSED,
+               self.timeout)
+        mv = memoryview(buf)
+        n = 0
+        while n < len(mv) and self.available:
+            c = self.chunks.peek()
+            k = min(len(c) - self.chunk_off, len(mv) - n)
+            mv[n:n + k] = c[self.chunk_off:self.chunk_off + k]
+            n += k
+            self.available -= k
+            self.chunk_off += k
+            if self.chunk_off == len(c):
+                self.chunks.get()
+                self.chunk_off = 0
+        if n and self.adv_window == 0:
+            self.ack_due = True  # tell the sender there's room again
+        return n
+
+    def read(self, n=None):
+        # Up to n bytes (all that's ready, if n is None); b'' at end of stream
+        if n is None:
+            self.transport.wait(lambda: self.available or self.peer_fin
+                                or self.state == CLOSED, self.timeout)
+            n = self.available
+        buf = bytearray(n)
+        return bytes(buf[:self.readinto(buf)])
+
+    def close(self):
+        # Send what's left, then FIN
+        t = self.transport
+        if self.state == OPEN:
+            self.flush()
+            self.state = CLOSING
+            t.send_ctl(self, FIN)
+            t.radio.flush_tx()
+        if self.state == CLOSING:
+            t.wait(lambda: self.state == CLOSED, self.timeout)
+
+    ################################################################
+    # Round trip estimation and congestion window
+
+    def rtt_sample(self, r):
+        t = self.transport
+        if self.srtt is None:
+            self.srtt = r
+            self.rttvar = r // 2
+        else:
+            self.rttvar = (3 * self.rttvar + abs(self.srtt - r)) // 4
+            self.srtt = (7 * self.srtt + r) // 8
+        self.rto = min(t.max_rto, max(t.min_rto, self.srtt + 4 * self.rttvar))
+
+    def grow(self):
+        self.cwnd_acc += 1
+        if self.cwnd_acc >= self.cwnd:
+            self.cwnd_acc = 0
+            if self.cwnd < self.transport.max_window:
+                self.cwnd += 1
+
+    def cut(self, now):
+        # Halve the window, at most once per round trip
+        if now - self.last_cut < (self.srtt or self.rto):
+            return
+        self.last_cut = now
+        self.cwnd = max(1, self.cwnd // 2)
+        self.cwnd_acc = 0
+        self.recover = self.snd_next
+        self.cuts += 1
+
+    def window(self):
+        # Segments we have room to take in
+        return max(0, self.chunks.capacity - len(self.chunks) - len(self.ooo))
+
+
+class StreamTransport(object):
+    def __init__(self, radio, mss=None, max_window=16, send_buffer=4096,
+                 rx_segments=16, initial_rto=500, min_rto=50, max_rto=4000,
+                 retry_threshold=2, timeout=5000):
+        self.radio = radio
+        if mss is None:
+            mss = radio.get_value('NP') - DATA_HEADER_LEN
+        self.mss = mss
+        self.max_window = max_window
+        self.send_buffer = send_buffer
+        self.rx_segments = rx_segments
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.retry_threshold = retry_threshold
+        self.timeout = timeout
+        self.streams = {}       # (peer, conn_id, initiator) -> Stream
+        self.next_conn = 0
+        self.accepting = BoundedFIFO(4)
+        # Our packets come straight to us; the radio queues the rest for rx()
+        for tag in (STREAM_DATA, STREAM_ACK, STREAM_CTL):
+            radio.subscribe(self.handle_packet, tag)
+
+    def close(self):
+        for tag in (STREAM_DATA, STREAM_ACK, STREAM_CTL):
+            self.radio.unsubscribe(tag)
+
+    def wait(self, cond, timeout):
+        t0 = millis()
+        while not cond():
+            if timeout is not None and elapsed_millis(t0) > timeout:
+                raise PacketWaitTimeout("%dms" % timeout)
+            self.service()
+            wfi()
+
+    ################################################################
+    # Connections
+
+    def connect(self, dest, timeout=None):
+        self.next_conn = (self.next_conn + 1) & 0x7f
+        s = Stream(self, dest, self.next_conn, True, CONNECTING)
+        self.streams[(dest, s.conn_id, True)] = s
+        self.send_ctl(s, SYN)
+        self.radio.flush_tx()
+        try:
+            self.wait(lambda: s.state != CONNECTING,
+                      self.timeout if timeout is None else timeout)
+        except PacketWaitTimeout:
+            del self.streams[(dest, s.conn_id, True)]
+            raise
+        return s
+
+    def accept(self, timeout=None):
+        self.wait(lambda: len(self.accepting),
+                  self.timeout if timeout is None else timeout)
+        return self.accepting.get()
+
+    def handle_packet(self, source, data):
+        # From the radio, for each packet tagged STREAM_DATA, STREAM_ACK
+        # or STREAM_CTL
+        tag = data[0]
+        if tag == STREAM_CTL:
+            if len(data) >= 3:
+                self.handle_ctl(source, data)
+            return
+        if len(data) < (DATA_HEADER_LEN if tag == STREAM_DATA else 5):
+            return
+        c = data[1]
+        s = self.streams.get((source, c & 0x7f, bool(c & 0x80)))
+        if s is None or s.state == CONNECTING:
+            return
+        if tag == STREAM_DATA:
+            self.handle_data(s, data)
+        else:
+            self.handle_ack(s, data, millis())
+
+    def send_ctl(self, s, kind):
+        self.radio.tx(bytes([STREAM_CTL, s.wire_conn(), kind]), s.peer, flush=False)
+        if kind == SYN or kind == FIN:
+            s.t_ctl = millis()
+
+    def handle_ctl(self, source, data):
+        c = data[1]
+        kind = data[2]
+        key = (source, c & 0x7f, bool(c & 0x80))
+        s = self.streams.get(key)
+        if kind == SYN:
+            if s is not None and (s.rcv_next or s.snd_next or s.peer_fin
+                                  or s.state != OPEN):
+                # Not a resent SYN but a new connection: the peer has
+                # started over (restarted, say) with a conn number still
+                # in use here, and the old stream is finished
+                self.drop_stream(key, s)
+                s = None
+            if s is None:
+                s = Stream(self, source, c, False, OPEN)
+                self.streams[key] = s
+                if not self.accepting.put(s):
+                    del self.streams[key]
+                    return
+            self.send_ctl(s, SYN_ACK)
+        elif s is None:
+            if kind == FIN:
+                self.radio.tx(bytes([STREAM_CTL, c ^ 0x80, FIN_ACK]), source,
+                              flush=False)
+        elif kind == SYN_ACK:
+            if s.state == CONNECTING:
+                s.state = OPEN
+        elif kind == FIN:
+            s.peer_fin = True
+            self.send_ctl(s, FIN_ACK)
+        elif kind == FIN_ACK:
+            if s.state == CLOSING:
+                s.state = CLOSED
+
+    def drop_stream(self, key, s):
+        # Forget s; whoever has it reads end of stream, and can't write
+        s.state = CLOSED
+        s.peer_fin = True
+        del self.streams[key]
+        q = self.accepting
+        for i in range(len(q)):
+            t = q.get()
+            if t is not s:
+                q.put(t)
+
+    ################################################################
+    # Sending
+
+    def send_segment(self, s, seg, now):
+        seq = seg.seq
+        seg.frame_id = self.radio.tx(bytes([STREAM_DATA, s.wire_conn(), seq >> 8,
+                                            seq & 0xff]) + seg.data,
+                                     s.peer, flush=False)
+        seg.t_sent = now
+        s.segments_sent += 1
+
+    def retransmit(self, s, seg, now):
+        seg.retransmitted = True
+        s.retransmits += 1
+        self.send_segment(s, seg, now)
+
+    def pump(self, s, now):
+        while s.queue and len(s.unacked) < min(s.cwnd, s.peer_window):
+            seg = s.queue.pop(0)
+            seg.seq = s.snd_next
+            s.snd_next = (s.snd_next + 1) & 0xffff
+            s.unacked.append(seg)
+            self.send_segment(s, seg, now)
+
+    def handle_ack(self, s, data, now):
+        a = (data[2] << 8) | data[3]
+        s.peer_window = max(1, data[4])
+        if seq_lt(s.snd_una, a):
+            sample = None
+            while s.unacked and seq_lt(s.unacked[0].seq, a):
+                seg = s.unacked.pop(0)
+                s.buffered -= len(seg.data)
+                if not seg.retransmitted:
+                    sample = now - seg.t_sent
+                s.grow()
+            if sample is not None:
+                s.rtt_sample(sample)
+            s.snd_una = a
+            s.dup_acks = 0
+            if s.recover is not None:
+                if seq_lt(a, s.recover) and s.unacked:
+                    self.retransmit(s, s.unacked[0], now)  # next hole
+                else:
+                    s.recover = None
+        elif a == s.snd_una and s.unacked:
+            s.dup_acks += 1
+            if s.dup_acks == 2:
+                s.cut(now)
+                self.retransmit(s, s.unacked[0], now)
+
+    def check_tx_status(self, s, now):
+        # What the radio said about each segment's delivery
+        tracker = self.radio.tx_tracker
+        for seg in s.unacked:
+            if seg.frame_id is None:
+                continue
+            try:
+                r = tracker.poll(seg.frame_id)
+            except KeyError:
+                seg.frame_id = None
+                continue
+            if r is None:
+                continue
+            seg.frame_id = None
+            if r.status != 0:
+                s.cut(now)
+                self.retransmit(s, seg, now)
+            elif r.retries >= self.retry_threshold:
+                s.cut(now)
+
+    def check_timers(self, s, now):
+        if s.state == CONNECTING or s.state == CLOSING:
+            if now - s.t_ctl > s.rto:
+                self.send_ctl(s, SYN if s.state == CONNECTING else FIN)
+        if s.unacked and now - s.unacked[0].t_sent > s.rto:
+            s.rto = min(self.max_rto, s.rto * 2)
+            s.cwnd = 1
+            s.cwnd_acc = 0
+            s.recover = s.snd_next
+            self.retransmit(s, s.unacked[0], now)
+
+    ################################################################
+    # Receiving
+
+    def handle_data(self, s, data):
+        seq = (data[2] << 8) | data[3]
+        s.ack_due = True
+        if s.peer_fin:
+            return
+        if seq == s.rcv_next:
+            if s.chunks.full():
+                return
+            self.deliver(s, bytes(data[DATA_HEADER_LEN:]))
+            while s.rcv_next in s.ooo and not s.chunks.full():
+                self.deliver(s, s.ooo.pop(s.rcv_next))
+        elif seq_lt(s.rcv_next, seq) and seq not in s.ooo and s.window() > 0:
+            s.ooo[seq] = bytes(data[DATA_HEADER_LEN:])
+
+    def deliver(self, s, d):
+        s.chunks.put(d)
+        s.available += len(d)
+        s.rcv_next = (s.rcv_next + 1) & 0xffff
+
+    def send_ack(self, s):
+        w = min(255, s.window())
+        n = s.rcv_next
+        self.radio.tx(bytes([STREAM_ACK, s.wire_conn(), n >> 8, n & 0xff, w]),
+                      s.peer, flush=False)
+        s.adv_window = w
+        s.ack_due = False
+
+    def service(self):
+        # Handle what has come in, and keep streams moving
+        radio = self.radio
+        radio.service()
+        now = millis()
+        for key, s in list(self.streams.items()):
+            self.check_tx_status(s, now)
+            self.check_timers(s, now)
+            if s.state != CONNECTING:
+                self.pump(s, now)
+            if s.ack_due:
+                self.send_ack(s)
+            if s.state == CLOSED and s.peer_fin:
+                del self.streams[key]
+        radio.flush_tx()
@@ -0,0 +1,114 @@
+"""Tests for the 16-bit address cache, alone and in XBRadio"""
+
+import unittest
+from pyb import SPI, delay
+from address_cache import AddressCache, UNKNOWN16, BROADCAST64
+from test_XBRadio import create_test_radio
+
+def address(i):
+    return b'\x00\x13\xa2\x00\x41\x00\x00' + bytes([i])
+
+
+class AddressCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = AddressCache(capacity=3)
+
+    def testLearnAndLookup(self):
+        c = self.c
+        self.assertEqual(c.lookup(address(1)), UNKNOWN16)
+        c.learn(bytearray(address(1)), 0x1234)
+        self.assertIn(address(1), c)
+        self.assertEqual(c.lookup(memoryview(address(1))), 0x1234)
+        c.learn(address(1), 0x4321)         # rejoined with a new one
+        self.assertEqual(c.lookup(address(1)), 0x4321)
+        self.assertEqual((c.hits, c.misses, c.learned), (2, 1, 2))
+
+    def testStrAddress(self):
+        # tx() accepts a str address, sent as its ASCII bytes
+        c = self.c
+        a = '\x00\x13\x7a\x00\x41\x00\x00\x07'
+        b = b'\x00\x13\x7a\x00\x41\x00\x00\x07'
+        c.learn(a, 0x1234)
+        self.assertIn(b, c)
+        self.assertEqual(c.lookup(b), 0x1234)
+        c.learn(bytearray(b), 0x4321)
+        self.assertEqual(c.lookup(a), 0x4321)
+        self.assertEqual(len(c), 1)
+
+    def testIgnored(self):
+        c = self.c
+        c.learn(address(1), UNKNOWN16)
+        c.learn(BROADCAST64, 0x0001)
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.lookup(BROADCAST64), UNKNOWN16)
+
+    def testLRU(self):
+        c = self.c
+        for i in range(3):
+            c.learn(address(i), 0x100 + i)
+        c.lookup(address(0))                # 1 is now the least recently used
+        c.learn(address(3), 0x103)
+        self.assertEqual(len(c), 3)
+        self.assertNotIn(address(1), c)
+        self.assertIn(address(0), c)
+        self.assertEqual(c.evictions, 1)
+
+    def testInvalidate(self):
+        c = self.c
+        c.learn(address(1), 0x1234)
+        c.invalidate(address(1))
+        c.invalidate(address(2))
+        self.assertEqual(c.lookup(address(1)), UNKNOWN16)
+        self.assertEqual(c.invalidations, 1)
+
+
+class RadioAddressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gse = create_test_radio('gse')
+        self.flight = create_test_radio('flight')
+        self.flight_sim = SPI._devices[2]
+
+    def testLearnedFromTransmitStatus(self):
+        gse = self.gse
+        r = gse.wait_tx(gse.tx(b'one', self.flight.address))
+        self.assertEqual(r.discovery, 0x02)     # had to find the route
+        self.assertEqual(gse.addresses.lookup(self.flight.address),
+                         int.from_bytes(self.flight_sim.my16, 'big'))
+        r = gse.wait_tx(gse.tx(b'two', self.flight.address))
+        self.assertTrue(r.ok())
+        self.assertEqual(r.discovery, 0x00)     # didn't
+        self.assertEqual(gse.stats()['addresses']['hits'], 2)
+
+    def testLearnedFromRx(self):
+        gse, flight = self.gse, self.flight
+        flight.tx(b'hello', gse.address)
+        delay(10)
+        self.assertEqual(gse.rx(), (bytes(flight.address), b'hello'))
+        self.assertIn(flight.address, gse.addresses)
+        r = gse.wait_tx(gse.tx(b'reply', flight.address))
+        self.assertEqual((r.status, r.discovery), (0, 0))
+
+    def testInvalidatedOnFailure(self):
+        gse = self.gse
+        gse.wait_tx(gse.tx(b'one', self.flight.address))
+        self.flight_sim.my16 = b'\x12\x34'      # it rejoined
+        r = gse.wait_tx(gse.tx(b'two', self.flight.address))
+        self.assertFalse(r.ok())
+        self.assertNotIn(self.flight.address, gse.addresses)
+        r = gse.wait_tx(gse.tx(b'three', self.flight.address))
+        self.assertTrue(r.ok())
+        self.assertEqual(gse.addresses.lookup(self.flight.address), 0x1234)
+
+    def testDisabled(self):
+        xb = create_test_radio('gse', address_cache=0)
+        self.assertIsNone(xb.addresses)
+        xb.wait_tx(xb.tx(b'one', self.flight.address))
+        r = xb.wait_tx(xb.tx(b'two', self.flight.address))
+        self.assertEqual(r.discovery, 0x02)
+        self.assertIsNone(xb.stats()['addresses'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from axbradio import AsyncXBRadio, asyncio
+from xbradio import ATCommandError, PacketWaitTimeout
+from test_XBRadio import create_test_radio
+
+NOWHERE = b'\x00\x13\xa2\x00\x00\x00\x00\x01'
+
+
+class AsyncXBRadioTestCase(unittest.TestCase):
+
+    def run_async(self, coro_fn, **kw):
+        async def main():
+            a = AsyncXBRadio(create_test_radio('gse', **kw))
+            a.start()
+            try:
+                return await coro_fn(a)
+            finally:
+                a.stop()
+        return asyncio.run(main())
+
+    def testSendRecv(self):
+        async def t(a):
+            r = await a.send(b'foo', a.radio.address)
+            self.assertTrue(r.ok())
+            return await a.recv(timeout=100)
+        self.assertEqual(self.run_async(t)[1], b'foo')
+
+    def testSendFails(self):
+        async def t(a):
+            return await a.send(b'foo', NOWHERE)
+        self.assertEqual(self.run_async(t).status, 0x21)
+
+    def testAT(self):
+        async def t(a):
+            return await a.at('TP'), await a.at('NI'), await a.at('SH')
+        tp, ni, sh = self.run_async(t)
+        self.assertEqual(tp, 25)
+        self.assertEqual(ni, 'gse')
+        self.assertEqual(sh, b'\x00\x13\xa2\x00')
+
+    def testATCache(self):
+        # The same reply handling, and values cache, as XBRadio.at()
+        async def t(a):
+            tp = await a.at('TP')
+            cached = a.radio.values.get('TP')
+            return tp, cached, await a.at('NI', 'pump-7'), 'NI' in a.radio.values
+        self.assertEqual(self.run_async(t), (25, 25, None, False))
+
+    def testATError(self):
+        async def t(a):
+            with self.assertRaises(ATCommandError):
+                await a.at('ZZ')
+        self.run_async(t)
+
+    def testRecvTimeout(self):
+        async def t(a):
+            with self.assertRaises(PacketWaitTimeout):
+                await a.recv(timeout=10)
+        self.run_async(t)
+
+    def testConcurrent(self):
+        # Several senders and a receiver sharing one reader task
+        async def t(a):
+            sends = [a.send(bytes([i]), a.radio.address) for i in range(4)]
+            results = await asyncio.gather(*sends)
+            got = [(await a.recv(timeout=100))[1] for i in range(4)]
+            return results, got
+        results, got = self.run_async(t)
+        self.assertTrue(all(r.ok() for r in results))
+        self.assertEqual(sorted(got), [bytes([i]) for i in range(4)])
+
+    def testIrq(self):
+        async def t(a):
+            a.radio.enable_irq_rx()
+            await a.send(b'foo', a.radio.address)
+            return await a.recv(timeout=100)
+        self.assertEqual(self.run_async(t)[1], b'foo')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tests for SPI clock calibration, against the virtual XBee's clock limit"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from pyb import SPI
+from xbradio import saved_prescaler, save_prescaler, DEFAULT_PRESCALER, SAVED
+from calibrate import calibrate, stress
+from test_XBRadio import create_test_radio
+
+
+class CalibrateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'xbspi.cfg')
+        self.sim = SPI._devices[1]
+        self.xb = create_test_radio('gse', prescaler=256)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testStress(self):
+        r = stress(self.xb, frames=100)
+        self.assertTrue(r['clean'])
+        self.assertEqual(r['received'], 100)
+        self.xb.xcvr.set_prescaler(16)
+        r = stress(self.xb, frames=100)
+        self.assertFalse(r['clean'])
+        self.assertGreater(r['checksum_errors'] + r['AT_failures'] + r['rx_errors'], 0)
+
+    def testCalibrate(self):
+        self.sim.stable_prescaler = 32
+        report = calibrate(self.xb, frames=100, path=self.path)
+        self.assertEqual(report['fastest'], 32)
+        self.assertEqual(report['prescaler'], 64)   # one step of margin
+        self.assertEqual([r['prescaler'] for r in report['results']],
+                         [256, 128, 64, 32, 16])
+        self.assertFalse(report['results'][-1]['clean'])
+        self.assertEqual(self.xb.xcvr.prescaler, 64)
+        self.assertEqual(saved_prescaler(self.path), 64)
+        # and the radio still works
+        self.assertEqual(self.xb.at('TP'), 25)
+        self.assertEqual(self.xb.tx_tracker.outstanding, 0)
+
+    def testNoMargin(self):
+        report = calibrate(self.xb, prescalers=(128, 64, 32), frames=100,
+                           margin=0, path=None)
+        self.assertEqual(report['prescaler'], 64)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testMarginCappedAtSlowest(self):
+        report = calibrate(self.xb, prescalers=(64, 32), frames=100, margin=2,
+                           path=None)
+        self.assertEqual(report['prescaler'], 64)
+
+    def testNothingClean(self):
+        self.sim.stable_prescaler = 1024
+        report = calibrate(self.xb, prescalers=(256, 128), frames=100, path=self.path)
+        self.assertIsNone(report['prescaler'])
+        self.assertIsNone(report['fastest'])
+        self.assertEqual(len(report['results']), 1)
+        self.assertEqual(self.xb.xcvr.prescaler, 256)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testSavedPrescaler(self):
+        self.assertEqual(saved_prescaler(self.path), DEFAULT_PRESCALER)
+        with open(self.path, 'w') as f:
+            f.write('fast\n')
+        self.assertEqual(saved_prescaler(self.path), DEFAULT_PRESCALER)
+        save_prescaler(32, self.path)
+        self.assertEqual(saved_prescaler(self.path), 32)
+        xb = create_test_radio('flight', prescaler=saved_prescaler(self.path))
+        self.assertEqual(xb.xcvr.spi.prescaler, 32)
+
+    def testSavedOnlyWhenAsked(self):
+        # The file in the current directory is read for prescaler=SAVED
+        # and otherwise left alone
+        save_prescaler(32, self.path)
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            self.assertEqual(create_test_radio('flight').xcvr.prescaler,
+                             DEFAULT_PRESCALER)
+            self.assertEqual(create_test_radio('flight', prescaler=SAVED).xcvr.prescaler,
+                             32)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
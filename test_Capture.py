@@ -0,0 +1,113 @@
+"""Tests for SPI capture (spi_capture.py) and replay (sim/replay.py)"""
+
+import io
+import unittest
+import pyb
+from pyb import SPI, Pin
+from xbradio import XBRadio
+from packet_buffer import PacketBuffer, RingPacketBuffer
+from spi_capture import CaptureSPI, read_capture, replay_into, HEADER, RECV, \
+    XFER, ATTN
+from replay import ReplayXBee
+
+
+def radio(spi):
+    return XBRadio(spi=spi, nRESET=Pin('Y11'), DOUT=Pin('Y12'),
+                   nSSEL=Pin('X5'), nATTN=Pin('Y10'))
+
+def session(xb):
+    # Things to do, the same way, when capturing and when replaying
+    tp = xb.at('TP')
+    xb.tx(b'hello', xb.address)
+    got = xb.rx(timeout=100)
+    ni = xb.at('NI')
+    return tp, got, ni
+
+
+class FakeSPI(object):
+    # Reads come from a script
+    def __init__(self, script):
+        self.script = script
+    def recv(self, recv, timeout=5000):
+        n = recv if isinstance(recv, int) else len(recv)
+        b, self.script = self.script[:n], self.script[n:]
+        return b + b'\xff' * (n - len(b))
+
+
+class CaptureTestCase(unittest.TestCase):
+
+    def capture(self):
+        log = io.BytesIO()
+        xb = radio(CaptureSPI(SPI(1), log, Pin('Y10')))
+        result = session(xb)
+        return log.getvalue(), result, xb
+
+    def testRecords(self):
+        log, result, xb = self.capture()
+        self.assertTrue(log.startswith(HEADER))
+        kinds = [k for k, t, p in read_capture(io.BytesIO(log))]
+        self.assertIn(RECV, kinds)
+        self.assertIn(XFER, kinds)
+        self.assertIn(ATTN, kinds)
+        spi = xb.xcvr.spi
+        self.assertEqual(spi.records, len(kinds))
+        self.assertEqual(spi.bytes_logged, len(log) - len(HEADER))
+        self.assertEqual(spi.transactions, spi.spi.transactions) # passed through
+
+    def testReplayIntoPacketBuffer(self):
+        log, result, xb = self.capture()
+        for pb in (PacketBuffer(), RingPacketBuffer(1024)):
+            report = replay_into(pb, io.BytesIO(log))
+            self.assertEqual(len(report['frames']), xb.frames_processed)
+            self.assertEqual(report['checksum_errors'], 0)
+            self.assertIn(b'\x88\x04TP\x00\x00\x19', report['frames'])
+
+    def testReplayAtOriginalTiming(self):
+        log, result, xb = self.capture()
+        last = max(t for k, t, p in read_capture(io.BytesIO(log)))
+        report = replay_into(PacketBuffer(), io.BytesIO(log), timing=True)
+        self.assertGreaterEqual(report['ms'], last)
+
+    def testReplayIntoXBRadio(self):
+        log, result, xb = self.capture()
+        pyb.reset()
+        rp = ReplayXBee(1, 'Y10', io.BytesIO(log))
+        xb2 = radio(SPI(1))
+        self.assertEqual(xb2.address, xb.address)
+        self.assertEqual(session(xb2), result)
+        self.assertTrue(rp.done())
+        self.assertEqual(rp.mismatches, 0)
+
+    def testIncident(self):
+        # A marking-byte storm and a bad frame, captured and replayed
+        script = b'\xff' * 200 + b'~\x00\x02\x8a\x01u' + b'~\x00\x02\x8a\x00u'
+        log = io.BytesIO()
+        spi = CaptureSPI(FakeSPI(script), log)
+        for i in range(0, len(script), 16):
+            spi.recv(16)
+        report = replay_into(PacketBuffer(), io.BytesIO(log.getvalue()))
+        self.assertEqual(report['frames'], [b'\x8a\x00'])
+        self.assertEqual(report['checksum_errors'], 1)
+        self.assertEqual(report['marking_bytes'], 200 + 12) # and the padding
+
+    def testHALCapture(self):
+        xb = radio(SPI(1))
+        log = io.BytesIO()
+        xb.xcvr.start_capture(log)
+        xb.at('TP')
+        xb.xcvr.stop_capture()
+        self.assertIsInstance(xb.xcvr.spi, SPI)
+        n = len(log.getvalue())
+        xb.at('TP')
+        self.assertEqual(len(log.getvalue()), n)
+        kinds = [k for k, t, p in read_capture(io.BytesIO(log.getvalue()))]
+        self.assertEqual(kinds.count(XFER), 1)
+        self.assertEqual(kinds.count(RECV), 2)
+
+    def testNotACapture(self):
+        with self.assertRaises(ValueError):
+            list(read_capture(io.BytesIO(b'garbage')))
+
+
+if __name__ == '__main__':
+    unittest.main()
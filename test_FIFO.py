@@ -0,0 +1,58 @@
+import unittest
+from fifo import BoundedFIFO, DROP_OLDEST, DROP_NEWEST, BACKPRESSURE
+
+
+class BoundedFIFOTestCase(unittest.TestCase):
+
+    def testOrder(self):
+        q = BoundedFIFO(4)
+        for v in 'abc':
+            q.put(v)
+        self.assertEqual(list(q), ['a', 'b', 'c'])
+        self.assertEqual(q.get(), 'a')
+        q.put('d')
+        q.put('e')
+        self.assertEqual([q.get() for i in range(4)], ['b', 'c', 'd', 'e'])
+        with self.assertRaises(IndexError):
+            q.get()
+
+    def testDropOldest(self):
+        q = BoundedFIFO(2, DROP_OLDEST)
+        self.assertTrue(q.put(1))
+        self.assertTrue(q.put(2))
+        self.assertFalse(q.put(3))
+        self.assertEqual(list(q), [2, 3])
+        self.assertEqual(q.dropped, 1)
+
+    def testDropNewest(self):
+        q = BoundedFIFO(2, DROP_NEWEST)
+        q.put(1)
+        q.put(2)
+        self.assertFalse(q.put(3))
+        self.assertEqual(list(q), [1, 2])
+        self.assertEqual(q.dropped, 1)
+
+    def testBackpressure(self):
+        q = BoundedFIFO(2, BACKPRESSURE)
+        q.put(1)
+        self.assertFalse(q.full())
+        q.put(2)
+        self.assertTrue(q.full())
+        self.assertFalse(q.put(3))
+        self.assertEqual(list(q), [1, 2])
+
+    def testHighWater(self):
+        q = BoundedFIFO(8)
+        for i in range(5):
+            q.put(i)
+        for i in range(5):
+            q.get()
+        q.put(9)
+        self.assertEqual(q.high_water, 5)
+        q.reset_counters()
+        self.assertEqual(q.high_water, 1)
+        self.assertEqual(q.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import unittest
+from fragment import FragTransport, FRAGMENT, HEADER_LEN
+from xbradio import PacketWaitTimeout
+from test_XBRadio import create_test_radio
+from pyb import SPI, millis, elapsed_millis
+
+NOWHERE = b'\x00\x13\xa2\x00\x00\x00\x00\x01'
+
+def blob(n):
+    return bytes((i * 7 + (i >> 8)) & 0xff for i in range(n))
+
+
+class FragmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FragTransport(create_test_radio('gse'))
+        self.b = FragTransport(create_test_radio('flight'))
+
+    def run_until(self, cond, timeout=5000):
+        t0 = millis()
+        while not cond():
+            self.assertLess(elapsed_millis(t0), timeout)
+            self.a.service()
+            self.b.service()
+
+    def testMTU(self):
+        self.assertEqual(self.a.mtu, 256)
+        self.assertEqual(self.a.max_chunk, 256 - HEADER_LEN)
+
+    def testLoopback(self):
+        a = self.a
+        data = blob(3000)
+        s = a.send(a.radio.address, data)
+        self.assertEqual(s.count, 13)
+        self.assertEqual(s.retransmits, 0)
+        a.service()
+        self.assertEqual(a.recv(), (a.radio.address, data))
+        self.assertRaises(IndexError, a.recv)
+
+    def testSmallMessage(self):
+        a, b = self.a, self.b
+        s = a.start_send(b.radio.address, 'hi')
+        self.assertEqual(s.count, 1)
+        self.run_until(lambda: s.done)
+        self.assertEqual(b.recv(), (a.radio.address, b'hi'))
+
+    def testEmptyMessage(self):
+        a, b = self.a, self.b
+        s = a.start_send(b.radio.address, b'')
+        self.run_until(lambda: s.done)
+        self.assertEqual(b.recv(), (a.radio.address, b''))
+
+    def testWindowed(self):
+        # More than a window's worth goes out before any ack comes back
+        a, b = self.a, self.b
+        data = blob(8000)
+        s = a.start_send(b.radio.address, data)
+        self.assertEqual(s.next_new, a.window)
+        self.run_until(lambda: s.done)
+        self.assertEqual(b.recv()[1], data)
+        self.assertEqual(a.fragments_sent, s.count)
+        self.assertLess(b.acks_sent, s.count)
+
+    def testLossyLink(self):
+        a, b = self.a, self.b
+        air = SPI._devices[1].air
+        air.loss = 0.6
+        data = blob(8000)
+        s = a.start_send(b.radio.address, data)
+        self.run_until(lambda: s.done, 20000)
+        air.loss = 0.0
+        self.run_until(lambda: len(b.messages))
+        self.assertEqual(b.recv()[1], data)
+        self.assertGreater(s.retransmits, 0)
+
+    def testTwoAtOnce(self):
+        a, b = self.a, self.b
+        s1 = a.start_send(b.radio.address, blob(2000))
+        s2 = a.start_send(b.radio.address, blob(1500))
+        self.run_until(lambda: s1.done and s2.done)
+        got = sorted(len(b.recv()[1]) for i in range(2))
+        self.assertEqual(got, [1500, 2000])
+
+    def testSendTimeout(self):
+        a = self.a
+        self.assertRaises(PacketWaitTimeout, a.send, NOWHERE, blob(1000), 300)
+        self.assertEqual(a.senders, [])
+
+    def testTooBig(self):
+        a = self.a
+        self.assertRaises(ValueError, a.start_send, NOWHERE, bytes(1 << 20))
+
+    def testReassemblyCap(self):
+        # A message bigger than the cap is refused; partials past the cap
+        # push out the oldest
+        a, b = self.a, self.b
+        b.max_reassembly = 2000
+        src = a.radio.address
+        def frag(msg_id, total):
+            return bytes([FRAGMENT, 0, msg_id, 0, 0, 0, 4,
+                          0, total >> 8, total & 0xff]) + bytes(10)
+        b.handle_fragment(src, frag(1, 3000))
+        self.assertEqual(b.rejected, 1)
+        b.handle_fragment(src, frag(2, 1200))
+        b.handle_fragment(src, frag(3, 1200))
+        self.assertEqual(b.evicted, 1)
+        self.assertEqual(list(b.partials), [(src, 0, 3)])
+        self.assertEqual(b.reassembly_bytes, 1200)
+
+    def testMalformedFragments(self):
+        # Fragments that don't fit the message they claim are dropped
+        b = self.b
+        src = self.a.radio.address
+        def frag(msg_id, i, count, total, n):
+            return bytes([FRAGMENT, 0, msg_id, i >> 8, i & 0xff, count >> 8, count & 0xff,
+                          0, total >> 8, total & 0xff]) + bytes(n)
+        b.handle_fragment(src, frag(1, 4, 4, 40, 10))     # index past count
+        b.handle_fragment(src, frag(1, 0, 0, 40, 10))     # no fragments
+        b.handle_fragment(src, frag(1, 3, 4, 40, 20))     # runs off the end
+        self.assertEqual(b.malformed, 3)
+        self.assertEqual(b.partials, {})
+        b.handle_fragment(src, frag(1, 0, 4, 40, 10))
+        b.handle_fragment(src, frag(1, 5, 4, 40, 10))     # index past count
+        b.handle_fragment(src, frag(1, 3, 4, 40, 11))     # runs off the end
+        self.assertEqual(b.malformed, 5)
+        p = b.partials[(src, 0, 1)]
+        self.assertEqual((p.got, len(p.buf)), (1, 40))
+
+    def testStaleFragments(self):
+        # A fragment of an earlier message that used the same ID doesn't
+        # get mixed into the one being reassembled
+        b = self.b
+        src = self.a.radio.address
+        def frag(i, count, total, fill):
+            n = (total + count - 1) // count
+            return bytes([FRAGMENT, 0, 7, 0, i, 0, count, 0, 0, total]) \
+                + bytes([fill]) * min(n, total - i * n)
+        b.handle_fragment(src, frag(0, 2, 20, 1))
+        b.handle_fragment(src, frag(2, 3, 90, 2))         # different count
+        b.handle_fragment(src, frag(1, 2, 30, 2))         # different total
+        self.assertEqual(b.malformed, 2)
+        self.assertEqual(len(b.messages), 0)
+        b.handle_fragment(src, frag(1, 2, 20, 1))
+        self.assertEqual(b.recv()[1], bytes([1]) * 20)
+
+    def testSenderRestart(self):
+        # A sender that restarts numbers its messages from 1 again; they
+        # aren't taken for the ones its last run sent
+        a, b = self.a, self.b
+        s = a.start_send(b.radio.address, b'first run')
+        self.run_until(lambda: s.done)
+        self.assertEqual(b.recv()[1], b'first run')
+        a.close()
+        a = self.a = FragTransport(a.radio)
+        a.session = (s.session + 1) & 0xff     # random, so 255 times in 256
+        s = a.start_send(b.radio.address, b'again run')
+        self.assertEqual(s.msg_id, 1)
+        self.run_until(lambda: s.done)
+        self.assertEqual(b.recv()[1], b'again run')
+
+    def testStaleAck(self):
+        # An ack for the last run's message of the same ID is ignored
+        a, b = self.a, self.b
+        s = a.start_send(NOWHERE, blob(600))
+        a.handle_ack(NOWHERE, bytes([0xF1, (a.session + 1) & 0xff, s.msg_id, 0, s.count, 0xff]))
+        self.assertFalse(s.done)
+        a.handle_ack(NOWHERE, bytes([0xF1, a.session, s.msg_id, 0, s.count, 0xff]))
+        self.assertTrue(s.done)
+
+    def testOtherTrafficKept(self):
+        a, b = self.a, self.b
+        a.radio.tx(b'plain', b.radio.address)
+        self.run_until(lambda: len(b.radio.received_data_packets))
+        self.assertEqual(b.radio.rx(), (a.radio.address, b'plain'))
+
+
+class IrqFragmentTestCase(FragmentTestCase):
+    # The same again, with the handlers (and their acks) run in the
+    # nATTN drain, and a transmit window that fills
+
+    def setUp(self):
+        self.a = FragTransport(create_test_radio('gse', tx_window=2))
+        self.b = FragTransport(create_test_radio('flight', tx_window=2))
+        self.a.radio.enable_irq_rx()
+        self.b.radio.enable_irq_rx()
+
+
+if __name__ == '__main__':
+    unittest.main()
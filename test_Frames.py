@@ -0,0 +1,79 @@
+import unittest
+from frames import decode, Frame, ATResponse, ModemStatus, TransmitStatus, \
+    RxIndicator, ExplicitRxIndicator, NodeIdentification, RemoteATResponse
+
+SRC = b'\x00\x13\xa2\x00\x40\xa1\xb2\xc3'
+REMOTE = b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6'
+
+
+class FramesTestCase(unittest.TestCase):
+
+    def testATResponse(self):
+        f = decode(b'\x88\x05TP\x00\x00\x19')
+        self.assertIsInstance(f, ATResponse)
+        self.assertEqual((f.frame_id, f.command, f.status), (5, 'TP', 0))
+        self.assertEqual(bytes(f.data), b'\x00\x19')
+        self.assertEqual(f.describe(), "id 0x5 TP OK 0 19")
+
+    def testModemStatus(self):
+        f = decode(b'\x8a\x0b')
+        self.assertIsInstance(f, ModemStatus)
+        self.assertEqual(f.status, 0x0b)
+        self.assertEqual(f.describe(), "Network Woke Up")
+        self.assertEqual(decode(b'\x8a\x33').describe(), "0x33")
+
+    def testTransmitStatus(self):
+        f = decode(b'\x8b\x07\x12\x34\x02\x21\x00')
+        self.assertIsInstance(f, TransmitStatus)
+        self.assertEqual((f.frame_id, f.dest16, f.retries, f.delivery_status,
+                          f.discovery_status), (7, 0x1234, 2, 0x21, 0))
+        self.assertEqual(f.describe(), "id 0x7, 2 retries, Network ACK Failure, "
+                         "No Discovery Overhead")
+
+    def testRxIndicator(self):
+        f = decode(b'\x90' + SRC + b'\xff\xfe\x01hello')
+        self.assertIsInstance(f, RxIndicator)
+        self.assertEqual(bytes(f.source64), SRC)
+        self.assertEqual(f.source16, 0xfffe)
+        self.assertEqual(f.options, 1)
+        self.assertEqual(bytes(f.data), b'hello')
+
+    def testExplicitRx(self):
+        f = decode(b'\x91' + SRC + b'\xff\xfe\xe8\xe9\x00\x11\xc1\x05\x01hi')
+        self.assertIsInstance(f, ExplicitRxIndicator)
+        self.assertEqual((f.source_endpoint, f.dest_endpoint, f.cluster_id,
+                          f.profile_id, f.options), (0xe8, 0xe9, 0x11, 0xc105, 1))
+        self.assertEqual(bytes(f.data), b'hi')
+
+    def testNodeIdentification(self):
+        f = decode(b'\x95' + SRC + b'\xff\xfe\x02\xff\xfe' + REMOTE + b'flight\x00'
+                   + b'\xff\xfe\x01\x01\xc1\x05\x10\x1e')
+        self.assertIsInstance(f, NodeIdentification)
+        self.assertEqual(bytes(f.remote64), REMOTE)
+        self.assertEqual(f.remote16, 0xfffe)
+        self.assertEqual(f.ni, 'flight')
+        self.assertEqual((f.parent16, f.device_type, f.source_event),
+                         (0xfffe, 1, 1))
+        self.assertEqual((f.profile_id, f.manufacturer_id), (0xc105, 0x101e))
+
+    def testRemoteATResponse(self):
+        f = decode(b'\x97\x09' + REMOTE + b'\xff\xfeNI\x00flight')
+        self.assertIsInstance(f, RemoteATResponse)
+        self.assertEqual((f.frame_id, f.command, f.status), (9, 'NI', 0))
+        self.assertEqual(bytes(f.source64), REMOTE)
+        self.assertEqual(bytes(f.data), b'flight')
+
+    def testViewNotCopy(self):
+        buf = bytearray(b'\x90' + SRC + b'\xff\xfe\x01hello')
+        f = decode(memoryview(buf))
+        buf[12] = ord('j')
+        self.assertEqual(bytes(f.data), b'jello')
+
+    def testUnknown(self):
+        f = decode(b'\x42\x01\x02')
+        self.assertIs(type(f), Frame)
+        self.assertEqual(f.frame_type, 0x42)
+
+
+if __name__ == '__main__':
+    unittest.main()
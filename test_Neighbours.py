@@ -0,0 +1,148 @@
+"""Tests for node discovery and the neighbour table"""
+
+import unittest
+from pyb import SPI, delay
+from neighbours import Neighbour, NeighbourTable, parse_ND
+from test_XBRadio import create_test_radio
+import xbee_sim
+
+FLIGHT = b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6'
+
+def field_address(i):
+    return b'\x00\x13\xa2\x00\x41\x00\x00' + bytes([i])
+
+ND_PUMP = b'\x12\x34' + field_address(7) + b'pump-7\x00' \
+    + b'\xff\xfe\x01\x00\xc1\x05\x10\x1e'
+
+
+class NeighbourTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.t = NeighbourTable(max_age=1000, capacity=3)
+
+    def testParseND(self):
+        n = parse_ND(ND_PUMP, 5)
+        self.assertEqual(n.address, field_address(7))
+        self.assertEqual(n.address16, 0x1234)
+        self.assertEqual(n.ni, 'pump-7')
+        self.assertEqual((n.parent16, n.device_type, n.status), (0xfffe, 1, 0))
+        self.assertEqual((n.profile_id, n.manufacturer_id), (0xc105, 0x101e))
+        self.assertIsNone(n.rssi)
+        self.assertEqual(n.last_seen, 5)
+        self.assertEqual(parse_ND(ND_PUMP + b'\x28').rssi, 0x28)
+        self.assertEqual(parse_ND(ND_PUMP + b'\x00\x0b\x00\x00\x2c').rssi, 0x2c)
+        self.assertIsNone(parse_ND(ND_PUMP + b'\x00\x0b\x00\x00').rssi)
+
+    def testParseNDMalformed(self):
+        self.assertIsNone(parse_ND(ND_PUMP[:8]))           # cut off in SL
+        self.assertIsNone(parse_ND(ND_PUMP[:16]))          # NI unterminated
+        self.assertIsNone(parse_ND(ND_PUMP[:-1]))          # a field short
+        self.assertIsNone(parse_ND(ND_PUMP[:10] + b'p\xffmp\x00' + ND_PUMP[17:]))
+        self.assertIsNone(parse_ND(b''))
+
+    def testResolve(self):
+        t = self.t
+        t.update(Neighbour(field_address(1), 1, 'a', rssi=40, last_seen=0))
+        self.assertEqual(t.resolve('a', now=10), field_address(1))
+        self.assertRaises(KeyError, t.resolve, 'b', 10)
+        self.assertIs(t.get_by_address(bytearray(field_address(1)), now=10).ni, 'a')
+
+    def testRenameAndSwap(self):
+        t = self.t
+        t.update(Neighbour(field_address(1), 1, 'a', rssi=40))
+        t.update(Neighbour(field_address(1), 1, 'b'))       # renamed
+        self.assertRaises(KeyError, t.resolve, 'a', 0)
+        self.assertEqual(t.get('b', 0).rssi, 40)            # kept
+        t.update(Neighbour(field_address(2), 2, 'b'))       # swapped in
+        self.assertEqual(t.resolve('b', 0), field_address(2))
+        self.assertEqual(len(t), 2)
+
+    def testAging(self):
+        t = self.t
+        t.update(Neighbour(field_address(1), 1, 'a', last_seen=0))
+        t.update(Neighbour(field_address(2), 2, 'b', last_seen=0))
+        t.seen(field_address(2), 800)
+        self.assertEqual(t.resolve('a', 1000), field_address(1))
+        self.assertRaises(KeyError, t.resolve, 'a', 1001)
+        t.expire(1500)
+        self.assertEqual([n.ni for n in t], ['b'])
+        self.assertEqual(t.aged_out, 1)
+
+    def testCapacity(self):
+        t = self.t
+        for i in range(4):
+            t.update(Neighbour(field_address(i), i, 'n%d' % i, last_seen=10 - i))
+        self.assertEqual(len(t), 3)
+        self.assertRaises(KeyError, t.resolve, 'n2', 10)   # heard from longest ago
+        self.assertEqual(t.resolve('n3', 10), field_address(3))
+        self.assertEqual(t.evictions, 1)
+
+
+class DiscoveryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+        self.air = SPI._devices[1].air
+        self.nodes = [xbee_sim.node(self.air, field_address(i), ni='pump-%d' % i)
+                      for i in range(10)]
+        self.xb.at('NT', 2)     # 200ms, to keep the tests quick
+
+    def testDiscover(self):
+        xb = self.xb
+        found = xb.discover()
+        self.assertEqual(sorted(n.ni for n in found),
+                         sorted(['flight'] + ['pump-%d' % i for i in range(10)]))
+        self.assertEqual(len(xb.neighbours), 11)
+        self.assertEqual(xb.resolve('pump-7'), field_address(7))
+        self.assertEqual(xb.resolve('flight'), FLIGHT)
+        self.assertRaises(KeyError, xb.resolve, 'pump-70')
+        # The 16-bit address came with it: no route discovery needed
+        r = xb.wait_tx(xb.tx(b'on', xb.resolve('pump-7')))
+        self.assertEqual((r.status, r.discovery), (0, 0))
+
+    def testRSSI(self):
+        xb = self.xb
+        xb.at('NO', 4)
+        self.nodes[3].params['DB'] = b'\x4a'
+        xb.discover()
+        self.assertEqual(xb.neighbours.get('pump-3').rssi, 0x4a)
+        self.assertEqual(xb.neighbours.get('flight').rssi, 0x28)
+
+    def testMalformedReply(self):
+        # A garbled reply is counted and skipped; the others still count
+        xb = self.xb
+        self.nodes[5].ND_data = lambda rssi=False: b'\x12\x34' + field_address(5) + b'pump-5'
+        found = xb.discover()
+        self.assertEqual(len(found), 10)
+        self.assertNotIn('pump-5', [n.ni for n in found])
+        self.assertEqual(xb.stats()['ND_malformed'], 1)
+
+    def testAgeOut(self):
+        xb = self.xb
+        xb.neighbours.max_age = 1000
+        xb.discover()
+        delay(600)
+        SPI._devices[2].identify()      # flight is heard from again
+        delay(5)
+        xb.rx_available()
+        delay(600)
+        self.assertRaises(KeyError, xb.resolve, 'pump-1')
+        self.assertEqual(xb.resolve('flight'), FLIGHT)
+
+    def testNodeIdentification(self):
+        xb = self.xb
+        self.nodes[4].identify()
+        delay(5)
+        xb.rx_available()
+        self.assertEqual(xb.resolve('pump-4'), field_address(4))
+        self.assertEqual(xb.stats()['frames'][0x95], 1)
+        # A replacement pump-4 is commissioned
+        new = xbee_sim.node(self.air, field_address(99), ni='pump-4')
+        new.identify()
+        delay(5)
+        xb.rx_available()
+        self.assertEqual(xb.resolve('pump-4'), field_address(99))
+
+
+if __name__ == '__main__':
+    unittest.main()
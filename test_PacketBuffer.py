@@ -1,5 +1,6 @@
 import unittest
-from xbradio import PacketBuffer, ChecksumError
+from packet_buffer import PacketBuffer, RingPacketBuffer, ChecksumError, \
+    FrameTooLongError
 
 class TimedOutError(Exception):
     pass
@@ -86,6 +87,32 @@ class PacketBufferTestCase(unittest.TestCase):
         with self.assertRaises(ChecksumError):
             self.pb.include_bytes(b'foobar~\x00\x02\x8a\x01u\xff\xff\xff\xff\xff\xff')
 
+    def testReadinto(self):
+        rx = b'\xff\xff~\x00\x02\x8a\x00u\xff'
+        def recv(buf):
+            n = len(buf)
+            buf[:] = rx[self.pos:self.pos + n]
+            self.pos += n
+        self.pos = 0
+        self.assertEqual(self.pb.readinto(recv, 4), 4)
+        self.assertEqual(len(self.pb), 0)
+        self.assertTrue(self.pb.in_a_packet())
+        self.assertEqual(self.pb.readinto(recv, 5), 5)
+        self.assertEqual(bytes(self.pb.dequeue_one()), b'\x8a\x00')
+
+    def testParseRest(self):
+        # Good frames after bad ones come out without more input
+        bad = b'~\x00\x02\x8a\x01u'
+        good = b'~\x00\x02\x8a\x00u'
+        with self.assertRaises(ChecksumError):
+            self.pb.include_bytes(bad + good + bad + good + b'\xff')
+        self.assertEqual(self.pb.parse_rest(), 1)
+        self.assertEqual(self.pb.parse_rest(), 0)
+        self.assertEqual([bytes(self.pb.dequeue_one()) for i in range(len(self.pb))],
+                         [b'\x8a\x00', b'\x8a\x00'])
+        self.assertFalse(self.pb.in_a_packet())
+        self.assertEqual(self.pb.checksum_errors, 2)
+
     def testInAPacket(self):
         self.assertFalse(self.pb.in_a_packet())
         self.pb.include_bytes(b'some random stuff then ')
@@ -165,11 +192,94 @@ class PacketBufferTestCase(unittest.TestCase):
                          len(b'\x00\x00\x00'))
         self.assertEqual(self.pb.packet_count, 2)
 
+    def testStats(self):
+        pb = self.pb
+        pb.include_bytes(b'\xff\xff~\x00\x02\x8a\x00u~\x00\x02\x8a\x00u')
+        with self.assertRaises(ChecksumError):
+            pb.include_bytes(b'~\x00\x02\x8a\x01u')
+        st = pb.stats()
+        self.assertEqual(st['bytes'], 20)
+        self.assertEqual(st['frames'], 2)
+        self.assertEqual(st['marking_bytes'], 2)
+        self.assertEqual(st['checksum_errors'], 1)
+        self.assertEqual(st['queued'], 2)
+        self.assertEqual(st['high_water'], 2)
+        pb.dequeue_one()
+        pb.reset_stats()
+        st = pb.stats()
+        self.assertEqual((st['bytes'], st['frames'], st['checksum_errors']), (0, 0, 0))
+        self.assertEqual(st['high_water'], 1)
+
     @unittest.skip("Demonstrating the @unittest.skip decorator")
     def testSkipThisOne(self):
         pass
 
 
+class PlainPacketBufferTestCase(unittest.TestCase):
+    # What only PacketBuffer does
+
+    def setUp(self):
+        self.pb = PacketBuffer()
+
+    def testReadintoReusesBuffer(self):
+        pb = self.pb
+        def recv(buf):
+            buf[:] = b'\xff' * len(buf)
+        pb.readinto(recv, 8)
+        rbuf = pb.rbuf
+        for n in (3, 2, 8, 1):
+            pb.readinto(recv, n)
+        self.assertIs(pb.rbuf, rbuf)
+        self.assertEqual(pb.total_marking_bytes_count, 22)
+
+    def testFrameTooLong(self):
+        pb = PacketBuffer(max_length=16)
+        with self.assertRaises(FrameTooLongError):
+            pb.include_bytes(b'~\x00\x11~\x00\x02\x8a\x00u')
+        self.assertEqual(pb.parse_rest(), 0)
+        self.assertEqual(pb.dequeue_one(), b'\x8a\x00')
+        self.assertEqual(pb.stats()['too_long'], 1)
+
+
+class RingPacketBufferTestCase(PacketBufferTestCase):
+    # Everything PacketBuffer does, RingPacketBuffer must do too
+
+    def setUp(self):
+        self.pb = RingPacketBuffer(64)
+
+    def testZeroCopy(self):
+        self.pb.include_bytes(b'~\x00\x05\x88\x03PL\x00\xd8')
+        v = self.pb.dequeue_one()
+        self.assertIsInstance(v, memoryview)
+        self.assertIs(v.obj, self.pb.buf)
+
+    def testWrapAround(self):
+        frame = b'~\x00\x05\x88\x03PL\x00\xd8'
+        for i in range(40):
+            self.pb.include_bytes(b'\xff' * (i % 7) + frame)
+            self.assertEqual(bytes(self.pb.dequeue_one()), b'\x88\x03PL\x00')
+        self.assertEqual(self.pb.packet_count, 40)
+
+    def testViewValidUntilNextDequeue(self):
+        self.pb.include_bytes(b'~\x00\x02\x8a\x00u')
+        v = self.pb.dequeue_one()
+        for i in range(10):
+            self.pb.include_bytes(b'\xff\xff\xff')
+        self.assertEqual(bytes(v), b'\x8a\x00')
+
+    def testParseResumesAfterChecksumError(self):
+        with self.assertRaises(ChecksumError):
+            self.pb.include_bytes(b'~\x00\x02\x8a\x01u~\x00\x02\x8a\x00u')
+        self.pb.include_bytes(b'')
+        self.pb.commit(0)
+        self.assertEqual(bytes(self.pb.dequeue_one()), b'\x8a\x00')
+
+    def testFrameTooLong(self):
+        with self.assertRaises(FrameTooLongError):
+            self.pb.include_bytes(b'~\x01\x00')
+        self.assertFalse(self.pb.in_a_packet())
+
+
 def run_unittest(*classes):
     suite = unittest.TestSuite()
     for c in classes:
@@ -182,7 +292,7 @@ def run_unittest(*classes):
     print(msg)
 
 def main():
-    test_classes = [PacketBufferTestCase]
+    test_classes = [PacketBufferTestCase, RingPacketBufferTestCase]
     run_unittest(*test_classes)
 
 if __name__ == '__main__':
@@ -0,0 +1,184 @@
+"""Differential tests: the parser kernels against plain Python, and
+RingPacketBuffer against PacketBuffer, on random streams. Off the board
+the viper and native kernels' source is run as plain Python, which checks
+its logic if not the code the emitter makes of it."""
+
+import random
+import sys
+import unittest
+import packet_buffer
+import parse_kernel
+from parse_kernel import py_ring_find_sync, py_ring_sum, py_buf_sum, compile_kernel
+from packet_buffer import PacketBuffer, RingPacketBuffer, ChecksumError
+
+
+def frame(payload):
+    n = len(payload)
+    return bytes([0x7e, n >> 8, n & 0xff]) + payload \
+        + bytes([0xff - (sum(payload) & 0xff)])
+
+def noise(rnd, n):
+    return bytes(rnd.choice((0xff, 0x00, rnd.randrange(0x7f, 0x100)))
+                 for _ in range(n))
+
+def stream(rnd, nframes):
+    # Frames with marking bytes between, some with a corrupted payload
+    # or check byte; returns the stream and the frames that are good
+    out = bytearray()
+    for i in range(nframes):
+        out += noise(rnd, rnd.choice((0, 0, 1, 5, 30)))
+        payload = bytes(rnd.randrange(256) for _ in range(rnd.choice((0, 1, 2, 17, 100, 300))))
+        f = bytearray(frame(payload))
+        if rnd.random() < 0.2:
+            f[rnd.randrange(3, len(f))] ^= 1 << rnd.randrange(8)
+        out += f
+    return bytes(out)
+
+class Decorators(object):
+    # micropython's code emitter decorators, as no-ops
+    @staticmethod
+    def viper(f):
+        return f
+    native = viper
+
+def kernels():
+    # (name, (ring_find_sync, ring_sum, buf_sum)) for each kernel to check
+    ks = []
+    if parse_kernel.KERNEL != 'python':
+        ks.append((parse_kernel.KERNEL, (parse_kernel.ring_find_sync,
+                                         parse_kernel.ring_sum, parse_kernel.buf_sum)))
+    env = { 'micropython': Decorators, 'ptr8': lambda buf: buf }
+    for name, source in (('viper source', parse_kernel.VIPER_SOURCE),
+                         ('native source', parse_kernel.NATIVE_SOURCE)):
+        ks.append((name, compile_kernel(source, env)))
+    return ks
+
+def with_kernel(kernel, f):
+    # f(), with the parsers using kernel
+    saved = packet_buffer.ring_find_sync, packet_buffer.ring_sum, packet_buffer.buf_sum
+    packet_buffer.ring_find_sync, packet_buffer.ring_sum, packet_buffer.buf_sum = kernel
+    try:
+        return f()
+    finally:
+        packet_buffer.ring_find_sync, packet_buffer.ring_sum, packet_buffer.buf_sum = saved
+
+def parse_all(pb, data, rnd):
+    # Feed data in random pieces; list of frames and errors, in order
+    events = []
+    i = 0
+    while i < len(data):
+        k = rnd.choice((1, 3, 16, 64, 200))
+        b = data[i:i + k]
+        i += k
+        while True:
+            try:
+                pb.include_bytes(b)
+                error = None
+            except ChecksumError:
+                error = 'checksum error'
+            while len(pb):
+                events.append(bytes(pb.dequeue_one()))
+            if hasattr(pb, 'release'):
+                pb.release()
+            if error is None:
+                break
+            events.append(error)
+            b = b''             # carry on parsing what followed the bad frame
+    return events
+
+
+class KernelTestCase(unittest.TestCase):
+
+    def testKernelPicked(self):
+        self.assertIn(parse_kernel.KERNEL, ('viper', 'native', 'python'))
+        if sys.implementation.name != 'micropython':
+            self.assertEqual(parse_kernel.KERNEL, 'python')
+
+    def testNoEmitter(self):
+        # Where the decorators can't be compiled, the kernel is refused
+        # rather than the module failing to load
+        self.assertIsNone(compile_kernel('@micropython.viper\ndef f(:\n'))
+        if sys.implementation.name != 'micropython':
+            self.assertIsNone(compile_kernel(parse_kernel.VIPER_SOURCE))
+
+    def testAgainstPython(self):
+        for name, (find, total, flat) in kernels():
+            rnd = random.Random(1)
+            for trial in range(300):
+                size = rnd.choice((8, 64, 1024))
+                mask = size - 1
+                buf = bytearray(rnd.choice((0x7e, rnd.randrange(256))) for _ in range(size))
+                i = rnd.randrange(size)
+                head = rnd.randrange(size)
+                k = rnd.randrange(size)
+                self.assertEqual(find(buf, i, head, mask),
+                                 py_ring_find_sync(buf, i, head, mask), name)
+                self.assertEqual(total(buf, i, k, mask),
+                                 py_ring_sum(buf, i, k, mask), name)
+                k = rnd.randrange(size - i + 1)
+                self.assertEqual(flat(buf, i, k), py_buf_sum(buf, i, k), name)
+                self.assertEqual(flat(bytes(buf), i, k), py_buf_sum(buf, i, k), name)
+
+    def testReference(self):
+        buf = bytearray(b'ab~cd~ef')
+        self.assertEqual(py_ring_find_sync(buf, 3, 2, 7), 5)
+        self.assertEqual(py_ring_find_sync(buf, 6, 2, 7), 2)
+        self.assertEqual(py_ring_find_sync(buf, 6, 1, 7), 1)
+        self.assertEqual(py_ring_sum(buf, 6, 3, 7), ord('e') + ord('f') + ord('a'))
+
+
+class DifferentialTestCase(unittest.TestCase):
+
+    def testSameFramesAndErrors(self):
+        for seed in range(40):
+            data = stream(random.Random(seed), 30)
+            a = parse_all(PacketBuffer(), data, random.Random(seed + 1000))
+            b = parse_all(RingPacketBuffer(1024), data, random.Random(seed + 2000))
+            self.assertEqual(a, b, "seed %d" % seed)
+
+    def testByteAtATime(self):
+        # Chunking mustn't change what comes out
+        data = stream(random.Random(3), 30)
+        events = []
+        pb = PacketBuffer()
+        for c in data:
+            try:
+                pb.include_bytes(bytes([c]))
+            except ChecksumError:
+                events.append('checksum error')
+            while len(pb):
+                events.append(pb.dequeue_one())
+        self.assertIn('checksum error', events)
+        self.assertEqual(parse_all(RingPacketBuffer(1024), data, random.Random(4)),
+                         events)
+
+    def testKernelAgainstPythonParser(self):
+        # Both parsers with each kernel, against both with plain Python
+        python = (py_ring_find_sync, py_ring_sum, py_buf_sum)
+        for seed in range(10):
+            data = stream(random.Random(seed), 30)
+            want = with_kernel(python, lambda: parse_all(
+                RingPacketBuffer(1024), data, random.Random(seed)))
+            self.assertEqual(with_kernel(python, lambda: parse_all(
+                PacketBuffer(), data, random.Random(seed))), want)
+            for name, kernel in kernels():
+                for pb in (RingPacketBuffer(1024), PacketBuffer()):
+                    got = with_kernel(kernel, lambda: parse_all(
+                        pb, data, random.Random(seed)))
+                    self.assertEqual(got, want, "%s, %s, seed %d"
+                                     % (name, pb.__class__.__name__, seed))
+
+    def testCounts(self):
+        data = stream(random.Random(7), 50)
+        pb = PacketBuffer()
+        ring = RingPacketBuffer(1024)
+        parse_all(pb, data, random.Random(1))
+        parse_all(ring, data, random.Random(2))
+        self.assertEqual(pb.packet_count, ring.packet_count)
+        self.assertEqual(pb.checksum_errors, ring.checksum_errors)
+        self.assertEqual(pb.total_marking_bytes_count, ring.total_marking_bytes_count)
+        self.assertEqual(pb.byte_count, ring.byte_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
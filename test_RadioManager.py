@@ -0,0 +1,149 @@
+"""Tests for RadioManager, running the gse and flight radios together"""
+
+import unittest
+from pyb import SPI, delay, millis, elapsed_millis
+from xbradio import PacketWaitTimeout
+from fifo import BACKPRESSURE
+from radio_manager import RadioManager
+from test_XBRadio import create_test_radio
+import xbee_sim
+
+FIELD = b'\x00\x13\xa2\x00\x41\x00\x00\x01'
+
+
+class RadioManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gse = create_test_radio('gse')
+        self.flight = create_test_radio('flight')
+        self.rm = RadioManager({ 'gse': self.gse, 'flight': self.flight })
+
+    def testMergedReceive(self):
+        rm = self.rm
+        self.gse.tx(b'to flight', self.flight.address)
+        self.flight.tx(b'to gse', self.gse.address)
+        delay(10)
+        got = set()
+        for i in range(2):
+            got.add(rm.rx(timeout=50))
+        self.assertEqual(got, set([('flight', self.gse.address, b'to flight'),
+                                   ('gse', self.flight.address, b'to gse')]))
+        self.assertRaises(IndexError, rm.rx, 10)
+
+    def testRoundRobinBudget(self):
+        rm = RadioManager({ 'gse': self.gse, 'flight': self.flight }, budget=2)
+        for i in range(6):
+            self.gse.tx(bytes([i]), self.gse.address, flush=False)
+            self.flight.tx(bytes([i]), self.flight.address, flush=False)
+        self.gse.flush_tx()
+        self.flight.flush_tx()
+        delay(20)
+        # Each radio has 6 RX and 6 status frames waiting; one round
+        # takes no more than the budget from each
+        self.assertEqual(rm.service(), 4)
+        self.assertEqual(rm.serviced, { 'gse': 2, 'flight': 2 })
+        while rm.service():
+            self.assertLessEqual(abs(rm.serviced['gse'] - rm.serviced['flight']), 2)
+        self.assertEqual(rm.serviced, { 'gse': 12, 'flight': 12 })
+        self.assertEqual(len(rm.received), 12)
+        names = [rm.rx()[0] for i in range(12)]
+        self.assertEqual(names.count('gse'), 6)
+        self.assertEqual(names.count('flight'), 6)
+
+    def testPerRadioBudget(self):
+        rm = RadioManager({ 'gse': self.gse, 'flight': self.flight },
+                          budget={ 'gse': 3 })
+        self.assertEqual(rm.budgets, { 'gse': 3, 'flight': 4 })
+        rm.budgets['flight'] = 1
+        for i in range(6):
+            self.gse.tx(bytes([i]), self.gse.address, flush=False)
+            self.flight.tx(bytes([i]), self.flight.address, flush=False)
+        self.gse.flush_tx()
+        self.flight.flush_tx()
+        delay(20)
+        self.assertEqual(rm.service(), 4)
+        self.assertEqual(rm.serviced, { 'gse': 3, 'flight': 1 })
+
+    def testNoStarvation(self):
+        rm = self.rm
+        # An AT command on gse that takes the whole timeout doesn't hold
+        # up the packets flight receives meanwhile
+        node = xbee_sim.node(SPI._devices[1].air, FIELD)
+        node.response_ms = 500
+        t0 = millis()
+        self.gse.send_remote_AT_cmd(node.address, 'TP')
+        self.gse.tx(b'hello', self.flight.address)
+        seen = []
+        def cond():
+            if len(rm.received):
+                seen.append(elapsed_millis(t0))
+                rm.received.get()
+            return False
+        self.assertRaises(PacketWaitTimeout, rm.wait, cond, 100)
+        self.assertEqual(len(seen), 1)
+        self.assertLess(seen[0], 20)
+
+    def testAT(self):
+        rm = self.rm
+        self.assertEqual(rm.at('flight', 'NI'), 'flight')
+        self.assertEqual(self.flight.values['NI'], 'flight')
+        self.flight.tx(b'x', self.gse.address)
+        self.assertEqual(rm.at('gse', 'TP'), 25)
+        self.assertEqual(rm.rx(timeout=10), ('gse', self.flight.address, b'x'))
+
+    def testRouting(self):
+        rm = self.rm
+        # Unknown addresses go by the default radio ('flight', first by name)
+        name, fid = rm.tx(b'ping', self.gse.address)
+        self.assertEqual(name, 'flight')
+        self.assertTrue(rm.wait_tx(name, fid).ok())
+        self.assertEqual(rm.rx(timeout=10), ('gse', self.flight.address, b'ping'))
+        # Replies go back by the radio the address was heard on
+        self.assertEqual(rm.radio_for(self.flight.address), 'gse')
+        name, fid = rm.tx(b'pong', self.flight.address)
+        self.assertEqual(name, 'gse')
+        self.assertEqual(rm.rx(timeout=10), ('flight', self.gse.address, b'pong'))
+        # Or by the one asked for
+        name, fid = rm.tx(b'self', self.gse.address, radio='gse')
+        self.assertEqual(name, 'gse')
+        self.assertEqual(rm.rx(timeout=10), ('gse', self.gse.address, b'self'))
+
+    def testRoutesBounded(self):
+        rm = RadioManager({ 'gse': self.gse, 'flight': self.flight }, max_routes=2)
+        a, b, c = b'\x00' * 7 + b'\x01', b'\x00' * 7 + b'\x02', b'\x00' * 7 + b'\x03'
+        rm.learn_route(a, 'gse')
+        rm.learn_route(b, 'gse')
+        rm.learn_route(a, 'gse')        # heard again: now b is the oldest
+        rm.learn_route(c, 'gse')
+        self.assertEqual(sorted(rm.routes), [a, c])
+        self.assertEqual(rm.route_evictions, 1)
+        self.assertEqual(rm.radio_for(c), 'gse')
+        self.assertEqual(rm.radio_for(b), 'flight')
+        self.assertRaises(ValueError, RadioManager, [self.gse], max_routes=0)
+
+    def testStrAddress(self):
+        # tx() takes str addresses, as XBRadio.tx() does
+        rm = self.rm
+        rm.learn_route(b'\x00\x13\x7a\x00\x41\x00\x00\x07', 'gse')
+        self.assertEqual(rm.radio_for('\x00\x13\x7a\x00\x41\x00\x00\x07'), 'gse')
+        self.assertEqual(rm.radio_for('thisisanaddress!'), 'flight')
+        name, frame_id = rm.tx(b'x', 'thisisanaddress!')
+        self.assertEqual(name, 'flight')
+
+    def testBackpressure(self):
+        gse, flight = self.gse, self.flight
+        rm = RadioManager([gse, flight], queue_len=3, policy=BACKPRESSURE)
+        self.assertEqual(rm.names, ['radio0', 'radio1'])
+        for i in range(5):
+            gse.tx(bytes([i]), flight.address)
+        delay(20)
+        for i in range(10):
+            rm.service()
+        self.assertEqual(len(rm.received), 3)
+        self.assertEqual(rm.received.dropped, 0)
+        got = [rm.rx(timeout=10)[2] for i in range(5)]
+        self.assertEqual(got, [bytes([i]) for i in range(5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""Tests for remote AT commands (0x17 / 0x97), on virtual field nodes"""
+
+import unittest
+import pyb
+from pyb import SPI, millis, elapsed_millis
+from xbradio import ATCommandError, PacketWaitTimeout, TxWindowFull
+from test_XBRadio import create_test_radio
+import xbee_sim
+
+NOWHERE = b'\x00\x13\xa2\x00\x00\x00\x00\x01'
+
+def field_address(i):
+    return b'\x00\x13\xa2\x00\x41\x00' + bytes([i >> 8, i & 0xff])
+
+
+class RemoteATTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+        self.air = SPI._devices[1].air
+        self.nodes = [xbee_sim.node(self.air, field_address(i), ni='node%d' % i)
+                      for i in range(50)]
+
+    def testRemoteAT(self):
+        xb = self.xb
+        flight = b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6'
+        self.assertEqual(xb.remote_at(flight, 'NI'), 'flight')
+        self.assertEqual(xb.remote_at(flight, 'TP'), 25)
+        self.assertNotIn('NI', xb.values)   # remote values aren't ours
+
+    def testRemoteSet(self):
+        xb = self.xb
+        node = self.nodes[3]
+        self.assertIsNone(xb.remote_at(node.address, 'NT', 0x20))
+        self.assertEqual(node.params['NT'], b'\x20')
+        self.assertEqual(xb.remote_at(node.address, 'NT'), b'\x20')
+
+    def testRemoteErrors(self):
+        xb = self.xb
+        self.assertRaises(ATCommandError, xb.remote_at, self.nodes[0].address, 'QQ')
+        with self.assertRaises(ATCommandError) as cm:
+            xb.remote_at(NOWHERE, 'NI')
+        self.assertIn('status 4', str(cm.exception))
+
+    def testRemoteTimeout(self):
+        xb = self.xb
+        self.nodes[0].response_ms = 500
+        self.assertRaises(PacketWaitTimeout, xb.remote_at, self.nodes[0].address,
+                          'TP', timeout=100)
+        self.assertEqual(xb.remote_AT_pending, {})
+
+    def testFanout(self):
+        xb = self.xb
+        for i, node in enumerate(self.nodes):
+            node.params['%V'] = bytes([0x0c, i])
+        addresses = [node.address for node in self.nodes]
+        got = {}
+        for dest, status, value in xb.remote_at_fanout(addresses, '%V', concurrency=16):
+            self.assertEqual(status, 0)
+            got[dest] = value
+        self.assertEqual(len(got), 50)
+        for i in range(50):
+            self.assertEqual(got[field_address(i)], 0x0c00 + i)
+        self.assertEqual(xb.remote_AT_pending, {})
+        self.assertEqual(xb.remote_AT_replies, {})
+
+    def testFanoutTakesSlowestNotSum(self):
+        xb = self.xb
+        for node in self.nodes:
+            node.response_ms = 40
+        t0 = millis()
+        results = list(xb.remote_at_fanout([n.address for n in self.nodes], 'TP',
+                                           concurrency=50))
+        self.assertEqual(len(results), 50)
+        self.assertLess(elapsed_millis(t0), 40 * 5)
+
+    def testFanoutPerNodeTimeout(self):
+        xb = self.xb
+        self.nodes[1].response_ms = 500
+        addresses = [n.address for n in self.nodes[:4]] + [NOWHERE]
+        results = dict((d, (s, v)) for d, s, v in
+                       xb.remote_at_fanout(addresses, 'TP', timeout=200))
+        self.assertEqual(results[self.nodes[1].address], (None, None))
+        self.assertEqual(results[NOWHERE], (4, None))
+        self.assertEqual(results[self.nodes[0].address], (0, 25))
+
+    def testFanoutAsTheyArrive(self):
+        # The fast nodes come back before the slow one
+        xb = self.xb
+        self.nodes[0].response_ms = 100
+        order = [d for d, s, v in xb.remote_at_fanout([n.address for n in self.nodes[:5]],
+                                                      'TP')]
+        self.assertEqual(order[-1], self.nodes[0].address)
+
+    def testAbandonedFanout(self):
+        xb = self.xb
+        g = xb.remote_at_fanout([n.address for n in self.nodes], 'TP', concurrency=8)
+        next(g)
+        g.close()
+        self.assertEqual(xb.remote_AT_pending, {})
+
+
+    def run_for(self, ms):
+        t0 = millis()
+        while elapsed_millis(t0) < ms:
+            self.xb.service()
+            pyb.delay(1)
+
+    def testPendingExpires(self):
+        # A command whose reply never comes is given up on by service()
+        xb = self.xb
+        xb.remote_AT_timeout = 200
+        self.nodes[1].response_ms = 10000
+        frame_id = xb.send_remote_AT_cmd(self.nodes[1].address, 'TP')
+        self.nodes[0].response_ms = 500
+        slow = xb.send_remote_AT_cmd(self.nodes[0].address, 'TP', timeout=1000)
+        self.run_for(100)
+        self.assertIn(frame_id, xb.remote_AT_pending)
+        self.run_for(150)
+        self.assertEqual(list(xb.remote_AT_pending), [slow])
+        self.assertEqual(xb.stats()['remote_AT_expired'], 1)
+        self.run_for(400)
+        self.assertEqual(list(xb.remote_AT_replies), [slow])
+
+    def testRepliesBounded(self):
+        # Replies nobody collects push out the oldest
+        xb = self.xb
+        xb.max_remote_AT_replies = 3
+        ids = [xb.send_remote_AT_cmd(n.address, 'TP') for n in self.nodes[:5]]
+        self.run_for(100)
+        self.assertEqual(sorted(xb.remote_AT_replies), sorted(ids[2:]))
+        self.assertEqual(xb.remote_AT_dropped, 2)
+
+    def testFrameIDsRunOut(self):
+        xb = self.xb
+        for frame_id in range(1, 256):
+            xb.remote_AT_pending[frame_id] = millis() + 10000
+        self.assertRaises(TxWindowFull, xb.send_AT_cmd, 'TP')
+        del xb.remote_AT_pending[42]
+        self.assertEqual(xb.send_AT_cmd('TP'), 42)
+
+
+if __name__ == '__main__':
+    unittest.main()
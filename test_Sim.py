@@ -0,0 +1,44 @@
+"""Tests for the host-side virtual XBee (sim/xbee_sim.py)"""
+
+import unittest
+from pyb import delay, millis
+from test_XBRadio import create_test_radio
+import xbee_sim
+
+
+class SimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gse = create_test_radio('gse')
+        self.flt = create_test_radio('flight')
+
+    def testAddresses(self):
+        self.assertEqual(self.gse.address, xbee_sim.BOARDS['gse'][5])
+        self.assertEqual(self.flt.address, xbee_sim.BOARDS['flight'][5])
+
+    def testDeliveryBetweenRadios(self):
+        self.gse.tx(b'ping', self.flt.address)
+        delay(5)
+        self.gse.get_and_process_available_packets(timeout=1)
+        a, d = self.flt.rx()
+        self.assertEqual(a, self.gse.address)
+        self.assertEqual(d, b'ping')
+
+    def testInvalidATCommand(self):
+        self.gse.do_AT_cmd_and_process_response('ZZ')
+        self.assertNotIn('ZZ', self.gse.values)
+
+    def testDelayTakesNoTime(self):
+        t0 = millis()
+        delay(10000)
+        self.assertTrue(millis() - t0 >= 10000)
+
+    def testBadChecksumIgnored(self):
+        xb = self.gse.xcvr
+        xb.spi.send(b'~\x00\x04\x08\x01TP\x00')
+        self.gse.get_and_process_available_packets(timeout=1)
+        self.assertNotIn('TP', self.gse.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
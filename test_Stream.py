@@ -0,0 +1,203 @@
+import io
+import unittest
+from fragment import FragTransport
+from stream import StreamTransport, StreamClosed, OPEN, CLOSED, seq_lt
+from xbradio import PacketWaitTimeout
+from test_XBRadio import create_test_radio
+from pyb import SPI, millis, elapsed_millis
+
+NOWHERE = b'\x00\x13\xa2\x00\x00\x00\x00\x01'
+
+def blob(n):
+    return bytes((i * 13 + (i >> 8)) & 0xff for i in range(n))
+
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.a = StreamTransport(create_test_radio('gse'))
+        self.b = StreamTransport(create_test_radio('flight'))
+
+    def run_until(self, cond, timeout=5000):
+        t0 = millis()
+        while not cond():
+            self.assertLess(elapsed_millis(t0), timeout)
+            self.a.service()
+            self.b.service()
+
+    def pair(self):
+        # Connect a to b. Each end's waits service only its own side, so
+        # a's service also services b, and reads whatever b has into
+        # self.got when self.reading.
+        a, b = self.a, self.b
+        a_service = a.service
+        self.got = bytearray()
+        self.reading = False
+        def both():
+            a_service()
+            b.service()
+            if self.reading and self.sb.available:
+                self.got += self.sb.read()
+        a.service = both
+        sa = a.connect(b.radio.address)
+        self.sb = sb = b.accept(0)
+        return sa, sb
+
+    def testSeq(self):
+        self.assertTrue(seq_lt(1, 2))
+        self.assertTrue(seq_lt(0xffff, 0))
+        self.assertFalse(seq_lt(2, 2))
+        self.assertFalse(seq_lt(3, 2))
+
+    def testConnect(self):
+        sa, sb = self.pair()
+        self.assertEqual(sa.state, OPEN)
+        self.assertEqual(sb.state, OPEN)
+        self.assertEqual(sb.peer, self.a.radio.address)
+
+    def testConnectTimeout(self):
+        self.assertRaises(PacketWaitTimeout, self.a.connect, NOWHERE, 300)
+        self.assertEqual(self.a.streams, {})
+
+    def testSmallWriteRead(self):
+        sa, sb = self.pair()
+        sa.write(b'hello ')
+        sa.write('world')
+        self.run_until(lambda: sb.available == 11)
+        self.assertEqual(sb.read(5), b'hello')
+        self.assertEqual(sb.read(), b' world')
+
+    def testCoalesce(self):
+        sa, sb = self.pair()
+        sa.cwnd = 0     # hold everything in the queue
+        for i in range(20):
+            sa.write(b'line %02d\n' % i)
+        self.assertEqual(len(sa.queue), 1)
+
+    def testBulk(self):
+        sa, sb = self.pair()
+        data = blob(20000)
+        self.reading = True
+        sa.write(data)
+        sa.flush()
+        self.assertEqual(bytes(self.got), data)
+        self.assertEqual(sa.retransmits, 0)
+        self.assertGreater(sa.cwnd, 2)
+        self.assertIsNotNone(sa.srtt)
+
+    def testFileCopy(self):
+        sa, sb = self.pair()
+        data = blob(20000)
+        f = io.BytesIO(data)
+        self.reading = True
+        while True:
+            block = f.read(512)
+            if not block:
+                break
+            sa.write(block)
+        sa.close()
+        self.assertEqual(sb.read(), b'')
+        self.assertEqual(bytes(self.got), data)
+        self.assertEqual(sa.state, CLOSED)
+        self.assertTrue(sb.peer_fin)
+
+    def testLossy(self):
+        sa, sb = self.pair()
+        air = SPI._devices[1].air
+        air.loss = 0.6
+        data = blob(8000)
+        sa.write(data)
+        got = bytearray()
+        t0 = millis()
+        while len(got) < len(data):
+            self.assertLess(elapsed_millis(t0), 30000)
+            self.a.service()
+            if sb.available:
+                got += sb.read()
+        air.loss = 0.0
+        self.assertEqual(bytes(got), data)
+        self.assertGreater(sa.retransmits, 0)
+        self.assertGreater(sa.cuts, 0)
+
+    def testSlowReader(self):
+        # The receiver's window closes and reopens as it reads
+        sa, sb = self.pair()
+        data = blob(sb.chunks.capacity * self.a.mss * 2)
+        sa.write(data)
+        self.run_until(lambda: sb.chunks.full())
+        self.assertEqual(sb.window(), 0)
+        got = bytearray()
+        while len(got) < len(data):
+            self.a.service()
+            if sb.available:
+                got += sb.read()
+        self.assertEqual(bytes(got), data)
+
+    def testWriteAfterClose(self):
+        sa, sb = self.pair()
+        sa.close()
+        self.assertRaises(StreamClosed, sa.write, b'x')
+        self.assertEqual(sb.read(), b'')
+
+    def testPeerRestart(self):
+        # The peer starts over without closing, and connects again with
+        # the same conn number: a new stream, not the old one resumed
+        sa, sb = self.pair()
+        sa.write(b'first')
+        self.run_until(lambda: sb.available == 5)
+        self.a.close()
+        a = self.a = StreamTransport(self.a.radio)
+        a_service = a.service
+        def both():
+            a_service()
+            self.b.service()
+        a.service = both
+        sa = a.connect(self.b.radio.address)
+        self.assertEqual(sa.conn_id, sb.conn_id)
+        sb2 = self.b.accept(500)
+        self.assertIsNot(sb2, sb)
+        sa.write(b'hello')
+        self.run_until(lambda: sb2.available == 5)
+        self.assertEqual(sb2.read(), b'hello')
+        # The old one has its data, then ends
+        self.assertEqual(sb.read(), b'first')
+        self.assertEqual(sb.read(), b'')
+        self.assertRaises(StreamClosed, sb.write, b'x')
+
+    def testOtherTrafficKept(self):
+        a, b = self.a, self.b
+        a.radio.tx(b'plain', b.radio.address)
+        self.run_until(lambda: len(b.radio.received_data_packets))
+        self.assertEqual(b.radio.rx(), (a.radio.address, b'plain'))
+
+    def testWithFragTransport(self):
+        # Each transport gets only its own packets
+        a, b = self.a, self.b
+        fa, fb = FragTransport(a.radio), FragTransport(b.radio)
+        sa, sb = self.pair()
+        fa.start_send(b.radio.address, blob(1000))
+        sa.write(b'hello')
+        sa.flush()
+        def both():
+            fa.service()
+            fb.service()
+            return sb.available and len(fb.messages)
+        self.run_until(both)
+        self.assertEqual(sb.read(), b'hello')
+        self.assertEqual(fb.recv(), (a.radio.address, blob(1000)))
+        self.assertEqual(len(b.radio.received_data_packets), 0)
+
+
+class IrqStreamTestCase(StreamTestCase):
+    # The same again, with the handlers (and their acks and segments)
+    # run in the nATTN drain, and a transmit window that fills
+
+    def setUp(self):
+        self.a = StreamTransport(create_test_radio('gse', tx_window=2))
+        self.b = StreamTransport(create_test_radio('flight', tx_window=2))
+        self.a.radio.enable_irq_rx()
+        self.b.radio.enable_irq_rx()
+
+
+if __name__ == '__main__':
+    unittest.main()
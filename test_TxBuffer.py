@@ -0,0 +1,72 @@
+import unittest
+from tx_buffer import TxBuffer
+from packet_buffer import PacketBuffer
+from pyb import delay
+from test_XBRadio import create_test_radio
+
+
+class TxBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.txb = TxBuffer(64)
+
+    def testOneFrame(self):
+        self.txb.frame(b'\x08\x03PL\x00')
+        self.assertEqual(bytes(self.txb.view()), b'~\x00\x05\x08\x03PL\x00\x58')
+
+    def testPieces(self):
+        txb = self.txb
+        txb.begin()
+        txb.put_byte(0x8a)
+        txb.put(b'\x00')
+        txb.end()
+        self.assertEqual(bytes(txb.view()), b'~\x00\x02\x8a\x00u')
+
+    def testSeveralFrames(self):
+        txb = self.txb
+        txb.frame(b'\x8a\x00')
+        txb.frame('\x08\x03PL\x00')
+        pb = PacketBuffer()
+        pb.include_bytes(bytes(txb.view()))
+        self.assertEqual(list(pb), [b'\x8a\x00', b'\x08\x03PL\x00'])
+        self.assertEqual(txb.frames, 2)
+        txb.clear()
+        self.assertEqual(len(txb), 0)
+
+    def testTooBig(self):
+        txb = self.txb
+        txb.frame(b'x' * 30)
+        with self.assertRaises(ValueError):
+            txb.frame(b'x' * 30)
+        self.assertEqual(len(txb), 34)
+        txb.frame(b'x' * 26)
+        self.assertEqual(len(txb), 64)
+
+
+class CoalescedTxTestCase(unittest.TestCase):
+
+    def testOneTransaction(self):
+        xb = create_test_radio('gse')
+        spi = xb.xcvr.spi
+        t0 = spi.transactions
+        for i in range(5):
+            xb.tx(bytes([i]), xb.address, flush=False)
+        self.assertEqual(spi.transactions, t0)
+        xb.flush_tx()
+        self.assertEqual(spi.transactions, t0 + 1)
+        delay(5)
+        self.assertEqual(xb.rx_available(), 5)
+        self.assertEqual([xb.rx()[1] for i in range(5)],
+                         [bytes([i]) for i in range(5)])
+
+    def testFlushWhenFull(self):
+        xb = create_test_radio('gse', tx_buffer_size=64)
+        for i in range(3):
+            xb.tx(b'x' * 20, xb.address, flush=False)
+        xb.flush_tx()
+        delay(5)
+        self.assertEqual(xb.rx_available(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""Tests for the priority transmit classes"""
+
+import unittest
+from pyb import SPI, delay
+from tx_queues import TxQueues, CONTROL, TELEMETRY, BULK, STRICT, WEIGHTED
+from test_XBRadio import create_test_radio
+
+FLIGHT = b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6'
+
+
+class TxQueuesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+        self.peer = SPI._devices[2]
+
+    def peer_data(self):
+        # The data of the RX Indicator frames the peer radio has waiting
+        out = bytes(self.peer.out)
+        frames = []
+        while out:
+            n = (out[1] << 8) | out[2]
+            frames.append(out[3:3 + n])
+            out = out[4 + n:]
+        return [bytes(f[12:]) for f in frames if f[0] == 0x90]
+
+    def testStrictOrder(self):
+        txq = TxQueues(self.xb)
+        txq.send(b'b1', FLIGHT, BULK)
+        txq.send(b't1', FLIGHT, TELEMETRY)
+        txq.send(b'b2', FLIGHT, BULK)
+        txq.send(b'c1', FLIGHT, CONTROL)
+        txq.send(b't2', FLIGHT, TELEMETRY)
+        self.assertEqual(len(txq), 5)
+        self.assertEqual(txq.service(), 5)
+        delay(20)
+        self.assertEqual(self.peer_data(), [b'c1', b't1', b't2', b'b1', b'b2'])
+
+    def testWeighted(self):
+        # Telemetry gets 4 quanta a round to bulk's 1
+        xb = create_test_radio('gse', tx_window=10)
+        txq = TxQueues(xb, mode=WEIGHTED)
+        for i in range(20):
+            txq.send(bytes(64), FLIGHT, BULK)
+            txq.send(bytes(64), FLIGHT, TELEMETRY)
+        self.assertEqual(txq.service(), 9)      # one slot reserved
+        st = txq.stats()
+        self.assertEqual((st['telemetry']['sent'], st['bulk']['sent']), (8, 1))
+        # Strict would have starved bulk
+        xb = create_test_radio('gse', tx_window=10)
+        txq = TxQueues(xb, mode=STRICT)
+        for i in range(20):
+            txq.send(bytes(64), FLIGHT, BULK)
+            txq.send(bytes(64), FLIGHT, TELEMETRY)
+        txq.service()
+        st = txq.stats()
+        self.assertEqual((st['telemetry']['sent'], st['bulk']['sent']), (9, 0))
+        self.assertTrue(txq.drain(2000))
+        self.assertEqual(txq.stats()['bulk']['sent'], 20)
+
+    def testDeadline(self):
+        txq = TxQueues(self.xb, deadlines=(None, 20, None))
+        got = []
+        txq.send(b'stale', FLIGHT, TELEMETRY, done=got.append)
+        txq.send(b'later', FLIGHT, TELEMETRY, deadline=1000, done=got.append)
+        txq.send(b'bulk', FLIGHT, BULK, done=got.append)
+        delay(30)
+        self.assertEqual(txq.service(), 2)
+        self.assertIsNone(got[0])
+        self.assertEqual(len(got), 3)
+        delay(20)
+        self.assertEqual(self.peer_data(), [b'later', b'bulk'])
+        st = txq.stats()['telemetry']
+        self.assertEqual((st['queued'], st['sent'], st['expired']), (2, 1, 1))
+
+    def testLimits(self):
+        txq = TxQueues(self.xb, limits=(2, 2, 2))
+        self.assertTrue(txq.send(b'c1', FLIGHT, CONTROL))
+        self.assertTrue(txq.send(b'c2', FLIGHT, CONTROL))
+        self.assertFalse(txq.send(b'c3', FLIGHT, CONTROL))     # refused
+        for i in range(3):
+            self.assertTrue(txq.send(bytes([i]), FLIGHT, TELEMETRY))
+        st = txq.stats()
+        self.assertEqual(st['control']['rejected'], 1)
+        self.assertEqual((st['telemetry']['dropped'], st['telemetry']['high_water']),
+                         (1, 2))
+        txq.drain()
+        delay(20)
+        self.assertEqual(self.peer_data(), [b'c1', b'c2', b'\x01', b'\x02'])
+
+    def testDropOldestTellsSender(self):
+        txq = TxQueues(self.xb, limits=(2, 2, 2))
+        got = []
+        for i in range(3):
+            txq.send(bytes([i]), FLIGHT, TELEMETRY, done=got.append)
+        self.assertEqual(got, [None])           # the oldest, pushed out
+        st = txq.stats()
+        self.assertEqual((st['queued'], st['dropped'], st['expired']), (3, 1, 0))
+        self.assertEqual((st['waiting'], st['high_water']), (2, 2))
+        txq.drain()
+        st = txq.stats()
+        self.assertEqual((st['sent'], st['telemetry']['sent']), (2, 2))
+        self.assertEqual(len(got), 3)
+
+    def testControlReserve(self):
+        # Bulk can't take the last slot of the window, so control
+        # goes straight out
+        xb = create_test_radio('gse', tx_window=2)
+        txq = TxQueues(xb)
+        for i in range(4):
+            txq.send(bytes([i]), FLIGHT, BULK)
+        self.assertEqual(txq.service(), 1)
+        self.assertEqual(xb.tx_tracker.outstanding, 1)
+        txq.send(b'stop', FLIGHT, CONTROL)
+        self.assertEqual(txq.service(), 1)
+        self.assertEqual(xb.tx_tracker.outstanding, 2)
+        self.assertTrue(txq.drain())
+
+    def testFrameIDs(self):
+        # Frame IDs are only taken as messages go, in sequence with
+        # frames sent directly
+        xb = self.xb
+        txq = TxQueues(xb)
+        got = []
+        for i in range(3):
+            txq.send(bytes([i]), FLIGHT, BULK, done=got.append)
+        direct = xb.tx(b'direct', FLIGHT)
+        txq.service()
+        self.assertEqual(got, [direct + 1, direct + 2, direct + 3])
+        for frame_id in [direct] + got:
+            self.assertTrue(xb.wait_tx(frame_id).ok())
+
+
+    def testBadWeights(self):
+        # A class that could never earn a send would hang WEIGHTED
+        self.assertRaises(ValueError, TxQueues, self.xb, weights=(8, 4, 0))
+        self.assertRaises(ValueError, TxQueues, self.xb, quantum=0)
+
+    def wait_for(self, txq, asleep):
+        for i in range(1000):
+            txq.service()
+            if self.xb.asleep == asleep:
+                return
+            delay(1)
+        self.fail("never %s" % ('slept' if asleep else 'woke'))
+
+    def testSleep(self):
+        # Held while the network sleeps, and dropped at once if the
+        # deadline falls before it wakes; sent in one burst when it does
+        xb = self.xb
+        txq = TxQueues(xb)
+        sim = SPI._devices[1]
+        sim.sleep_cycle(50, 200)
+        self.wait_for(txq, True)
+        self.wait_for(txq, False)
+        self.wait_for(txq, True)
+        got = []
+        txq.send(b'c1', FLIGHT, CONTROL, done=got.append)
+        txq.send(b't1', FLIGHT, TELEMETRY, deadline=100, done=got.append)
+        txq.send(b't2', FLIGHT, TELEMETRY, deadline=1000, done=got.append)
+        tx0 = sim.tx_count
+        self.assertEqual(txq.service(), 0)
+        self.assertEqual(got, [None])
+        self.assertEqual(txq.stats()['telemetry']['expired'], 1)
+        self.assertEqual(sim.tx_count, tx0)
+        self.wait_for(txq, False)
+        self.assertEqual(len(txq), 0)
+        self.assertEqual(len(got), 3)
+        self.assertEqual((txq.sent, txq.expired, txq.bursts), (2, 1, 1))
+        delay(20)
+        self.assertEqual(self.peer_data(), [b'c1', b't2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
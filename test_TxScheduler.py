@@ -0,0 +1,160 @@
+"""Tests for SleepScheduler, against a virtual XBee in cyclic sleep"""
+
+import unittest
+from pyb import SPI, delay, millis
+from tx_scheduler import SleepScheduler
+from test_XBRadio import create_test_radio
+
+FLIGHT = b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6'
+
+
+class SleepScheduleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+        self.sim = SPI._devices[1]
+        self.peer = SPI._devices[2]
+        self.sched = SleepScheduler(self.xb)
+
+    def wait_for(self, asleep):
+        for i in range(1000):
+            self.sched.service()
+            if self.xb.asleep == asleep:
+                return
+            delay(1)
+        self.fail("never %s" % ('slept' if asleep else 'woke'))
+
+    def testModemStatus(self):
+        xb = self.xb
+        self.sim.sleep_cycle(50, 200)
+        self.assertFalse(xb.asleep)
+        self.assertIsNone(xb.next_wake())
+        self.wait_for(True)
+        self.assertEqual(xb.modem_status, 0x0c)
+        self.assertIsNone(xb.next_wake())       # don't know how long yet
+        self.wait_for(False)
+        self.assertEqual(xb.modem_status, 0x0b)
+        self.assertTrue(199 <= xb.sleep_ms < 230)
+        self.wait_for(True)
+        self.assertTrue(49 <= xb.wake_ms < 80)
+        self.assertEqual(xb.next_wake(), xb.slept_at + xb.sleep_ms)
+        xb.reset()
+        xb.get_and_process_available_packets(timeout=1)
+        self.assertFalse(xb.asleep)
+        self.assertIsNone(xb.sleep_ms)
+
+    def testHeldWhileAsleep(self):
+        xb, sched = self.xb, self.sched
+        self.sim.sleep_cycle(50, 200)
+        self.wait_for(True)
+        tx0 = self.sim.tx_count
+        got = []
+        for i, priority in enumerate((0, 2, 1, 2)):
+            sched.send(bytes([i]), FLIGHT, priority=priority, done=got.append)
+        delay(100)
+        sched.service()
+        self.assertEqual(self.sim.tx_count, tx0)
+        self.assertEqual(len(sched), 4)
+        self.wait_for(False)
+        sched.drain()
+        self.assertEqual(len(got), 4)
+        self.assertNotIn(None, got)
+        delay(20)
+        received = self.peer.rx_count
+        self.assertEqual(received, 4)
+        # The peer got them in priority order, equals oldest first
+        order = [bytes(f[-1:]) for f in self.peer_frames()]
+        self.assertEqual(order, [b'\x01', b'\x03', b'\x02', b'\x00'])
+        st = sched.stats()
+        self.assertEqual((st['sent'], st['expired'], st['bursts']), (4, 0, 1))
+        self.assertEqual(xb.stats()['tx_failed'], 0)
+
+    def peer_frames(self):
+        # The RX Indicator frames the peer radio has waiting for its host
+        out = bytes(self.peer.out)
+        frames = []
+        while out:
+            n = (out[1] << 8) | out[2]
+            frames.append(out[3:3 + n])
+            out = out[4 + n:]
+        return [f for f in frames if f[0] == 0x90]
+
+    def testDeadlineOrder(self):
+        sched = self.sched
+        self.sim.sleep_cycle(50, 200)
+        self.wait_for(True)
+        sched.send(b'late', FLIGHT, deadline=5000)
+        sched.send(b'soon', FLIGHT, deadline=1000)
+        sched.send(b'whenever', FLIGHT)
+        self.wait_for(False)
+        sched.drain()
+        delay(20)
+        self.assertEqual([bytes(f[12:]) for f in self.peer_frames()],
+                         [b'soon', b'late', b'whenever'])
+
+    def testExpired(self):
+        sched = self.sched
+        self.sim.sleep_cycle(50, 200)
+        self.wait_for(True)
+        got = []
+        sched.send(b'x', FLIGHT, deadline=20, done=got.append)
+        sched.send(b'y', FLIGHT, deadline=1000, done=got.append)
+        delay(30)
+        sched.service()
+        self.assertEqual(got, [None])
+        self.wait_for(False)
+        sched.drain()
+        self.assertEqual(len(got), 2)
+        self.assertIsNotNone(got[1])
+        self.assertEqual(sched.expired, 1)
+
+    def testExpiredBeforeWake(self):
+        # Once it knows how long the network sleeps, a frame that can't
+        # make its deadline is dropped straight away
+        xb, sched = self.xb, self.sched
+        self.sim.sleep_cycle(50, 200)
+        self.wait_for(True)
+        self.wait_for(False)
+        self.wait_for(True)
+        got = []
+        sched.send(b'x', FLIGHT, deadline=100, done=got.append)
+        sched.send(b'y', FLIGHT, deadline=300, done=got.append)
+        sched.service()
+        self.assertEqual(got, [None])
+        self.assertEqual(len(sched), 1)
+
+    def testNoDeadlineNeverExpires(self):
+        # However late it gets: a frame without a deadline has no due
+        # time to fall behind
+        xb, sched = self.xb, self.sched
+        self.sim.sleep_cycle(50, 200)
+        self.wait_for(True)
+        got = []
+        sched.send(b'x', FLIGHT, done=got.append)
+        delay(1 << 30)
+        self.assertTrue(sched.drain())
+        self.assertEqual(sched.expired, 0)
+        self.assertIsNotNone(got[0])
+
+    def testAwakeSendsAtOnce(self):
+        sched = self.sched
+        got = []
+        sched.send(b'now', FLIGHT, done=got.append)
+        self.assertEqual(sched.service(), 1)
+        self.assertEqual(len(got), 1)
+        self.assertTrue(self.xb.wait_tx(got[0]).ok())
+
+    def testWindowAndCapacity(self):
+        xb = create_test_radio('gse', tx_window=2)
+        sched = SleepScheduler(xb, capacity=3)
+        for i in range(3):
+            self.assertTrue(sched.send(bytes([i]), FLIGHT))
+        self.assertFalse(sched.send(b'no room', FLIGHT))
+        self.assertEqual(sched.rejected, 1)
+        self.assertEqual(sched.service(), 2)
+        self.assertTrue(sched.drain())
+        self.assertEqual(sched.sent, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
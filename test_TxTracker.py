@@ -0,0 +1,103 @@
+import unittest
+from tx_tracker import TxTracker, TX_LOST
+from xbradio import TxWindowFull, PacketWaitTimeout
+from test_XBRadio import create_test_radio
+
+NOWHERE = b'\x00\x13\xa2\x00\x00\x00\x00\x01'
+
+
+class TxTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.t = TxTracker(window=2, status_timeout=100)
+
+    def testComplete(self):
+        t = self.t
+        t.add(5, b'addr', 1000)
+        self.assertTrue(t.pending(5))
+        self.assertIsNone(t.poll(5))
+        r = t.complete(5, 0xfffe, 2, 0, 0, 1030)
+        self.assertEqual((r.status, r.retries, r.latency), (0, 2, 30))
+        self.assertIs(t.poll(5), r)
+        with self.assertRaises(KeyError):
+            t.poll(5)
+        self.assertEqual((t.delivered, t.total_retries, t.max_latency), (1, 2, 30))
+
+    def testWindow(self):
+        t = self.t
+        t.add(1, b'a', 0)
+        self.assertFalse(t.window_full())
+        t.add(2, b'a', 0)
+        self.assertTrue(t.window_full())
+        t.complete(1, 0xfffe, 0, 0x21, 0, 5)
+        self.assertFalse(t.window_full())
+        self.assertEqual(t.failed, 1)
+
+    def testUnknownStatusIgnored(self):
+        self.assertIsNone(self.t.complete(9, 0xfffe, 0, 0, 0, 0))
+        self.assertEqual(self.t.outstanding, 0)
+
+    def testExpire(self):
+        t = self.t
+        t.add(1, b'a', 0)
+        t.expire(50)
+        self.assertTrue(t.pending(1))
+        t.expire(101)
+        self.assertEqual(t.poll(1).status, TX_LOST)
+        self.assertEqual(t.outstanding, 0)
+
+    def testLoseAll(self):
+        t = self.t
+        t.add(1, b'a', 0)
+        t.add(2, b'a', 0)
+        t.complete(1, 0xfffe, 0, 0, 0, 5)
+        t.lose_all(20)
+        self.assertEqual(t.poll(1).status, 0)
+        self.assertEqual(t.poll(2).status, TX_LOST)
+        self.assertEqual((t.outstanding, t.lost), (0, 1))
+
+
+class RadioTxTrackingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse', tx_window=2)
+
+    def testDelivered(self):
+        xb = self.xb
+        fid = xb.tx('foo', xb.address)
+        r = xb.wait_tx(fid)
+        self.assertTrue(r.ok())
+        self.assertEqual(r.retries, 0)
+        self.assertTrue(r.latency >= 0)
+
+    def testNotDelivered(self):
+        xb = self.xb
+        fid = xb.tx('foo', NOWHERE)
+        self.assertIsNone(xb.tx_status(fid))
+        r = xb.wait_tx(fid)
+        self.assertEqual(r.status, 0x21)
+
+    def testWindowPaces(self):
+        xb = self.xb
+        fids = [xb.tx('foo', NOWHERE) for i in range(3)]
+        # The third had to wait for the first's status
+        self.assertLessEqual(xb.tx_tracker.outstanding, 2)
+        self.assertEqual(xb.tx_status(fids[0]).status, 0x21)
+
+    def testWindowFull(self):
+        xb = self.xb
+        xb.tx_window_timeout = 0
+        xb.tx('foo', NOWHERE)
+        xb.tx('foo', NOWHERE)
+        with self.assertRaises(TxWindowFull):
+            xb.tx('foo', NOWHERE)
+
+    def testWaitTimeout(self):
+        xb = self.xb
+        fid = xb.tx('foo', NOWHERE)
+        with self.assertRaises(PacketWaitTimeout):
+            xb.wait_tx(fid, timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
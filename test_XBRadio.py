@@ -1,8 +1,13 @@
 """Test for XBee Pro S3B"""
 
 import unittest
-from xbradio import XBRadio
-from pyb import SPI, Pin, delay
+from xbradio import XBRadio, XBRHAL, PacketOverrunError, PacketWaitTimeout, \
+    ATCommandError, SpiCommError, RadioException
+from packet_buffer import ChecksumError
+from fifo import DROP_OLDEST, BACKPRESSURE
+from pyb import SPI, Pin, delay, millis, elapsed_millis
+
+FLIGHT = b'\x00\x13\xa2\x00\x40\xd4\xe5\xf6'
 
 
 class RadioTestCase(unittest.TestCase):
@@ -57,7 +62,451 @@ class RadioTestCase(unittest.TestCase):
         self.assertEqual(xb.rx_available(), 0)
 
 
-    
+class RingRadioTestCase(RadioTestCase):
+    # The same again, parsing in place in a receive ring
+
+    def setUp(self):
+        self.xb = create_test_radio('gse', rx_ring_size=1024)
+
+
+class IrqRadioTestCase(RadioTestCase):
+    # The same again, receiving on nATTN interrupts
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+        self.xb.enable_irq_rx()
+
+    def testReceivesWithoutPolling(self):
+        xb = self.xb
+        xb.tx('foo', xb.address)
+        delay(5)
+        self.assertEqual(len(xb.received_data_packets), 1)
+
+    def testDisable(self):
+        xb = self.xb
+        xb.disable_irq_rx()
+        xb.tx('foo', xb.address)
+        delay(5)
+        self.assertEqual(len(xb.received_data_packets), 0)
+        self.assertEqual(xb.rx_available(), 1)
+
+
+class ATTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+
+    def testAT(self):
+        xb = self.xb
+        self.assertEqual(xb.at('TP'), 25)
+        self.assertEqual(xb.at('NI'), 'gse')
+        self.assertEqual(xb.at('NP'), 256)
+        self.assertEqual(xb.at('ID'), b'\x7f\xff')
+        self.assertEqual(xb.values['TP'], 25)
+
+    def testSetInvalidates(self):
+        xb = self.xb
+        xb.at('NI')
+        self.assertIsNone(xb.at('NI', 'pump-7'))
+        self.assertNotIn('NI', xb.values)
+        self.assertEqual(xb.at('NI'), 'pump-7')
+
+    def testError(self):
+        with self.assertRaises(ATCommandError):
+            self.xb.at('ZZ')
+        self.assertIsNone(self.xb.do_AT_cmd_and_process_response('ZZ'))
+
+    def testTimeout(self):
+        SPI._devices.pop(1)     # unplug the radio
+        with self.assertRaises(PacketWaitTimeout):
+            self.xb.at('TP', timeout=5)
+
+    def testCache(self):
+        xb = self.xb
+        spi = xb.xcvr.spi
+        self.assertEqual(xb.get_value('TP'), 25)
+        n = spi.transactions
+        for i in range(10):
+            self.assertEqual(xb.get_value('TP'), 25)
+        self.assertEqual(spi.transactions, n)
+        self.assertEqual((xb.AT_cache_hits, xb.AT_cache_misses), (10, 1))
+        delay(xb.AT_ttl['TP'] + 1)
+        xb.get_value('TP')
+        self.assertEqual(xb.AT_cache_misses, 2)
+        xb.get_value('TP', max_age=0)
+        self.assertEqual(xb.AT_cache_misses, 3)
+
+
+class ConfigureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+
+    def testDiffAndSkip(self):
+        xb = self.xb
+        vx = SPI._devices[1]
+        r = xb.configure({'NI': 'gse', 'PL': 4, 'ID': 0x1234, 'NT': b'\x00\x20'},
+                         write=True)
+        self.assertEqual(sorted(r['unchanged']), ['NI', 'PL'])
+        self.assertEqual(r['changed'], {'ID': (b'\x7f\xff', 0x1234),
+                                        'NT': (b'\x00\x0a', b'\x00\x20')})
+        self.assertEqual(r['failed'], {})
+        self.assertTrue(r['applied'] and r['written'])
+        self.assertEqual(vx.at_sets, {'ID': 1, 'NT': 1})
+        self.assertEqual(vx.flash_writes, 1)
+        self.assertEqual(xb.at('ID'), b'\x12\x34')
+
+    def testNothingToDo(self):
+        r = self.xb.configure({'PL': 4, 'NI': 'gse'}, write=True)
+        self.assertEqual(r['changed'], {})
+        self.assertFalse(r['applied'] or r['written'])
+
+    def testFailed(self):
+        r = self.xb.configure({'ZZ': 1, 'SH': 5, 'PL': 2})
+        self.assertEqual(r['failed'], {'ZZ': 2, 'SH': 3})
+        self.assertEqual(r['changed'], {'PL': (4, 2)})
+
+    def testEncode(self):
+        e = self.xb.encode_AT_param
+        self.assertEqual(e(0), b'\x00')
+        self.assertEqual(e(0x1234), b'\x12\x34')
+        self.assertEqual(e('ab'), b'ab')
+
+
+class RxQueueTestCase(unittest.TestCase):
+
+    def send3(self, xb):
+        for d in ('a', 'b', 'c'):
+            xb.tx(d, xb.address)
+        delay(5)
+
+    def testDropOldest(self):
+        xb = create_test_radio('gse', rx_queue_len=2, rx_policy=DROP_OLDEST)
+        self.send3(xb)
+        self.assertEqual(xb.rx_available(), 2)
+        self.assertEqual(xb.rx()[1], b'b')
+        self.assertEqual(xb.received_data_packets.dropped, 1)
+        self.assertEqual(xb.received_data_packets.high_water, 2)
+
+    def testBackpressure(self):
+        xb = create_test_radio('gse', rx_queue_len=2, rx_policy=BACKPRESSURE)
+        self.send3(xb)
+        self.assertEqual(xb.rx_available(), 2)
+        self.assertEqual(xb.rx()[1], b'a')
+        self.assertEqual(xb.rx_available(), 2)
+        self.assertEqual([xb.rx()[1], xb.rx()[1]], [b'b', b'c'])
+        self.assertEqual(xb.received_data_packets.dropped, 0)
+
+    def testBackpressureControlFrames(self):
+        # A full queue holds back data, not AT replies or Transmit Status
+        xb = create_test_radio('gse', rx_queue_len=2, rx_policy=BACKPRESSURE)
+        for d in ('a', 'b'):
+            xb.tx(d, xb.address)
+        delay(5)
+        self.assertEqual(xb.rx_available(), 2)
+        self.assertEqual(xb.at('TP'), 25)
+        self.assertTrue(xb.wait_tx(xb.tx(b'x', FLIGHT)).ok())
+        for i in range(xb.tx_tracker.window + 1):
+            xb.tx(b'y', FLIGHT)
+        xb.tx('c', xb.address)
+        xb.tx('d', xb.address)
+        delay(5)
+        self.assertEqual(xb.rx_available(), 2)
+        self.assertEqual([xb.rx()[1] for i in range(4)], [b'a', b'b', b'c', b'd'])
+
+    def testBackpressureIrq(self):
+        xb = create_test_radio('gse', rx_queue_len=2, rx_policy=BACKPRESSURE)
+        xb.enable_irq_rx()
+        self.send3(xb)
+        self.assertEqual(len(xb.received_data_packets), 2)
+        self.assertEqual(xb.rx()[1], b'a')
+        self.assertEqual([xb.rx()[1], xb.rx()[1]], [b'b', b'c'])
+
+
+class SubscribeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gse = create_test_radio('gse')
+        self.flight = create_test_radio('flight')
+        self.got = []
+
+    def handler(self, name):
+        return lambda source, data: self.got.append((name, data))
+
+    def testByTagAndSource(self):
+        gse, flight = self.gse, self.flight
+        gse.subscribe(self.handler('tag'), tag=0x01)
+        gse.subscribe(self.handler('flight'), source=bytearray(flight.address))
+        flight.tx(b'\x01reading', gse.address)
+        flight.tx(b'\x02other', gse.address)
+        gse.tx(b'\x02self', gse.address)
+        gse.tx(b'\x01mine', gse.address)
+        delay(5)
+        self.assertEqual(gse.rx_available(), 1)     # only one left unclaimed
+        self.assertEqual(gse.rx(), (bytes(gse.address), b'\x02self'))
+        self.assertEqual(sorted(self.got), [('flight', b'\x02other'),
+                                            ('tag', b'\x01mine'), ('tag', b'\x01reading')])
+        self.assertEqual(gse.stats()['rx_dispatched'], 3)
+
+    def testUnsubscribe(self):
+        gse = self.gse
+        gse.subscribe(self.handler('tag'), tag=0x01)
+        gse.unsubscribe(tag=0x01)
+        gse.tx(b'\x01', gse.address)
+        delay(5)
+        self.assertEqual(gse.rx()[1], b'\x01')
+        self.assertEqual(self.got, [])
+        self.assertRaises(ValueError, gse.subscribe, self.handler('x'))
+        self.assertRaises(ValueError, gse.subscribe, self.handler('x'), 1, gse.address)
+
+    def testIrq(self):
+        gse = self.gse
+        gse.subscribe(self.handler('tag'), tag=0x01)
+        gse.enable_irq_rx()
+        gse.tx(b'\x01irq', gse.address)
+        delay(5)
+        self.assertEqual(self.got, [('tag', b'\x01irq')])
+
+    def testIrqHandlerTx(self):
+        # A handler's tx() in the drain waits for service()
+        gse, flight = self.gse, self.flight
+        ids = []
+        gse.subscribe(lambda source, data: ids.append(gse.tx(b'\x02echo', source)),
+                      tag=0x01)
+        flight.subscribe(self.handler('flight'), tag=0x02)
+        gse.enable_irq_rx()
+        flight.tx(b'\x01ping', gse.address)
+        delay(5)
+        self.assertEqual(ids, [None])
+        self.assertEqual(gse.stats()['tx_deferrals'], 1)
+        self.assertEqual(self.got, [])
+        gse.service()
+        delay(5)
+        flight.service()
+        self.assertEqual(self.got, [('flight', b'\x02echo')])
+        self.assertEqual(gse.tx_deferred, [])
+
+    def testFrameAlreadyBegun(self):
+        gse = self.gse
+        gse.xcvr.txb.begin()
+        self.assertRaises(RadioException, gse.send_AT_cmd, 'NI')
+
+
+class HALTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hal = XBRHAL(spi = SPI(1),
+                          nRESET = Pin('Y11'),
+                          DOUT = Pin('Y12'),
+                          nSSEL = Pin('X5'),
+                          nATTN = Pin('Y10'))
+        self.hal.hard_reset()
+
+    def testReadsExactlyOneFrame(self):
+        # Modem status is ~ 00 02 8a 00 u: six bytes, read as 3 + 3
+        n0 = self.hal.spi.bytes_exchanged
+        self.assertEqual(self.hal.get_packet(), b'\x8a\x00')
+        self.assertEqual(self.hal.spi.bytes_exchanged - n0, 6)
+
+    def testLongFrameInHunks(self):
+        # The overrun limit follows the frame length, not a fixed 300
+        hal = self.hal
+        hal.get_packet()
+        hal.length_aware_reads = False
+        hal.send_packet(b'\x08\x01NI' + b'x' * 20)
+        hal.get_packet()
+        hal.send_packet(b'\x08\x01NI')
+        self.assertEqual(hal.get_packet(), b'\x88\x01NI\x00' + b'x' * 20)
+
+    def testOverrun(self):
+        hal = self.hal
+        hal.get_packet()
+        hal.spi.recv = lambda n: b'\xff' * n if isinstance(n, int) else n
+        hal.nATTN.value = lambda: 0
+        with self.assertRaises(PacketOverrunError):
+            hal.get_packet()
+
+    def testRecoverParsesRest(self):
+        # A frame read in the same transaction as a bad one isn't left
+        # waiting for the radio to send more
+        hal = self.hal
+        hal.get_packet()
+        with self.assertRaises(ChecksumError):
+            hal.pb.include_bytes(b'~\x00\x02\x8a\x01u~\x00\x02\x8a\x07n')
+        hal.recover('checksum')
+        self.assertTrue(hal.packet_ready())
+        self.assertEqual(bytes(hal.get_packet(timeout=0)), b'\x8a\x07')
+
+    def testRingFullOnTransmit(self):
+        # Frames sitting unread mustn't make a transmit raise
+        hal = XBRHAL(SPI(1), Pin('Y11'), Pin('Y12'), Pin('X5'), Pin('Y10'),
+                     rx_ring_size=64)
+        hal.hard_reset()
+        self.assertEqual(bytes(hal.get_packet()), b'\x8a\x00')
+        hal.pb.release()
+        for i in range(8):
+            hal.pb.include_bytes(b'~\x00\x02\x8a\x00u')
+        hal.send_packet(b'\x08\x01NI' + b'x' * 20)
+        self.assertEqual(hal.stats()['rx']['ring_full'], 1)
+        self.assertEqual(len(hal.pb), 8)
+        for i in range(8):
+            hal.get_packet()
+        hal.pb.release()
+        self.assertEqual(bytes(hal.get_packet()), b'\x88\x01NI\x00')
+
+    def testBootTimeout(self):
+        # No radio on bus 3: nATTN never comes
+        hal = XBRHAL(SPI(3), Pin('X1'), Pin('X2'), Pin('X3'), Pin('X4'))
+        t0 = millis()
+        self.assertRaises(SpiCommError, hal.hard_reset)
+        self.assertLess(elapsed_millis(t0), hal.boot_timeout + 50)
+        self.assertEqual(hal.DOUT.value(), 1)
+
+    def testResetKeepsFrames(self):
+        hal = self.hal
+        self.assertEqual(hal.get_packet(), b'\x8a\x00')
+        hal.pb.include_bytes(b'~\x00\x02\x8a\x07n~\x00\x05\x88')
+        hal.hard_reset()
+        self.assertEqual(hal.get_packet(), b'\x8a\x07')   # from before
+        self.assertEqual(hal.get_packet(), b'\x8a\x00')   # after the reset
+        self.assertEqual(hal.stats()['rx']['frames'], 3)
+
+
+class WedgeTestCase(unittest.TestCase):
+    # Recovery from the radio's misbehaviour, staged cheapest first
+
+    def setUp(self):
+        self.xb = self.create()
+        self.sim = SPI._devices[1]
+        self.xb.reset_stats()
+
+    def create(self):
+        return create_test_radio('gse')
+
+    def testGarbled(self):
+        xb = self.xb
+        self.sim.wedge('garble')
+        for c in b'abc':
+            xb.tx(bytes([c]), xb.address)
+        delay(10)
+        got = []
+        while xb.rx_available():
+            got.append(xb.rx()[1])
+        self.assertEqual(got, [b'b', b'c'])     # the first was lost
+        st = xb.stats()
+        self.assertEqual(st['rx_errors'], 1)
+        self.assertEqual(st['hal']['recoveries'],
+                         { 'resync': 1, 'reselect': 0, 'reset': 0 })
+        self.assertEqual(xb.at('TP'), 25)
+
+    def testStuck(self):
+        # Reselecting unsticks it; no reset needed
+        xb = self.xb
+        self.sim.wedge('stuck')
+        self.assertEqual(xb.at('TP'), 25)
+        hal = xb.stats()['hal']
+        self.assertEqual(hal['wedges'], { 'attn_stuck': 2 })
+        self.assertEqual(hal['recoveries'], { 'resync': 1, 'reselect': 1, 'reset': 0 })
+        self.assertEqual(hal['resets'], 0)
+        self.assertEqual(xb.xcvr.wedge_level, 0)
+
+    def testDead(self):
+        # Only a reset helps
+        xb = self.xb
+        self.sim.wedge('dead')
+        xb.get_and_process_available_packets(timeout=200)
+        self.assertEqual(xb.modem_status, 0)    # it has been reset
+        self.assertEqual(xb.at('TP'), 25)
+        hal = xb.stats()['hal']
+        self.assertEqual(hal['wedges'], { 'attn_stuck': 3 })
+        self.assertEqual(hal['recoveries'], { 'resync': 1, 'reselect': 1, 'reset': 1 })
+        self.assertEqual(hal['resets'], 1)
+        self.assertGreaterEqual(hal['recovery_max_ms'], self.sim.boot_ms)
+        self.assertGreaterEqual(hal['recovery_ms'], hal['recovery_max_ms'])
+
+    def testResetForgets(self):
+        # What the radio had in hand when the HAL reset it is given up on
+        xb = self.xb
+        self.assertEqual(xb.get_value('TP'), 25)
+        xb.remote_AT_pending[200] = millis() + 10000
+        xb.remote_AT_replies[201] = (FLIGHT, 'TP', 0, b'\x19')
+        xb.AT_replies[202] = ('TP', 0, b'\x19')
+        self.sim.wedge('dead')
+        frame_id = xb.tx(b'lost', FLIGHT)
+        xb.get_and_process_available_packets(timeout=200)
+        self.assertEqual(xb.xcvr.recoveries['reset'], 1)
+        self.assertFalse(xb.tx_tracker.poll(frame_id).ok())
+        self.assertEqual(xb.stats()['tx_lost'], 1)
+        self.assertEqual((xb.AT_replies, xb.remote_AT_pending, xb.remote_AT_replies),
+                         ({}, {}, {}))
+        self.assertEqual((xb.values, xb.values_time), ({}, {}))
+        self.assertEqual(xb.get_value('TP'), 25)
+
+
+class RingWedgeTestCase(WedgeTestCase):
+    # The same again, parsing in place in a receive ring
+
+    def create(self):
+        return create_test_radio('gse', rx_ring_size=1024)
+
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xb = create_test_radio('gse')
+
+    def testCounts(self):
+        xb = self.xb
+        xb.reset_stats()
+        xb.at('TP')
+        xb.wait_tx(xb.tx(b'foo', xb.address))
+        xb.wait_tx(xb.tx(b'bar', b'\x00\x13\xa2\x00\x00\x00\x00\x01'))
+        xb.rx()
+        st = xb.stats()
+        self.assertEqual(st['frames'][0x88], 1)
+        self.assertEqual(st['frames'][0x8b], 2)
+        self.assertEqual(st['frames'][0x90], 1)
+        self.assertEqual(st['tx_sent'], 2)
+        self.assertEqual(st['tx_delivered'], 1)
+        self.assertEqual(st['tx_failures'], {0x21: 1})
+        self.assertEqual(st['tx_retries'], 3)
+        self.assertEqual(st['rx_high_water'], 1)
+        hal = st['hal']
+        self.assertEqual(hal['spi_writes'], 3)
+        self.assertEqual(hal['spi_bytes_written'], 8 + 2 * 21)
+        self.assertEqual(hal['rx']['frames'], 4)
+        self.assertGreater(hal['attn_wait_ms'], 0)
+
+    def testSPIBytes(self):
+        xb = self.xb
+        spi = xb.xcvr.spi
+        xb.reset_stats()
+        n0 = spi.bytes_exchanged
+        xb.at('TP')
+        xb.rx_available()
+        hal = xb.stats()['hal']
+        self.assertEqual(hal['spi_bytes_read'], spi.bytes_exchanged - n0)
+        self.assertEqual(hal['rx']['bytes'], hal['spi_bytes_read'])
+
+    def testErrors(self):
+        xb = self.xb
+        xb.reset_stats()
+        self.assertIsNone(xb.do_AT_cmd_and_process_response('QQ'))
+        self.assertRaises(PacketWaitTimeout, xb.wait_AT_reply, 0x42, 5)
+        st = xb.stats()
+        self.assertEqual(st['AT_errors'], 1)
+        self.assertEqual(st['AT_timeouts'], 1)
+
+    def testReset(self):
+        xb = self.xb
+        xb.at('TP')
+        xb.reset_stats()
+        st = xb.stats()
+        self.assertEqual(st['frames'], {})
+        self.assertEqual(st['hal']['spi_bytes_read'], 0)
+        self.assertEqual(st['hal']['rx']['frames'], 0)
+
 
 def gse():
     test_as(create_test_radio('gse'))
@@ -65,19 +514,19 @@ def gse():
 def flight():
     test_as(create_test_radio('flight'))
 
-def create_test_radio(r):
+def create_test_radio(r, **kw):
     if r == 'gse': 
         return XBRadio(spi = SPI(1),
                        nRESET = Pin('Y11'),
                        DOUT = Pin('Y12'),
                        nSSEL = Pin('X5'),
-                       nATTN = Pin('Y10'))
+                       nATTN = Pin('Y10'), **kw)
     if r == 'flight' or r == 'flt':
         return XBRadio(spi = SPI(2),
                        nRESET = Pin('X11'),
                        DOUT = Pin('X12'),
                        nSSEL = Pin('Y5'),
-                       nATTN = Pin('Y4'))
+                       nATTN = Pin('Y4'), **kw)
 
 def create_test_radio_by_dialog(r):
     while True:
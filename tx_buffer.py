@@ -0,0 +1,80 @@
+class TxBuffer(object):
+    # Builds outgoing API frames in place in one preallocated buffer, so
+    # that one or several frames go out to the radio in a single SPI
+    # transaction. The checksum is kept up as the frame is written.
+    #
+    #   txb.begin()
+    #   txb.put_byte(0x08); txb.put_byte(frame_id); txb.put(b'TP')
+    #   txb.end()
+    #   spi.send_recv(txb.view(), ...); txb.clear()
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.clear()
+
+    def clear(self):
+        self.length = 0         # bytes of complete frames
+        self.frames = 0
+        self.start = -1         # start of the frame being built, if any
+
+    def __len__(self):
+        return self.length
+
+    def room(self):
+        # Largest payload a new frame could have
+        return self.size - self.length - 4
+
+    def view(self):
+        return self.mv[:self.length]
+
+    def begin(self):
+        if self.start >= 0:
+            raise ValueError("TxBuffer frame already begun")
+        if self.room() < 1:
+            raise ValueError("TxBuffer full")
+        self.start = self.length
+        self.pos = self.length + 3
+        self.csum = 0
+
+    def put_byte(self, v):
+        if self.pos >= self.size - 1:
+            self.cancel()
+            raise ValueError("frame too big for TxBuffer")
+        self.buf[self.pos] = v
+        self.pos += 1
+        self.csum += v
+
+    def put(self, data):
+        if isinstance(data, str):
+            data = bytes(data, 'ASCII')
+        k = len(data)
+        if self.pos + k > self.size - 1:
+            self.cancel()
+            raise ValueError("frame too big for TxBuffer")
+        self.mv[self.pos:self.pos + k] = data
+        self.pos += k
+        self.csum += sum(data)
+
+    def end(self):
+        s = self.start
+        n = self.pos - s - 3
+        buf = self.buf
+        buf[s] = 0x7e
+        buf[s + 1] = n >> 8
+        buf[s + 2] = n & 0xff
+        buf[self.pos] = 0xff - (self.csum & 0xff)
+        self.length = self.pos + 1
+        self.frames += 1
+        self.start = -1
+
+    def cancel(self):
+        # Abandon the frame being built
+        self.start = -1
+
+    def frame(self, payload):
+        # Add a whole frame with the given payload
+        self.begin()
+        self.put(payload)
+        self.end()
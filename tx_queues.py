@@ -0,0 +1,194 @@
+# Transmit classes, so that bulk traffic (log shipping, say) can't hold
+# up control commands when the link is saturated.
+#
+#   txq = TxQueues(xb, mode=WEIGHTED)
+#   txq.send(b'valve shut', dest, CONTROL)
+#   txq.send(reading, dest, TELEMETRY, deadline=500)
+#   txq.send(log_chunk, dest, BULK)
+#   while True:
+#       txq.service()               # instead of xb.service()
+#
+# Each class has its own BoundedFIFO, with its own limit and overflow
+# policy: by default control and bulk refuse what won't fit (send()
+# returns False), while telemetry drops its oldest, stale, reading.
+# STRICT sends the highest class that has anything; WEIGHTED shares the
+# link out by bytes in proportion to the classes' weights (deficit round
+# robin), so bulk still trickles out under load.
+#
+# TxQueues is a SleepScheduler (tx_scheduler.py) with the classes in
+# place of its one priority queue, so it too holds everything while a
+# cyclic-sleep network is asleep. A message whose deadline (ms from
+# send(), or its class's default) has passed is dropped rather than
+# sent, as is one whose deadline falls before the network is expected to
+# wake. Frame IDs are only taken (by XBRadio.tx()) as messages are sent,
+# not while they wait. The lower classes leave reserve slots of the
+# radio's transmit window free, for control to go at once.
+#
+# A message's done callback, if given, is called with its frame ID when
+# it is sent, or None if it is dropped: for its deadline, or to make room
+# for a newer one. stats() gives SleepScheduler's totals (plus the total
+# dropped to make room), and each class's by its name.
+
+from pyb import millis, elapsed_millis
+from fifo import BoundedFIFO, DROP_OLDEST, BACKPRESSURE
+from tx_scheduler import SleepScheduler
+
+CONTROL = 0
+TELEMETRY = 1
+BULK = 2
+CLASS_NAMES = ('control', 'telemetry', 'bulk')
+
+STRICT = 0
+WEIGHTED = 1
+
+class TxClass(object):
+    def __init__(self, name, limit, policy, weight, deadline):
+        self.name = name
+        # [t_queued, deadline (ms, or None), data, dest, ack, done]
+        self.q = BoundedFIFO(limit, policy)
+        self.weight = weight
+        self.deadline = deadline        # default, ms; None for none
+        self.deficit = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.queued = 0
+        self.sent = 0
+        self.expired = 0
+        self.rejected = 0       # refused when full
+        self.dropped = 0        # pushed out by newer ones (DROP_OLDEST)
+        self.bytes_sent = 0
+        self.max_wait = 0       # longest ms from send() to sent
+        self.q.reset_counters()
+
+    def stats(self):
+        return { 'waiting': len(self.q),
+                 'queued': self.queued,
+                 'sent': self.sent,
+                 'bytes_sent': self.bytes_sent,
+                 'expired': self.expired,
+                 'dropped': self.dropped,
+                 'rejected': self.rejected,
+                 'high_water': self.q.high_water,
+                 'max_wait': self.max_wait }
+
+
+class TxQueues(SleepScheduler):
+    def __init__(self, radio, mode=STRICT, limits=(16, 32, 64),
+                 policies=(BACKPRESSURE, DROP_OLDEST, BACKPRESSURE),
+                 weights=(8, 4, 1), deadlines=(None, None, None),
+                 quantum=64, reserve=1):
+        # WEIGHTED would go round forever waiting for a class with no
+        # weight to earn enough to send
+        if min(weights) < 1:
+            raise ValueError("weights must be at least 1")
+        if quantum < 1:
+            raise ValueError("quantum must be at least 1")
+        self.radio = radio
+        self.mode = mode
+        self.classes = [TxClass(CLASS_NAMES[i], limits[i], policies[i], weights[i],
+                                deadlines[i]) for i in range(len(CLASS_NAMES))]
+        self.quantum = quantum  # bytes a class may send per unit of weight per round
+        self.reserve = reserve  # window slots only control may use
+        self.turn = 0           # WEIGHTED: the class whose turn it is
+        self.woke_at = radio.woke_at
+        self.reset_stats()
+
+    def reset_stats(self):
+        SleepScheduler.reset_stats(self)
+        for c in self.classes:
+            c.reset_stats()
+
+    def stats(self):
+        st = SleepScheduler.stats(self)
+        st['dropped'] = sum(c.dropped for c in self.classes)
+        for c in self.classes:
+            st[c.name] = c.stats()
+        return st
+
+    def __len__(self):
+        return sum(len(c.q) for c in self.classes)
+
+    def send(self, data, dest_address=None, cls=TELEMETRY, deadline=None, ack=True,
+             done=None):
+        # Queue a message in class cls; returns False if it was refused
+        # (BACKPRESSURE, or DROP_NEWEST) for want of room
+        c = self.classes[cls]
+        q = c.q
+        if q.full():
+            if q.policy != DROP_OLDEST:
+                c.rejected += 1
+                self.rejected += 1
+                return False
+            # Push the oldest out here rather than in put(), so that its
+            # done callback hears of it
+            c.dropped += 1
+            self.dropped(q.get())
+        if dest_address is None:
+            dest_address = self.radio.correspondent_address
+        if deadline is None:
+            deadline = c.deadline
+        q.put([millis(), deadline, data, dest_address, ack, done])
+        c.queued += 1
+        self.queued += 1
+        if len(self) > self.high_water:
+            self.high_water = len(self)
+        return True
+
+    def expire(self):
+        # Drop the messages that can no longer make their deadlines
+        until_wake = self.until_wake()
+        for c in self.classes:
+            q = c.q
+            for i in range(len(q)):
+                e = q.get()
+                if self.too_late(e, until_wake):
+                    c.expired += 1
+                    self.expired += 1
+                    self.dropped(e)
+                else:
+                    q.put(e)
+
+    def may_send(self, c):
+        # Whether class c may take a transmit window slot now
+        tracker = self.radio.tx_tracker
+        if c is self.classes[CONTROL]:
+            return not tracker.window_full()
+        return tracker.outstanding < max(tracker.window - self.reserve, 1)
+
+    def pick(self):
+        # The class to send from next, or None
+        if self.mode == STRICT:
+            for c in self.classes:
+                if len(c.q):
+                    return c if self.may_send(c) else None
+            return None
+        # Deficit round robin, by bytes
+        ready = [c for c in self.classes if len(c.q) and self.may_send(c)]
+        if not ready:
+            return None
+        cs = self.classes
+        while True:
+            c = cs[self.turn]
+            if c in ready:
+                n = len(c.q.peek()[2])
+                if n <= c.deficit:
+                    c.deficit -= n
+                    return c
+                c.deficit += self.quantum * c.weight
+            elif not len(c.q):
+                c.deficit = 0   # an idle class doesn't save up
+            self.turn = (self.turn + 1) % len(cs)
+
+    def take(self):
+        # The next message to send now, or None
+        c = self.pick()
+        if c is None:
+            return None
+        e = c.q.get()
+        c.sent += 1
+        c.bytes_sent += len(e[2])
+        wait = elapsed_millis(e[0])
+        if wait > c.max_wait:
+            c.max_wait = wait
+        return e
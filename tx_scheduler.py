@@ -0,0 +1,166 @@
+# Holds transmits while a cyclic-sleep network is asleep, and sends
+# them in a burst when it wakes, most urgent first.
+#
+#   sched = SleepScheduler(xb)
+#   sched.send(b'telemetry', dest, priority=1, deadline=2000)
+#   while True:
+#       sched.service()             # instead of xb.service()
+#       ...
+#
+# The radio says when the network goes to sleep and wakes with Modem
+# Status 0x0C and 0x0B (see XBRadio.consume_modem_status()). While it
+# is awake, service() sends what is queued in order of priority (higher
+# first), then deadline (sooner first), then age, as fast as the
+# transmit window allows. A frame whose deadline passes before it can
+# be sent is dropped; so is one that, while the network sleeps, has a
+# deadline before the radio expects it to wake. Either way the frame's
+# done callback, if any, is called: with its frame ID once sent, or
+# with None if it was dropped.
+#
+# TxQueues (tx_queues.py) is a SleepScheduler that keeps its frames in
+# traffic classes instead, overriding send(), expire() and take(). An
+# entry there, as here, is a list that ends with t_queued, deadline (ms
+# after t_queued, or None), data, dest, ack, done. Deadlines are checked
+# with elapsed_millis(), so they hold across the wrap of millis().
+
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+from pyb import millis, elapsed_millis, wfi
+
+class SleepScheduler(object):
+    def __init__(self, radio, capacity=64):
+        self.radio = radio
+        self.capacity = capacity
+        # [-priority, no deadline, due, seq, t_queued, deadline, data,
+        # dest, ack, done]. due is t_queued + deadline, to order by only
+        # (around the wrap of millis() the order can be off; expiry
+        # isn't). seq keeps the order of equals, and keeps the rest from
+        # being compared.
+        self.heap = []
+        self.seq = 0
+        self.woke_at = radio.woke_at    # wake window we last sent in
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.queued = 0
+        self.high_water = len(self)
+        self.sent = 0
+        self.expired = 0
+        self.rejected = 0       # refused for want of room
+        self.bursts = 0         # wake windows we sent in
+
+    def stats(self):
+        return { 'queued': self.queued,
+                 'waiting': len(self),
+                 'high_water': self.high_water,
+                 'sent': self.sent,
+                 'expired': self.expired,
+                 'rejected': self.rejected,
+                 'bursts': self.bursts }
+
+    def __len__(self):
+        return len(self.heap)
+
+    def send(self, data, dest_address=None, priority=0, deadline=None, ack=True,
+             done=None):
+        # Queue a frame to go when the network is awake, within deadline
+        # ms if given. Returns False if there was no room for it.
+        if len(self.heap) >= self.capacity:
+            self.rejected += 1
+            return False
+        if dest_address is None:
+            dest_address = self.radio.correspondent_address
+        now = millis()
+        self.seq += 1
+        heapq.heappush(self.heap, [-priority, deadline is None,
+                                   0 if deadline is None else now + deadline,
+                                   self.seq, now, deadline, data, dest_address,
+                                   ack, done])
+        self.queued += 1
+        if len(self.heap) > self.high_water:
+            self.high_water = len(self.heap)
+        return True
+
+    def until_wake(self):
+        # ms until the radio expects the network to wake (going by how
+        # long it slept last time), or None if it is awake or can't say
+        radio = self.radio
+        if not radio.asleep or radio.sleep_ms is None:
+            return None
+        left = radio.sleep_ms - elapsed_millis(radio.slept_at)
+        if left < 0:
+            return None         # late waking; no telling when
+        return left
+
+    def too_late(self, e, until_wake):
+        # Whether entry e can no longer make its deadline
+        deadline = e[-5]
+        if deadline is None:
+            return False
+        waited = elapsed_millis(e[-6])
+        if until_wake is not None:
+            waited += until_wake
+        return waited > deadline
+
+    def dropped(self, e):
+        # e won't be sent: tell its sender
+        if e[-1] is not None:
+            e[-1](None)
+
+    def expire(self):
+        # Drop the frames that can no longer make their deadlines
+        until_wake = self.until_wake()
+        keep = []
+        for e in self.heap:
+            if self.too_late(e, until_wake):
+                self.expired += 1
+                self.dropped(e)
+            else:
+                keep.append(e)
+        if len(keep) < len(self.heap):
+            heapq.heapify(keep)
+            self.heap = keep
+
+    def take(self):
+        # The next entry to send now, or None
+        if self.heap and not self.radio.tx_tracker.window_full():
+            return heapq.heappop(self.heap)
+        return None
+
+    def service(self):
+        # Process what the radio has, then send what may go now.
+        # Returns the number of frames sent.
+        radio = self.radio
+        radio.service()
+        if not len(self):
+            return 0
+        self.expire()
+        if radio.asleep:
+            return 0
+        n = 0
+        while True:
+            e = self.take()
+            if e is None:
+                break
+            frame_id = radio.tx(e[-4], e[-3], e[-2], flush=False)
+            self.sent += 1
+            n += 1
+            if e[-1] is not None:
+                e[-1](frame_id)
+        if n:
+            radio.flush_tx()
+            if radio.woke_at != self.woke_at:
+                self.woke_at = radio.woke_at
+                self.bursts += 1
+        return n
+
+    def drain(self, timeout=1000):
+        # Service until everything queued has gone (or expired), or for
+        # timeout ms. Returns True if the queue emptied.
+        t0 = millis()
+        while len(self) and elapsed_millis(t0) < timeout:
+            if not self.service():
+                wfi()
+        return not len(self)
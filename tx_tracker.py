@@ -0,0 +1,114 @@
+# Keeps track of transmitted frames by frame ID until their Transmit
+# Status (0x8B) comes back, so callers can find out whether a tx() was
+# delivered, and can cap how many are outstanding at once.
+
+TX_LOST = -1        # status given to a frame whose Transmit Status never came
+
+class TxResult(object):
+    __slots__ = ('frame_id', 'dest', 't_sent', 'latency', 'retries', 'status',
+                 'discovery', 'dest16')
+
+    def __init__(self, frame_id, dest, t_sent):
+        self.frame_id = frame_id
+        self.dest = dest
+        self.t_sent = t_sent
+        self.latency = None     # ms from sending to Transmit Status
+        self.retries = 0
+        self.status = None      # None while pending, else the delivery status
+        self.discovery = 0
+        self.dest16 = None
+
+    def done(self):
+        return self.status is not None
+
+    def ok(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return "<TxResult id 0x%x status %r retries %d latency %r>" \
+            % (self.frame_id, self.status, self.retries, self.latency)
+
+
+class TxTracker(object):
+    def __init__(self, window=8, status_timeout=5000):
+        if not 1 <= window <= 254:
+            raise ValueError("window must be 1..254")
+        self.window = window            # most frames awaiting status at once
+        self.status_timeout = status_timeout
+        self.entries = {}               # frame ID -> TxResult
+        self.outstanding = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Totals
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self.lost = 0
+        self.total_retries = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def window_full(self):
+        return self.outstanding >= self.window
+
+    def pending(self, frame_id):
+        e = self.entries.get(frame_id)
+        return e is not None and e.status is None
+
+    def add(self, frame_id, dest, now):
+        e = self.entries.get(frame_id)
+        if e is not None and e.status is None:
+            self.outstanding -= 1
+        self.entries[frame_id] = TxResult(frame_id, dest, now)
+        self.outstanding += 1
+        self.sent += 1
+
+    def complete(self, frame_id, dest16, retries, status, discovery, now):
+        # A Transmit Status came in; returns its TxResult, or None if we
+        # weren't tracking the frame
+        e = self.entries.get(frame_id)
+        if e is None or e.status is not None:
+            return None
+        e.dest16 = dest16
+        e.retries = retries
+        e.status = status
+        e.discovery = discovery
+        e.latency = now - e.t_sent
+        self.outstanding -= 1
+        self.total_retries += retries
+        self.total_latency += e.latency
+        if e.latency > self.max_latency:
+            self.max_latency = e.latency
+        if status == 0:
+            self.delivered += 1
+        else:
+            self.failed += 1
+        return e
+
+    def expire(self, now):
+        # Give up on frames whose status is overdue, freeing their window slot
+        for e in self.entries.values():
+            if e.status is None and now - e.t_sent > self.status_timeout:
+                e.status = TX_LOST
+                e.latency = now - e.t_sent
+                self.outstanding -= 1
+                self.lost += 1
+
+    def lose_all(self, now):
+        # Give up on every frame awaiting status (e.g. the radio was reset)
+        for e in self.entries.values():
+            if e.status is None:
+                e.status = TX_LOST
+                e.latency = now - e.t_sent
+                self.outstanding -= 1
+                self.lost += 1
+
+    def poll(self, frame_id):
+        # The TxResult once the frame is done (and forgotten), else None.
+        # KeyError if the frame isn't known.
+        e = self.entries[frame_id]
+        if e.status is None:
+            return None
+        del self.entries[frame_id]
+        return e
@@ -1,5 +1,16 @@
-from pyb import SPI, Pin
-from pyb import delay, millis, elapsed_millis
+from pyb import SPI, Pin, ExtInt
+from pyb import delay, millis, elapsed_millis, wfi
+from micropython import schedule
+from packet_buffer import PacketException, ChecksumError, FrameTooLongError, \
+    RingFullError, PacketBuffer, RingPacketBuffer
+from fifo import BoundedFIFO, DROP_OLDEST, DROP_NEWEST, BACKPRESSURE
+from tx_buffer import TxBuffer
+from tx_tracker import TxTracker, TxResult, TX_LOST
+from spi_capture import CaptureSPI
+from address_cache import AddressCache
+from neighbours import Neighbour, NeighbourTable, parse_ND
+from frames import decode, FRAME_TYPES, ATResponse, ModemStatus, TransmitStatus, \
+    RxIndicator, NodeIdentification, RemoteATResponse
 
 class RadioException(Exception):
     pass
@@ -13,106 +24,50 @@ class SpiCommError(RadioException):
 class PacketOverrunError(RadioException):
     pass
 
+class TxWindowFull(RadioException):
+    pass
+
+class ATCommandError(RadioException):
+    pass
+
 #class ShortPacket(RadioException):
 #    pass
 #class BadChecksum(RadioException):
 #    pass
 
-class PacketException(Exception):
-    pass
-
-class ChecksumError(PacketException):
-    pass
-
 def big_endian_int(b):
     rv = 0
     for v in list(b):
         rv = (rv << 8) + int(v)
     return rv
 
-class PacketBuffer(object):
-    def __init__(self):
-        self.packets = []
-        self.reset_parse()
-        self.total_marking_bytes_count = 0
-        self.marking_bytes_count = 0
-        self.packet_count = 0
-
-    def reset_parse(self):
-        self.packet_buf = b''
-        # 0: looking for new packet
-        # 1: found sync ('~')
-        # 2: have first byte of payload length
-        # 3: have payload length, gathering payload
-        # 4: have full payload, need check byte
-        self.state = 0
-
-    def __len__(self):
-        return len(self.packets)
-
-    def __iter__(self):
-        return iter(self.packets)
-
-    def dequeue_one(self):
-        return self.packets.pop(0)
-
-    def include_bytes(self, b):
-        while len(b):
-            if self.state is 0:
-                marking, sync, b = b.partition(b'~')
-                self.total_marking_bytes_count += len(marking)
-                if sync:
-                    self.marking_bytes_count = 0
-                    self.state = 1
-                else:
-                    self.marking_bytes_count += len(marking)
-            if self.state is 1:
-                if len(b):
-                    self.payload_length = b[0]
-                    b = b[1:]
-                    self.state = 2
-            if self.state is 2:
-                if len(b):
-                    self.payload_length <<= 8
-                    self.payload_length += b[0]
-                    b = b[1:]
-                    self.state = 3
-            if self.state is 3:
-                # Try to get the bytes we need to make the length
-                want = self.payload_length - len(self.packet_buf)
-                self.packet_buf += b[:want]
-                b = b[want:]
-                if len(self.packet_buf) == self.payload_length:
-                    self.state = 4
-            if self.state is 4:
-                if len(b):
-                    check_byte = b[0]
-                    b = b[1:]
-                    if (sum(self.packet_buf) & 0xff) + check_byte != 0xff:
-                        self.bad = (self.packet_buf, check_byte)
-                        self.reset_parse()
-                        raise ChecksumError("sum(packet) = 0x%x, check_byte = 0x%x" \
-                                          % (sum(self.bad[0]), self.bad[1]))
-                    self.packets.append(self.packet_buf)
-                    self.packet_count += 1
-                    self.packet_buf = b''
-                    self.state = 0
-
-    def in_a_packet(self):
-        return bool(self.state)
-
-# Don't optimize prematurely:
-#    def bytes_needed_to_finish_next_packet(self):
-#        return 0                # FIXME
+# The SPI prescaler to use when none is given. prescaler=SAVED uses the
+# one calibrate.py last found and saved in PRESCALER_FILE instead (else
+# DEFAULT_PRESCALER); nothing is read from the file unless asked for.
+DEFAULT_PRESCALER = 128
+SAVED = 'saved'
+PRESCALER_FILE = 'xbspi.cfg'
+
+def saved_prescaler(path=PRESCALER_FILE):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return DEFAULT_PRESCALER
+
+def save_prescaler(prescaler, path=PRESCALER_FILE):
+    with open(path, 'w') as f:
+        f.write('%d\n' % prescaler)
 
 
 # Hardware interface
 class XBRHAL:
     #atplzero = b'\x08\x03PL\x00'
-    int_AT = set('DB,TP,%V,PL'.split(','))
+    int_AT = set('DB,TP,%V,PL,NP'.split(','))
     str_AT = set('NI,VL'.split(','))
     
-    def __init__(self, spi, nRESET, DOUT, nSSEL, nATTN):
+    def __init__(self, spi, nRESET, DOUT, nSSEL, nATTN, rx_ring_size=0,
+                 tx_buffer_size=1024, prescaler=None):
 
         # init the SPI bus and pins
         # XBee Pro manual says (p22) "SPI Clock rates up to 3.5 MHz are possible"
@@ -124,7 +79,15 @@ class XBRHAL:
         # prescaler=256 with delay_after_nATTN=1 ok (tested 340k packets)
         # prescaler=128 with delay_after_nATTN=0 ok (tested 310k packets)
         # prescaler=64 failed after of order 1000 packets
-        spi.init(SPI.MASTER, prescaler=128, polarity=0)
+        # How fast is safe varies with the board and wiring, so
+        # calibrate.py finds it for each, and saves it for next time
+        # (prescaler=SAVED).
+        if prescaler is None:
+            prescaler = DEFAULT_PRESCALER
+        elif prescaler == SAVED:
+            prescaler = saved_prescaler()
+        self.spi = spi
+        self.set_prescaler(prescaler)
 
         nRESET.init(nRESET.OUT_OD, nRESET.PULL_UP)
         DOUT.init(DOUT.OUT_OD, DOUT.PULL_UP)
@@ -135,81 +98,259 @@ class XBRHAL:
             p.high()
 
         # store the pins
-        self.spi = spi
         self.nRESET = nRESET
         self.DOUT = DOUT
         self.nSSEL = nSSEL
         self.nATTN = nATTN
 
         # helper
-        self.pb = PacketBuffer()
+        # rx_ring_size nonzero parses in place in a preallocated ring of
+        # that many bytes, and get_packet() returns memoryviews into it
+        self.rx_ring_size = rx_ring_size
+        self.pb = self.new_packet_buffer()
+
+        # Outgoing frames are built in txb and clocked out together by
+        # flush_tx(); what the radio sends meanwhile lands in tx_miso
+        self.txb = TxBuffer(tx_buffer_size)
+        self.tx_miso = memoryview(bytearray(tx_buffer_size))
 
         # init tuneable parameters
-        self.rx_hunk_len = 16
+        self.length_aware_reads = True
+        self.rx_hunk_len = 16   # when not length_aware_reads
+        self.rx_marking_limit = 64 # bytes beyond a frame to read before giving up
+        self.boot_timeout = 500 # ms from reset to the radio's Modem Status
         #self.delay_after_nATTN = 0 # How long after nATTN asserted before reading
 
+        # interrupt-driven receive
+        self.extint = None
+        self.rx_handler = None
+        self.rx_gate = None     # if set and it returns False, leave frames in the radio
+        self.on_reset = None    # if set, called after every hard_reset()
+        self.busy = False
+        self.drain_scheduled = False
+        self.drain_pending = False
+        self._drain_ref = self._scheduled_drain # ISR mustn't allocate a bound method
+
+        # Wedge recovery: each wedge signature (see recover()) with no
+        # good frame read since the last takes the next stage
+        self.wedge_level = 0
+
         self.verbose = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Plain integer counters, cheap enough to keep up always
+        self.spi_bytes_read = 0
+        self.spi_bytes_written = 0
+        self.spi_reads = 0      # receive transactions
+        self.spi_writes = 0     # transmit transactions (which also receive)
+        self.overruns = 0
+        self.attn_timeouts = 0  # get_packet() waits that ran out
+        self.attn_wait_ms = 0   # time spent waiting for nATTN
+        self.drains = 0
+        self.irq_rx_errors = 0
+        self.resets = 0
+        self.wedges = {}        # signature -> times seen
+        self.recoveries = { 'resync': 0, 'reselect': 0, 'reset': 0 }
+        self.recovery_ms = 0    # time spent recovering
+        self.recovery_max_ms = 0
+        self.pb.reset_stats()
+
+    def stats(self):
+        # Snapshot of the counters, and of the packet buffer's as 'rx'
+        return { 'spi_bytes_read': self.spi_bytes_read,
+                 'spi_bytes_written': self.spi_bytes_written,
+                 'spi_reads': self.spi_reads,
+                 'spi_writes': self.spi_writes,
+                 'overruns': self.overruns,
+                 'attn_timeouts': self.attn_timeouts,
+                 'attn_wait_ms': self.attn_wait_ms,
+                 'drains': self.drains,
+                 'irq_rx_errors': self.irq_rx_errors,
+                 'resets': self.resets,
+                 'wedges': dict(self.wedges),
+                 'recoveries': dict(self.recoveries),
+                 'recovery_ms': self.recovery_ms,
+                 'recovery_max_ms': self.recovery_max_ms,
+                 'rx': self.pb.stats() }
+
+    def set_prescaler(self, prescaler):
+        # SPI clock is the APB bus clock / prescaler (a power of two)
+        self.prescaler = prescaler
+        self.spi.init(SPI.MASTER, prescaler=prescaler, polarity=0)
+
+    def new_packet_buffer(self):
+        if self.rx_ring_size:
+            return RingPacketBuffer(self.rx_ring_size)
+        return PacketBuffer()
 
     def hard_reset(self):
+        # Reset the radio. Frames already received are kept; a partial
+        # one, and anything read but not yet parsed, are not.
+        self.resets += 1
+        self.wedge_level = 0
+        self.pb.resync(discard=True)
         self.force_SPI()
-        self.pb = PacketBuffer() # lose the old one
+        if self.on_reset is not None:
+            self.on_reset()
 
     def force_SPI(self):
         # reset and force the XBee into SPI mode
+        # Raises SpiCommError if it doesn't come up within boot_timeout ms
         self.nRESET.low()
         self.DOUT.low()
         delay(10)
         self.nRESET.high()
         #delay(100)              # Without nATTN watch loop, 85ms is unreliable. 100ms is ok.
-        #t0 = millis()
+        t0 = millis()
         while self.nATTN.value():
+            if elapsed_millis(t0) > self.boot_timeout:
+                self.DOUT.high()
+                raise SpiCommError("no nATTN %dms after reset" % self.boot_timeout)
             delay(1)
-        #print(elapsed_millis(t0))
         self.DOUT.high()
+
+    ################################################################
+    # Wedge recovery
+    #
+    # At higher SPI rates the radio can wedge: it holds nATTN asserted
+    # but clocks out only marking bytes, or the two ends lose byte sync
+    # and frames come in with bad lengths or checksums. Each such
+    # signature takes the next of these stages, cheapest first, until a
+    # good frame is read:
+    #   resync      drop the partial frame and hunt for the next '~' in
+    #               what was read after it (and then in what comes next)
+    #   reselect    deassert and reassert nSSEL, and resync
+    #   reset       hard_reset(), which costs about 100ms of link
+    # The signatures counted in wedges are
+    #   checksum    a frame's check byte was wrong
+    #   too_long    a frame's length couldn't be right
+    #   marking     part of a frame, then a run of marking bytes
+    #   attn_stuck  nATTN asserted, but nothing but marking bytes
+
+    recovery_stages = ('resync', 'reselect', 'reset')
+
+    def recover(self, signature):
+        # Take the next recovery stage on seeing a wedge signature
+        t0 = millis()
+        self.wedges[signature] = self.wedges.get(signature, 0) + 1
+        stage = self.recovery_stages[min(self.wedge_level, 2)]
+        self.wedge_level += 1
+        if stage == 'resync':
+            self.pb.resync()
+            self.pb.parse_rest()
+        elif stage == 'reselect':
+            self.nSSEL.high()
+            delay(1)
+            self.nSSEL.low()
+            self.pb.resync()
+            self.pb.parse_rest()
+        else:
+            self.hard_reset()
+        self.recoveries[stage] += 1
+        ms = elapsed_millis(t0)
+        self.recovery_ms += ms
+        if ms > self.recovery_max_ms:
+            self.recovery_max_ms = ms
+        return stage
         
+    def start_capture(self, log):
+        # Record all SPI traffic, and nATTN, to log (a file opened 'wb');
+        # see spi_capture.py
+        if not isinstance(self.spi, CaptureSPI):
+            self.spi = CaptureSPI(self.spi, log, self.nATTN)
+        return self.spi
+
+    def stop_capture(self):
+        if isinstance(self.spi, CaptureSPI):
+            self.spi = self.spi.spi
+
+    def get_packet_by_reading(self):
+        # Get a packet from the radio itself
+        # Reads the sync and length first, then exactly the rest of the
+        # frame and its check byte in one transaction (or fixed hunks of
+        # rx_hunk_len if length_aware_reads is off). Gives up once it
+        # has read rx_marking_limit bytes more than the frame needs.
+        # A bad frame or an overrun is recovered from (see recover()) before
+        # the exception is passed on; the caller need only try again.
+        self.nSSEL.low()
+        gotten = 0
+        pb = self.pb
+        limit = self.rx_marking_limit
+        if pb.state >= 3:
+            limit += pb.bytes_needed_to_finish_next_packet()
+        while len(pb) == 0 and gotten < limit: # feed the packet buffer until packet(s) available
+            if self.length_aware_reads:
+                n = pb.bytes_needed_to_finish_next_packet()
+            else:
+                n = self.rx_hunk_len
+            in_frame = pb.state >= 3
+            try:
+                pb.readinto(self.spi.recv, n)
+            except ChecksumError:
+                self.spi_reads += 1
+                self.spi_bytes_read += gotten + n
+                self.recover('checksum')
+                raise
+            except FrameTooLongError:
+                self.spi_reads += 1
+                self.spi_bytes_read += gotten + n
+                self.recover('too_long')
+                raise
+            gotten += n
+            if not in_frame and pb.state >= 3:
+                # Now we know how long the frame is
+                limit = gotten + self.rx_marking_limit \
+                    + pb.bytes_needed_to_finish_next_packet()
+            if self.verbose:
+                print("get_packet_by_reading(): State %d, gotten %d, marking bytes %d, total marking %d" %
+                      (pb.state,
+                       gotten,
+                       pb.marking_bytes_count,
+                       pb.total_marking_bytes_count))
+        self.spi_reads += 1
+        self.spi_bytes_read += gotten
+        if len(pb) == 0:
+            self.overruns += 1
+            if pb.in_a_packet():
+                self.recover('marking')
+            else:
+                self.recover('attn_stuck')
+            raise PacketOverrunError("got %d bytes and don't have a packet yet" % gotten)
+        self.wedge_level = 0
+        return pb.dequeue_one()
+
     def get_packet(self, timeout=100):
         # Get a packet from the radio
         # or raise PacketWaitTimeout if none available in specified time
 
-        def get_packet_by_reading():
-            # Helper to get a packet from the radio itself
-            # Note it will spin forever if the radio has no packet
-            self.nSSEL.low()
-            gotten = 0
-            while len(self.pb) == 0 and gotten < 300: # feed the packet buffer until packet(s) available
-                self.pb.include_bytes(self.spi.recv(self.rx_hunk_len))
-                # DEBUG
-                gotten += self.rx_hunk_len
-                if self.verbose:
-                    print("get_packet_by_reading(): State %d, gotten %d, marking bytes %d, total marking %d" %
-                          (self.pb.state,
-                           gotten,
-                           self.pb.marking_bytes_count,
-                           self.pb.total_marking_bytes_count))
-            if gotten >= 300:
-                raise PacketOverrunError("got %d bytes and don't have a packet yet" % gotten)
-            return self.pb.dequeue_one()
-
         # From the packet buffer if available
         if len(self.pb):
             return self.pb.dequeue_one()
         # else if part way into a packet, get the rest
         if self.pb.in_a_packet():
-            return get_packet_by_reading()
+            return self.get_packet_by_reading()
         # else see if one turns up within the timeout
         if self.nATTN.value():  # No data available from radio yet
             # wait up to the timeout value
             t0 = millis()
             while self.nATTN.value():
                 if elapsed_millis(t0) > timeout:
+                    self.attn_timeouts += 1
+                    self.attn_wait_ms += elapsed_millis(t0)
                     raise PacketWaitTimeout("%dms" % timeout)
                 #delay(self.delay_after_nATTN) # Does this help? No.
+            self.attn_wait_ms += elapsed_millis(t0)
             # Here nATTN is in asserted state
             # drop thru instead: return get_packet_by_reading()
         assert not self.nATTN.value(), 'expected nATTN to be low'
         #delay(10)                # DEBUG: does this help?
-        return get_packet_by_reading()
+        return self.get_packet_by_reading()
+
 
+    def packet_ready(self):
+        # True if a frame can be had without waiting for the radio
+        return bool(len(self.pb) or self.pb.in_a_packet() or not self.nATTN.value())
 
     def flush(self):
         # Flush out all readily-available received radio packets
@@ -220,18 +361,120 @@ class XBRHAL:
                 break
 
     def send_packet(self, buf):
-        # Wrap a packet in an API frame and send to the radio
-        # Radio may be sending a frame to us at the same time
+        # Wrap a packet in an API frame and send to the radio, along with
+        # any frames already waiting in txb
         #print("send_packet(%r)" % buf)
-        header = bytearray(3)
-        hv = memoryview(header)
-        hv[0] = ord('~')
-        hv[1] = len(buf) >> 8
-        hv[2] = len(buf) & 0xff
-        self.nSSEL.low()
-        self.pb.include_bytes(self.spi.send_recv(header))
-        self.pb.include_bytes(self.spi.send_recv(buf))
-        self.pb.include_bytes(self.spi.send_recv(0xff - (sum(buf) & 0xff)))
+        if self.txb.room() < len(buf):
+            self.flush_tx()
+        self.txb.frame(buf)
+        self.flush_tx()
+
+    def flush_tx(self):
+        # Send every frame in txb in one SPI transaction
+        # Radio may be sending a frame to us at the same time
+        n = len(self.txb)
+        if not n:
+            return
+        was_busy = self.busy
+        self.busy = True
+        try:
+            self.nSSEL.low()
+            miso = self.tx_miso[:n]
+            self.spi.send_recv(self.txb.view(), miso)
+            self.spi_writes += 1
+            self.spi_bytes_written += n
+            self.spi_bytes_read += n
+            self.txb.clear()
+            while True:
+                # The frames went out; a bad one coming in is recovered
+                # from here, and parsing goes on with what followed it
+                try:
+                    self.pb.include_bytes(miso)
+                    break
+                except ChecksumError:
+                    self.recover('checksum')
+                except FrameTooLongError:
+                    self.recover('too_long')
+                except RingFullError:
+                    # Unread frames left no room for what the radio sent
+                    # meanwhile; the rest of it is lost (the ring counts
+                    # it) and parsing starts again at the next '~'
+                    self.pb.resync()
+                    break
+                miso = b''
+        finally:
+            self.busy = was_busy
+        if self.rx_handler is not None and not self.busy \
+           and (self.drain_pending or len(self.pb)):
+            self.drain()
+
+    ################################################################
+    # Interrupt-driven receive
+    #
+    # A falling edge on nATTN schedules drain(), which reads everything
+    # the radio has into the PacketBuffer and hands each frame to the
+    # handler, so nobody has to poll. The ISR itself only schedules (it
+    # can't allocate); the busy flag keeps a drain from cutting into an
+    # SPI transaction the main program is part way through.
+
+    def enable_irq_rx(self, handler):
+        self.rx_handler = handler
+        if self.extint is None:
+            self.extint = ExtInt(self.nATTN, ExtInt.IRQ_FALLING, Pin.PULL_UP,
+                                 self._nATTN_irq)
+        else:
+            self.extint.enable()
+        self.drain()            # nATTN may already be low; no edge will come
+
+    def disable_irq_rx(self):
+        if self.extint is not None:
+            self.extint.disable()
+        self.rx_handler = None
+
+    def _nATTN_irq(self, line):
+        if self.drain_scheduled:
+            return
+        self.drain_scheduled = True
+        try:
+            schedule(self._drain_ref, 0)
+        except RuntimeError:    # schedule queue full
+            self.drain_scheduled = False
+            self.drain_pending = True
+
+    def _scheduled_drain(self, arg):
+        self.drain_scheduled = False
+        self.drain()
+
+    def drain(self):
+        # Read all available frames and pass them to the handler
+        if self.rx_handler is None:
+            return
+        if self.busy:
+            self.drain_pending = True
+            return
+        self.busy = True
+        self.drain_pending = False
+        self.drains += 1
+        try:
+            while True:
+                if self.rx_gate is not None and not self.rx_gate():
+                    break
+                try:
+                    if len(self.pb):
+                        b = self.pb.dequeue_one()
+                    elif self.pb.in_a_packet() or not self.nATTN.value():
+                        b = self.get_packet_by_reading()
+                    else:
+                        break
+                except (ChecksumError, FrameTooLongError):
+                    self.irq_rx_errors += 1
+                    continue
+                except PacketOverrunError:
+                    self.irq_rx_errors += 1
+                    break
+                self.rx_handler(b)
+        finally:
+            self.busy = False
 
     # for debugging
     def show(self):
@@ -244,18 +487,74 @@ class XBRHAL:
 
 class XBRadio:
     #atplzero = b'\x08\x03PL\x00'
-    int_AT = set('DB,TP,%V,PL'.split(',')) # AT commands that have integer responses
+    int_AT = set('DB,TP,%V,PL,NP'.split(',')) # AT commands that have integer responses
     str_AT = set('NI,VL'.split(',')) # AT commands that have string responses
 
-    def __init__(self, spi, nRESET, DOUT, nSSEL, nATTN):
-        self.xcvr = XBRHAL(spi, nRESET, DOUT, nSSEL, nATTN)
+    def __init__(self, spi, nRESET, DOUT, nSSEL, nATTN, rx_ring_size=0,
+                 rx_queue_len=32, rx_policy=DROP_OLDEST, tx_buffer_size=1024,
+                 tx_window=8, prescaler=None, address_cache=32):
+        self.xcvr = XBRHAL(spi, nRESET, DOUT, nSSEL, nATTN, rx_ring_size,
+                           tx_buffer_size, prescaler)
         self.xcvr.hard_reset()
 
-        self.received_data_packets = []
+        # Received (address, data), oldest first. With BACKPRESSURE, AT
+        # replies, Transmit Status and the like are read as usual while
+        # this is full; a data frame that comes then is held in rx_held,
+        # and frames are left in the radio until there's room for it.
+        self.received_data_packets = BoundedFIFO(rx_queue_len, rx_policy)
+        self.rx_held = None
+        # Handlers for received data by its first byte, and by the 64-bit
+        # address it came from (see subscribe()), ahead of the queue above
+        self.rx_by_tag = {}
+        self.rx_by_source = {}
+        if rx_policy == BACKPRESSURE:
+            self.xcvr.rx_gate = self.rx_room
         self.verbose = False
+        self.irq_rx = False
+        self.frames_processed = 0
+        # Frames awaiting Transmit Status; tx() waits up to
+        # tx_window_timeout ms for a free slot when tx_window are out
+        self.tx_tracker = TxTracker(tx_window)
+        self.tx_window_timeout = 1000
+        # (data, dest_address, ack) from tx() in the nATTN drain, where it
+        # can't wait for the window: sent by service() or the next tx()
+        self.tx_deferred = []
+        # 16-bit addresses of the radios we've heard from, for tx() to
+        # send with (address_cache 0 always leaves it to the radio)
+        self.addresses = AddressCache(address_cache) if address_cache else None
+        # The radios we know of, from discover() and Node Identification
+        self.neighbours = NeighbourTable()
+        self.ND_found = None    # what discover() has found so far
         self.frame_sequence = 1
         self.address = bytearray(8)
         self.values = {}
+        self.AT_replies = {}    # frame ID -> (cmd, status, data) of latest 0x88
+        # Remote AT commands awaiting their 0x97, frame ID -> when to give
+        # up on it (remote_AT_timeout ms after sending, unless told
+        # otherwise), and the replies, frame ID -> (source, cmd, status,
+        # data), at most max_remote_AT_replies of them uncollected (no
+        # fewer than remote_at_fanout() may have in flight)
+        self.remote_AT_pending = {}
+        self.remote_AT_replies = {}
+        self.remote_AT_timeout = 1000
+        self.max_remote_AT_replies = 128
+        # get_value() answers from self.values while they are younger
+        # than AT_ttl[cmd] ms
+        self.values_time = {}
+        self.AT_ttl = { 'TP': 1000, '%V': 1000, 'DB': 250 }
+        # Cyclic sleep, as told by modem status: whether the network is
+        # asleep, when it last went to sleep and woke, and how long the
+        # last sleep and wake periods were (None until seen)
+        self.modem_status = None
+        self.asleep = False
+        self.slept_at = None
+        self.woke_at = None
+        self.sleep_ms = None
+        self.wake_ms = None
+        self.reset_stats()
+        # The HAL resets the radio itself as a last resort (see
+        # XBRHAL.recover()); what the radio had in hand is gone then
+        self.xcvr.on_reset = self.radio_was_reset
 #        self.correspondent_address = bytes(16)
 
 	# set up packet parsing dispatch functions
@@ -270,31 +569,174 @@ class XBRadio:
         self.frame_dispatch = { 0x88: self.try_to_consume_AT_response,
                                 0x8a: self.consume_modem_status,
                                 0x8b: self.consume_transmit_status,
-                                0x90: self.consume_rx
+                                0x90: self.consume_rx,
+                                0x95: self.consume_node_id,
+                                0x97: self.consume_remote_AT_response
         }
         
         self.AT_response_dispatch = { 'SH': self.consume_ATSH,
-                                      'SL': self.consume_ATSL }
+                                      'SL': self.consume_ATSL,
+                                      'ND': self.consume_ATND }
         self.request_MAC_from_radio()
         self.get_and_process_available_packets()
 
     def reset(self):
+        # Reset the radio; frames it had yet to send are lost
         self.xcvr.hard_reset()
 
+    def radio_was_reset(self):
+        # Forget what the radio will now never answer: transmits awaiting
+        # status are lost, AT replies not yet collected and remote AT
+        # commands awaiting theirs are dropped, and cached AT values may
+        # no longer hold
+        self.tx_tracker.lose_all(millis())
+        self.AT_replies.clear()
+        self.remote_AT_pending.clear()
+        self.remote_AT_replies.clear()
+        self.values.clear()
+        self.values_time.clear()
+
+    def reset_stats(self):
+        self.frame_counts = {}  # frame type -> frames received
+        self.unconsumed_frames = 0
+        self.rx_errors = 0      # frames lost to bad reads (see XBRHAL.recover())
+        self.rx_dispatched = 0  # received packets passed to subscribed handlers
+        self.tx_failures = {}   # Transmit Status delivery status -> count
+        self.tx_window_waits = 0
+        self.tx_window_wait_ms = 0
+        self.tx_timeouts = 0
+        self.tx_deferrals = 0   # tx() calls put off until after the drain
+        self.AT_errors = 0
+        self.AT_timeouts = 0
+        self.AT_cache_hits = 0
+        self.AT_cache_misses = 0
+        self.remote_AT_expired = 0  # given up on with nobody collecting them
+        self.remote_AT_dropped = 0  # replies pushed out uncollected
+        self.ND_malformed = 0   # ATND replies too short or garbled to use
+        self.tx_tracker.reset_stats()
+        if self.addresses is not None:
+            self.addresses.reset_stats()
+        self.neighbours.reset_stats()
+        self.received_data_packets.reset_counters()
+        self.xcvr.reset_stats()
+
+    def stats(self):
+        # Snapshot of where the radio's time and frames went; the
+        # hardware interface's counters are under 'hal'
+        t = self.tx_tracker
+        q = self.received_data_packets
+        return { 'frames': dict(self.frame_counts),
+                 'unconsumed_frames': self.unconsumed_frames,
+                 'rx_errors': self.rx_errors,
+                 'rx_dispatched': self.rx_dispatched,
+                 'rx_queued': len(q),
+                 'rx_high_water': q.high_water,
+                 'rx_dropped': q.dropped,
+                 'tx_sent': t.sent,
+                 'tx_delivered': t.delivered,
+                 'tx_failed': t.failed,
+                 'tx_failures': dict(self.tx_failures),
+                 'tx_lost': t.lost,
+                 'tx_retries': t.total_retries,
+                 'tx_outstanding': t.outstanding,
+                 'tx_max_latency': t.max_latency,
+                 'tx_window_waits': self.tx_window_waits,
+                 'tx_window_wait_ms': self.tx_window_wait_ms,
+                 'tx_timeouts': self.tx_timeouts,
+                 'tx_deferrals': self.tx_deferrals,
+                 'AT_errors': self.AT_errors,
+                 'AT_timeouts': self.AT_timeouts,
+                 'AT_cache_hits': self.AT_cache_hits,
+                 'AT_cache_misses': self.AT_cache_misses,
+                 'remote_AT_expired': self.remote_AT_expired,
+                 'remote_AT_dropped': self.remote_AT_dropped,
+                 'ND_malformed': self.ND_malformed,
+                 'addresses': self.addresses.stats() if self.addresses else None,
+                 'neighbours': self.neighbours.stats(),
+                 'hal': self.xcvr.stats() }
+
+    def enable_irq_rx(self):
+        # Process frames as the radio raises nATTN, in the background,
+        # rather than when rx() and friends poll for them
+        self.irq_rx = True
+        self.xcvr.enable_irq_rx(self.handle_frame)
+
+    def disable_irq_rx(self):
+        self.xcvr.disable_irq_rx()
+        self.irq_rx = False
+
+    def service(self, limit=0):
+        # Process the frames the radio has ready now, without waiting
+        # for more (at most limit of them, if limit). Returns how many.
+        # With enable_irq_rx() frames are processed as they arrive, and
+        # this catches up on all of them: limit applies only when polling.
+        if self.remote_AT_pending:
+            self.expire_remote_AT(millis())
+        if self.irq_rx:
+            n = self.frames_processed
+            self.xcvr.drain()
+            self.send_deferred(False)
+            return self.frames_processed - n
+        n = 0
+        gate = self.xcvr.rx_gate
+        while self.xcvr.packet_ready() and (gate is None or gate()):
+            try:
+                b = self.xcvr.get_packet(timeout=0)
+            except (ChecksumError, FrameTooLongError, PacketOverrunError):
+                self.rx_errors += 1  # the HAL has recovered; go on
+                continue
+            self.handle_frame(b)
+            n += 1
+            if n == limit:
+                break
+        return n
+
+    def rx_room(self):
+        # The BACKPRESSURE gate: whether frames may be taken from the radio
+        held = self.rx_held
+        if held is not None:
+            q = self.received_data_packets
+            if q.full():
+                return False
+            q.put(held)
+            self.rx_held = None
+        return True
+
     def get_and_process_available_packets(self, timeout=100):
         # Consume and process packets from radio
-        while True:
+        if self.irq_rx:
+            # Frames are processed as they arrive; catch up on any
+            # pending, and if there are none sleep until one comes or
+            # the timeout is up
+            n = self.frames_processed
+            self.xcvr.drain()
+            t0 = millis()
+            while self.frames_processed == n and elapsed_millis(t0) < timeout:
+                wfi()
+            return
+        gate = self.xcvr.rx_gate
+        while gate is None or gate():
             try:
                 b = self.xcvr.get_packet(timeout=timeout)
             except PacketWaitTimeout:
                 break
+            except (ChecksumError, FrameTooLongError, PacketOverrunError):
+                self.rx_errors += 1
             else:
-                if self.verbose:
-                    self.print_response_frame(b)
-                v = self.process_packet(b)
-                if v and self.verbose:
-                    print("packet not consumed: ", end='')
-                    self.print_response_frame(b)
+                self.handle_frame(b)
+
+    def handle_frame(self, b):
+        self.frames_processed += 1
+        fc = self.frame_counts
+        fc[b[0]] = fc.get(b[0], 0) + 1
+        if self.verbose:
+            self.print_response_frame(b)
+        v = self.process_packet(b)
+        if v:
+            self.unconsumed_frames += 1
+        if v and self.verbose:
+            print("packet not consumed: ", end='')
+            self.print_response_frame(b)
 
     def process_packet(self, b):
         # Returns None if the packet was consumed, else returns the packet
@@ -305,160 +747,633 @@ class XBRadio:
             return b
 
     def consume_modem_status(self, b):
-        self.modem_status = b[1]
+        status = ModemStatus(b).status
+        self.modem_status = status
+        now = millis()
+        if status == ModemStatus.WENT_TO_SLEEP:
+            if not self.asleep and self.woke_at is not None:
+                self.wake_ms = now - self.woke_at
+            self.asleep = True
+            self.slept_at = now
+        elif status == ModemStatus.WOKE_UP:
+            if self.asleep and self.slept_at is not None:
+                self.sleep_ms = now - self.slept_at
+            self.asleep = False
+            self.woke_at = now
+        elif status in (ModemStatus.HW_RESET, ModemStatus.WATCHDOG_RESET):
+            self.asleep = False
+            self.slept_at = self.woke_at = self.sleep_ms = self.wake_ms = None
+
+    def next_wake(self):
+        # When (in millis()) the network should next wake, going by how
+        # long it slept last time, or None if it isn't asleep or we can't say
+        if not self.asleep or self.sleep_ms is None:
+            return None
+        return self.slept_at + self.sleep_ms
 
     def consume_transmit_status(self, b):
-        # What's worth doing here?
-        if (b[4] | b[5]):       # A retransmit or a status problem
+        f = TransmitStatus(b)
+        status = f.delivery_status
+        retries = f.retries
+        e = self.tx_tracker.complete(f.frame_id, f.dest16, retries, status,
+                                     f.discovery_status, millis())
+        if e is not None and self.addresses is not None:
+            if status == 0:
+                self.addresses.learn(e.dest, e.dest16)
+            else:
+                self.addresses.invalidate(e.dest)
+        if status:
+            self.tx_failures[status] = self.tx_failures.get(status, 0) + 1
+        if (retries | status) and self.verbose: # A retransmit or a status problem
             self.print_response_frame(b)
 
     def consume_rx(self, b):
         # Parse out (address, data) from a received RF packet and put in FIFO
-        # appendleft
-        self.received_data_packets.insert(0, (b[1:9], b[12:]))
+        # Copy out: b may be a view into the receive ring
+        f = RxIndicator(b)
+        source = bytes(f.source64)
+        if self.addresses is not None:
+            self.addresses.learn(source, f.source16)
+        self.neighbours.seen(source, millis())
+        data = bytes(f.data)
+        handler = self.rx_by_tag.get(data[0]) if data else None
+        if handler is None:
+            handler = self.rx_by_source.get(source)
+        if handler is None:
+            q = self.received_data_packets
+            if q.policy == BACKPRESSURE and q.full() and self.rx_held is None:
+                self.rx_held = (source, data)   # closes the gate (rx_room())
+            else:
+                q.put((source, data))
+        else:
+            self.rx_dispatched += 1
+            handler(source, data)
+
+    def subscribe(self, handler, tag=None, source=None):
+        # Have handler(source, data) called for each received packet whose
+        # data starts with the byte tag, or (give one or the other) that
+        # came from the 64-bit address source, instead of it being queued
+        # for rx(). A tag beats a source; what neither claims is queued as
+        # before. Subscribing again replaces the handler. Handlers run as
+        # frames are processed (in service(), rx() and the like, or the
+        # scheduled nATTN drain) and may tx(). In the drain tx() can't
+        # wait for the transmit window, nor cut into a frame the main
+        # program is building, so there it queues the packet for
+        # service() (or the next tx() outside the drain) and returns None
+        # instead of a frame ID.
+        if (tag is None) == (source is None):
+            raise ValueError("subscribe by tag or by source")
+        if tag is not None:
+            self.rx_by_tag[tag] = handler
+        else:
+            self.rx_by_source[bytes(source)] = handler
+
+    def unsubscribe(self, tag=None, source=None):
+        if tag is not None:
+            self.rx_by_tag.pop(tag, None)
+        if source is not None:
+            self.rx_by_source.pop(bytes(source), None)
 
     def try_to_consume_AT_response(self, b):
         # Function applied to AT response packets
         # returns its arg if not consumed
         rv = None
-        cmd = str(b[2:4], 'ASCII')
+        f = ATResponse(b)
+        cmd = f.command
         #print("Got AT response: %s" % cmd)
-        status = b[4]
-        if status is not 0:
-            print("bad status %d" % status)
+        status = f.status
+        data = bytes(f.data)
+        self.AT_replies[f.frame_id] = (cmd, status, data)
+        if status != 0:
+            self.AT_errors += 1
+            if self.verbose:
+                print("bad status %d" % status)
             return
-        data = b[5:]
         if cmd in self.AT_response_dispatch:
             self.AT_response_dispatch[cmd](cmd, data)
-        elif cmd in self.int_AT:
-            self.values[cmd] = big_endian_int(data)
-        elif cmd in self.str_AT:
-            self.values[cmd] = str(data, 'ASCII')
+        elif not data and (cmd in self.int_AT or cmd in self.str_AT):
+            # Reply to setting it: whatever we had is out of date
+            self.values.pop(cmd, None)
+            self.values_time.pop(cmd, None)
+        elif cmd in self.int_AT or cmd in self.str_AT:
+            self.values[cmd] = self.decode_AT_value(cmd, data)
+            self.values_time[cmd] = millis()
         else:
             rv = b
         return rv
 
+    def consume_node_id(self, b):
+        # A radio has joined or had its commissioning button pressed
+        f = NodeIdentification(b)
+        self.add_neighbour(Neighbour(bytes(f.remote64), f.remote16, f.ni, f.parent16,
+                                     f.device_type, None, f.profile_id,
+                                     f.manufacturer_id, None, millis()))
+
+    def add_neighbour(self, n):
+        self.neighbours.update(n)
+        if self.addresses is not None:
+            self.addresses.learn(n.address, n.address16)
+
+    def consume_remote_AT_response(self, b):
+        # Replies to frames nobody is waiting for any more are dropped
+        f = RemoteATResponse(b)
+        if self.remote_AT_pending.pop(f.frame_id, None) is None:
+            return
+        replies = self.remote_AT_replies
+        if len(replies) >= self.max_remote_AT_replies:
+            # Push out the one sent longest ago (IDs go out in sequence)
+            seq = self.frame_sequence
+            del replies[max(replies, key=lambda k: (seq - k) & 0xff)]
+            self.remote_AT_dropped += 1
+        replies[f.frame_id] = (bytes(f.source64), f.command,
+                               f.status, bytes(f.data))
+        if f.status != 0:
+            self.AT_errors += 1
+
+    def expire_remote_AT(self, now):
+        # Stop waiting on remote AT commands past their time, so that a
+        # reply that never comes doesn't hold its frame ID for good
+        pending = self.remote_AT_pending
+        for frame_id in [k for k in pending if now - pending[k] >= 0]:
+            del pending[frame_id]
+            self.remote_AT_expired += 1
+
+    def decode_AT_value(self, cmd, data):
+        if cmd in self.int_AT:
+            return big_endian_int(data)
+        if cmd in self.str_AT:
+            return str(data, 'ASCII')
+        return data
+
     def consume_ATSH(self, cmd, data):
         #print("High serial is %s" % ' '.join("%x" % v for v in data))
         self.address = data[0:4] + self.address[4:8]
 
+    def consume_ATND(self, cmd, data):
+        # One radio's reply to node discovery; an empty one means the end
+        if not data:
+            return
+        n = parse_ND(data, millis())
+        if n is None:
+            self.ND_malformed += 1
+            return
+        self.add_neighbour(n)
+        if self.ND_found is not None:
+            self.ND_found.append(n)
+
     def consume_ATSL(self, cmd, data):
         #print("Low serial is %s" % ' '.join("%x" % v for v in data))
         self.address = self.address[0:4] + data[0:4]
 
     def next_frame_sequence(self):
-        self.frame_sequence += 1
-        self.frame_sequence &= 0xff
-        if not self.frame_sequence:
-            self.frame_sequence = 1
-        return self.frame_sequence
-
-    def send_AT_cmd(self, cmd, param=None):
-        p = bytes([0x08, self.next_frame_sequence()])
-        p += bytes(cmd, 'ASCII')
+        # Raises TxWindowFull if every ID is in use
+        for i in range(255):
+            self.frame_sequence += 1
+            self.frame_sequence &= 0xff
+            if not self.frame_sequence:
+                self.frame_sequence = 1
+            # Don't reuse the ID of a transmit still awaiting its status,
+            # or of a remote AT command still awaiting its reply
+            if not self.tx_tracker.pending(self.frame_sequence) \
+               and self.frame_sequence not in self.remote_AT_pending:
+                return self.frame_sequence
+        raise TxWindowFull("no free frame ID")
+
+    def encode_AT_param(self, param):
+        # ints go big-endian in as few bytes as they need
+        if isinstance(param, (bytes, bytearray, memoryview)):
+            return param
+        if isinstance(param, int):
+            b = bytearray([param & 0xff])
+            param >>= 8
+            while param:
+                b.insert(0, param & 0xff)
+                param >>= 8
+            return bytes(b)
+        if isinstance(param, str):
+            return bytes(param, 'ASCII')
+        return bytes(param)
+
+    def send_AT_cmd(self, cmd, param=None, flush=True):
+        if param is not None:
+            param = self.encode_AT_param(param)
+        frame_id = self.next_frame_sequence()
+        txb = self.begin_frame(4 + (0 if param is None else len(param)))
+        txb.put_byte(0x08)
+        txb.put_byte(frame_id)
+        txb.put(cmd)
+        if param is not None:
+            txb.put(param)
+        txb.end()
+        if flush:
+            self.xcvr.flush_tx()
+        return frame_id
+
+    def send_remote_AT_cmd(self, dest_address, cmd, param=None, apply=True,
+                           flush=True, timeout=None):
+        # 0x17 Remote AT Command Request; returns its frame ID. The reply
+        # is kept if it comes within timeout ms (remote_AT_timeout if None).
+        now = millis()
+        if self.remote_AT_pending:
+            self.expire_remote_AT(now)
+        if param is not None:
+            param = self.encode_AT_param(param)
+        frame_id = self.next_frame_sequence()
+        txb = self.begin_frame(15 + (0 if param is None else len(param)))
+        txb.put_byte(0x17)
+        txb.put_byte(frame_id)
+        txb.put(dest_address)
+        txb.put_byte(0xFF)
+        txb.put_byte(0xFE)
+        txb.put_byte(0x02 if apply else 0x00) # apply changes now
+        txb.put(cmd)
         if param is not None:
-            if not isinstance(param, (bytes, bytearray)):
-                if isinstance(param, int):
-                    param = bytes([param])
-                elif isinstance(param, str):
-                    param = bytes(param, 'ASCII')
-                else:
-                    param = bytes(param)
-            p += param
-        self.xcvr.send_packet(p)
-
-    def do_AT_cmd_and_process_response(self, cmd, param=None):
-        self.send_AT_cmd(cmd, param)
-        self.get_and_process_available_packets(timeout=1) # FIXME: is 1ms long enough?
+            txb.put(param)
+        txb.end()
+        self.remote_AT_replies.pop(frame_id, None)   # an old one, uncollected
+        if timeout is None:
+            timeout = self.remote_AT_timeout
+        self.remote_AT_pending[frame_id] = now + timeout
+        if flush:
+            self.xcvr.flush_tx()
+        return frame_id
+
+    def begin_frame(self, n):
+        # Start a frame with an n-byte payload in the transmit buffer,
+        # sending what's already there first if it won't fit
+        txb = self.xcvr.txb
+        if txb.start >= 0:
+            # Only the nATTN drain gets here, having cut into the main
+            # program's frame: an AT command from a handler, say
+            raise RadioException("transmit frame already being built")
+        if txb.room() < n:
+            self.xcvr.flush_tx()
+        txb.begin()
+        return txb
+
+    def flush_tx(self):
+        # Send any frames queued with flush=False
+        self.xcvr.flush_tx()
+
+    def do_AT_cmd_and_process_response(self, cmd, param=None, timeout=100):
+        # As at(), but an error status just returns None
+        try:
+            return self.at(cmd, param, timeout)
+        except ATCommandError:
+            return None
+
+    def at(self, cmd, param=None, timeout=100):
+        # Run an AT command and wait for the reply with its frame ID.
+        # Returns the decoded value read, or None for a set or execute.
+        # Raises ATCommandError on a bad status, PacketWaitTimeout if no
+        # reply comes within timeout ms.
+        frame_id = self.send_AT_cmd(cmd, param)
+        return self.complete_AT(self.wait_AT_reply(frame_id, timeout), param)
+
+    def complete_AT(self, reply, param=None):
+        # Finish an AT command sent with send_AT_cmd(cmd, param), given
+        # its reply (cmd, status, data) from AT_replies: check the status,
+        # keep self.values up to date, and return what at() returns
+        cmd, status, data = reply
+        if status != 0:
+            raise ATCommandError("AT%s status %d" % (cmd, status))
+        if param is not None or not data:
+            self.values.pop(cmd, None)
+            self.values_time.pop(cmd, None)
+            return None
+        value = self.decode_AT_value(cmd, data)
+        self.values[cmd] = value
+        self.values_time[cmd] = millis()
+        return value
+
+    def remote_at(self, dest_address, cmd, param=None, timeout=1000, apply=True):
+        # As at(), on the radio at dest_address. Nothing is cached.
+        for dest, status, value in self.remote_at_fanout([dest_address], cmd, param,
+                                                         timeout, 1, apply):
+            if status is None:
+                raise PacketWaitTimeout("no reply to remote AT%s in %dms"
+                                        % (cmd, timeout))
+            if status != 0:
+                raise ATCommandError("remote AT%s status %d" % (cmd, status))
+            return value
+
+    def remote_at_fanout(self, dest_addresses, cmd, param=None, timeout=1000,
+                         concurrency=16, apply=True):
+        # Run one AT command on many radios, up to concurrency of them in
+        # flight at once, and yield (dest, status, value) for each as its
+        # reply comes in. status is None if there was no reply within
+        # timeout ms of sending; value is the decoded value read, or None.
+        # The whole takes about as long as the slowest node, not the sum.
+        concurrency = max(1, min(concurrency, 128))
+        pending = {}            # frame ID -> (dest, when sent)
+        replies = self.remote_AT_replies
+        dest_addresses = list(dest_addresses)
+        i = 0
+        n = len(dest_addresses)
+        try:
+            while i < n or pending:
+                while i < n and len(pending) < concurrency:
+                    dest = dest_addresses[i]
+                    frame_id = self.send_remote_AT_cmd(dest, cmd, param, apply,
+                                                       flush=False,
+                                                       timeout=timeout + 1)
+                    pending[frame_id] = (dest, millis())
+                    i += 1
+                self.xcvr.flush_tx()
+                self.get_and_process_available_packets(timeout=1)
+                now = millis()
+                for frame_id in list(pending):
+                    dest, t = pending[frame_id]
+                    if frame_id in replies:
+                        del pending[frame_id]
+                        source, rcmd, status, data = replies.pop(frame_id)
+                        value = None
+                        if status == 0 and data:
+                            value = self.decode_AT_value(cmd, data)
+                        yield dest, status, value
+                    elif now - t > timeout:
+                        del pending[frame_id]
+                        self.remote_AT_pending.pop(frame_id, None)
+                        self.AT_timeouts += 1
+                        yield dest, None, None
+        finally:
+            # Abandoned part way: stop waiting on what's still out
+            for frame_id in pending:
+                self.remote_AT_pending.pop(frame_id, None)
+                replies.pop(frame_id, None)
+
+    def wait_AT_reply(self, frame_id, timeout=100):
+        # (cmd, status, data) of the 0x88 reply with this frame ID
+        self.AT_replies.pop(frame_id, None)
+        t0 = millis()
+        while frame_id not in self.AT_replies:
+            if elapsed_millis(t0) > timeout:
+                self.AT_timeouts += 1
+                raise PacketWaitTimeout("no reply to AT frame 0x%x in %dms"
+                                        % (frame_id, timeout))
+            self.get_and_process_available_packets(timeout=1)
+        return self.AT_replies.pop(frame_id)
+
+    def wait_AT_replies(self, frame_ids, timeout=100):
+        # Replies to several AT frames in flight at once, as a dict of
+        # frame ID -> (cmd, status, data). Any missing had no reply
+        # within timeout ms.
+        for frame_id in frame_ids:
+            self.AT_replies.pop(frame_id, None)
+        replies = {}
+        t0 = millis()
+        while len(replies) < len(frame_ids) and elapsed_millis(t0) <= timeout:
+            self.get_and_process_available_packets(timeout=1)
+            for frame_id in frame_ids:
+                if frame_id in self.AT_replies:
+                    replies[frame_id] = self.AT_replies.pop(frame_id)
+        self.AT_timeouts += len(frame_ids) - len(replies)
+        return replies
+
+    def configure(self, settings, apply=True, write=False, timeout=500):
+        # Bring the radio's AT parameters to settings, a dict of
+        # {cmd: value}. All are read back in one pipelined burst, only
+        # those that differ are written (again all at once), and then
+        # AC applies them and WR (if write) commits them to flash, once.
+        # Returns a report dict:
+        #   'changed': {cmd: (old value, new value)}
+        #   'unchanged': [cmd, ...]
+        #   'failed': {cmd: status, or None if there was no reply}
+        #   'applied', 'written': whether AC and WR were done
+        #   'ms': how long it all took
+        t0 = millis()
+        changed = {}
+        unchanged = []
+        failed = {}
+
+        reads = {}
+        for cmd in settings:
+            reads[self.send_AT_cmd(cmd, flush=False)] = cmd
+        self.xcvr.flush_tx()
+        replies = self.wait_AT_replies(reads, timeout)
+
+        writes = {}
+        for frame_id, cmd in reads.items():
+            if frame_id not in replies:
+                failed[cmd] = None
+                continue
+            status, data = replies[frame_id][1:]
+            if status != 0:
+                failed[cmd] = status
+                continue
+            want = settings[cmd]
+            if self.same_AT_value(data, want):
+                unchanged.append(cmd)
+            else:
+                changed[cmd] = (self.decode_AT_value(cmd, data), want)
+                writes[self.send_AT_cmd(cmd, want, flush=False)] = cmd
+        if writes:
+            self.xcvr.flush_tx()
+            replies = self.wait_AT_replies(writes, timeout)
+            for frame_id, cmd in writes.items():
+                status = replies[frame_id][1] if frame_id in replies else None
+                if status != 0:
+                    failed[cmd] = status
+                    del changed[cmd]
+                self.values.pop(cmd, None)
+                self.values_time.pop(cmd, None)
+
+        applied = written = False
+        if changed and apply:
+            self.at('AC', timeout=timeout)
+            applied = True
+        if changed and write:
+            self.at('WR', timeout=timeout)
+            written = True
+        return { 'changed': changed,
+                 'unchanged': unchanged,
+                 'failed': failed,
+                 'applied': applied,
+                 'written': written,
+                 'ms': elapsed_millis(t0) }
+
+    def same_AT_value(self, data, want):
+        # Does the radio's reply data already say want?
+        if isinstance(want, int):
+            return big_endian_int(data) == want
+        return bytes(data) == bytes(self.encode_AT_param(want))
+
+    def get_value(self, cmd, max_age=None, timeout=100):
+        # The value of an AT parameter, from self.values if it is no
+        # older than max_age ms (AT_ttl[cmd] by default; 0 to always
+        # ask the radio), else read fresh from the radio
+        if max_age is None:
+            max_age = self.AT_ttl.get(cmd, 0)
+        t = self.values_time.get(cmd)
+        if t is not None and max_age and elapsed_millis(t) <= max_age:
+            self.AT_cache_hits += 1
+            return self.values[cmd]
+        self.AT_cache_misses += 1
+        return self.at(cmd, None, timeout)
+
+    ################################################################
+    # Node discovery
+
+    def discover(self, timeout=None):
+        # Run node discovery (ATND) and wait for the replies, until the
+        # radio says it's done or timeout ms (by default NT, plus a bit)
+        # are up. Returns the Neighbours that answered; they, and any
+        # others heard from, are in self.neighbours.
+        if timeout is None:
+            timeout = big_endian_int(self.get_value('NT')) * 100 + 200
+        self.ND_found = []
+        frame_id = self.send_AT_cmd('ND')
+        self.AT_replies.pop(frame_id, None)
+        t0 = millis()
+        try:
+            while elapsed_millis(t0) < timeout:
+                self.get_and_process_available_packets(timeout=10)
+                r = self.AT_replies.get(frame_id)
+                if r is not None and not r[2]:
+                    break
+            return self.ND_found
+        finally:
+            self.AT_replies.pop(frame_id, None)
+            self.ND_found = None
+
+    def resolve(self, name):
+        # The 64-bit address of the radio with NI name; KeyError if it
+        # isn't known (or hasn't been heard from in neighbours.max_age ms)
+        return self.neighbours.resolve(name)
 
     def request_MAC_from_radio(self):
         self.send_AT_cmd('SH')
         self.send_AT_cmd('SL')
 
-    def tx(self, data, dest_address=None, ack=True):
-        # Transmit an RF packet
+    def tx(self, data, dest_address=None, ack=True, flush=True):
+        # Transmit an RF packet; returns its frame ID
+        # With flush=False the frame waits in the transmit buffer, to go
+        # out in one SPI transaction with others at the next flush_tx()
+        if dest_address is None:
+            dest_address = self.correspondent_address
+        if self.xcvr.busy:
+            # From a handler in the nATTN drain (see subscribe()). Copied,
+            # as data may be a view of a buffer that's about to be reused.
+            if not isinstance(data, str):
+                data = bytes(data)
+            self.tx_deferred.append((data, dest_address, ack))
+            self.tx_deferrals += 1
+            return None
+        if self.tx_deferred:
+            self.send_deferred(True)   # they were first
+        return self.tx_now(data, dest_address, ack, flush)
+
+    def send_deferred(self, wait):
+        # Send what tx() put off in the drain, in order; unless wait, only
+        # as much as the transmit window has room for now
+        q = self.tx_deferred
+        if not q or self.xcvr.busy:
+            return
+        while q and (wait or not self.tx_tracker.window_full()):
+            data, dest_address, ack = q[0]
+            self.tx_now(data, dest_address, ack, False)
+            q.pop(0)
+        self.xcvr.flush_tx()
+
+    def tx_now(self, data, dest_address, ack, flush):
         if ack:
             options = 0x00
         else:
             options = 0x01
-        if dest_address is None:
-            dest_address = self.correspondent_address
-        p = bytes([0x10, self.next_frame_sequence()])
-        p += dest_address
-        p += bytes([0xFF, 0xFE, # "Reserved"
-                    0x00,       # use max broadcast radius
-                    options])
-        p += data
-        #print("tx %s ..." % p[:16]) # DEBUG
-        self.xcvr.send_packet(p)
+        self.wait_tx_window(self.tx_window_timeout)
+        if self.addresses is not None:
+            dest16 = self.addresses.lookup(dest_address)
+        else:
+            dest16 = 0xFFFE     # "unknown": the radio discovers the route
+        frame_id = self.next_frame_sequence()
+        txb = self.begin_frame(6 + len(dest_address) + len(data))
+        txb.put_byte(0x10)
+        txb.put_byte(frame_id)
+        txb.put(dest_address)
+        txb.put_byte(dest16 >> 8)
+        txb.put_byte(dest16 & 0xFF)
+        txb.put_byte(0x00)      # use max broadcast radius
+        txb.put_byte(options)
+        txb.put(data)
+        txb.end()
+        self.tx_tracker.add(frame_id, dest_address, millis())
+        if flush:
+            self.xcvr.flush_tx()
+        return frame_id
+
+    ################################################################
+    # Transmit tracking
+
+    def wait_tx_window(self, timeout):
+        # Wait until fewer than tx_window frames await their status
+        tracker = self.tx_tracker
+        if not tracker.window_full():
+            return
+        self.xcvr.flush_tx()
+        self.tx_window_waits += 1
+        t0 = millis()
+        while True:
+            self.get_and_process_available_packets(timeout=1)
+            tracker.expire(millis())
+            if not tracker.window_full():
+                self.tx_window_wait_ms += elapsed_millis(t0)
+                return
+            if elapsed_millis(t0) > timeout:
+                self.tx_window_wait_ms += elapsed_millis(t0)
+                raise TxWindowFull("%d frames awaiting status" % tracker.outstanding)
+
+    def tx_status(self, frame_id):
+        # The TxResult of a frame from tx() once its Transmit Status is
+        # in (after which it is forgotten), or None while still pending
+        self.get_and_process_available_packets(timeout=0)
+        self.tx_tracker.expire(millis())
+        return self.tx_tracker.poll(frame_id)
+
+    def wait_tx(self, frame_id, timeout=1000):
+        # Wait for a frame's TxResult, or raise PacketWaitTimeout
+        self.xcvr.flush_tx()
+        t0 = millis()
+        while True:
+            r = self.tx_status(frame_id)
+            if r is not None:
+                return r
+            if elapsed_millis(t0) > timeout:
+                self.tx_timeouts += 1
+                raise PacketWaitTimeout("no Transmit Status for frame 0x%x in %dms"
+                                        % (frame_id, timeout))
+            self.get_and_process_available_packets(timeout=1)
 
     def rx(self, timeout=1):
         # return next available (address, data) received
+        q = self.received_data_packets
         try:
-            return self.received_data_packets.pop()
+            v = q.get()
         except IndexError:
             self.get_and_process_available_packets(timeout=timeout)
-            return self.received_data_packets.pop()
+            return q.get()
+        if self.irq_rx and q.policy == BACKPRESSURE:
+            self.xcvr.drain()   # room again: pick up what was left waiting
+        return v
 
     def rx_available(self):
-        self.get_and_process_available_packets(timeout=1)
+        if self.irq_rx:
+            self.xcvr.drain()
+        else:
+            self.get_and_process_available_packets(timeout=1)
         return len(self.received_data_packets)
 
 
     ################################################################
     # Visibility and debugging
 
-    response_names = { 0x88: "AT Command Response",
-                       0x8A: "Modem Status",
-                       0x8B: "Transmit Status",
-                       0x90: "RX Indicator (AO=0)",
-                       0x91: "Explicit Rx Indicator (AO=1)",
-                       0x95: "Node Identification Indicator (AO=0)",
-                       0x97: "Remote Command Response" }
+    response_names = dict((t, c.name) for t, c in FRAME_TYPES.items())
 
     def print_response_frame(self, frame):
-        frame_type = frame[0]
-        try:
-            print("%s:" % self.response_names[frame_type], end='')
-        except KeyError:
-            print("Unk frame %r" % frame)
+        f = decode(frame)
+        if f.frame_type not in FRAME_TYPES:
+            print("Unk frame %r" % bytes(frame))
             return
-        if frame_type == 0x88:
-            print(" id 0x%x %s %s" %
-                  (frame[1],
-                   str(frame[2:4], 'ASCII'),
-                   ["OK", "ERR", "Invalid Cmd", "Invalid Param"][frame[4]]),
-                  end='')
-            if len(frame) > 5:
-                print(" %s" % ' '.join("%x" % v for v in frame[5:]),
-                      end='')
-        elif frame_type == 0x8a:
-            print(" %s" % { 0x00: "HW reset",
-                            0x01: "Watchdog reset",
-                            0x0b: "Network Woke Up",
-                            0x0c: "Network Went To Sleep" }[frame[1]],
-                  end='')
-        elif frame_type == 0x8b:
-            print(" id 0x%x, %d retries, %s, %s" %
-                  (frame[1],
-                   frame[4],
-                   { 0x00: "Success",
-                     0x01: "MAC ACK Failure",
-                     0x21: "Network ACK Failure",
-                     0x25: "Route Not Found",
-                     0x74: "Payload too large",
-                     0x75: "Indirect message unrequested" }[frame[5]],
-
-                   { 0x00: "No Discovery Overhead",
-                     0x02: "Route Discovery" }[frame[6]]),
-                  end='')
-        elif frame_type == 0x90:
-            print(" from %s, options 0x%x data %s" %
-                  (':'.join("%x" % v for v in frame[1:9]),
-                   frame[11],
-                   ' '.join("%x" % v for v in frame[12:])),
-                  end='')
-        print()
+        print("%s: %s" % (f.name, f.describe()))
 
 
     # various debugging utilities